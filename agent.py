@@ -4,17 +4,22 @@ import logging
 import sys
 import time
 
-import RPi.GPIO as GPIO
 import paho.mqtt.client as mqtt_client
 
-from controller import TempController
+from async_runtime import AsyncRuntime
+from controller import TempController, fan_configs
 from hardware_id import get_cpu_id
+from metrics import Metrics
+from mqtt_outbox import MqttOutbox
 from pacer import Pacer
+from persistence import PersistenceService
 from peripherals.blower_fan import BlowerFan
+from peripherals.simulation import Simulation
 from peripherals.temperature_sensors import Max31850Sensors
 from commands import Commands
 
 from db.data_logger import DataLogger
+from notifications.notify import Notifier
 
 logger = logging.getLogger(__name__)
 
@@ -30,24 +35,74 @@ class Agent:
         self._setup_logger()
         logger.info('HardwareID={}'.format(get_cpu_id()))
 
+        # Hardware backends, real GPIO and 1-wire unless simulating the smoker.
+        if config.get('simulation', {}).get('enabled', False):
+            simulation = Simulation(config)
+            self._gpio = simulation.gpio
+            ds = simulation.ds
+            pulse_counter = simulation.pulse_counter
+        else:
+            import RPi.GPIO
+            import DS18B20
+            self._gpio = RPi.GPIO
+            ds = DS18B20
+            pulse_counter = None
+
         # GPIOs
-        GPIO.setmode(GPIO.BCM)
+        self._gpio.setmode(self._gpio.BCM)
 
         self._go = False
-        self._temp_sensors = Max31850Sensors(self._config['temperature'])
-        self._blower_fan = BlowerFan(self._config['fan'])
+        self._runtime = None
+        self._temp_sensors = Max31850Sensors(self._config['temperature'], ds)
+        # Blower fans by name, the one of the 'fan' section first, possibly more for other zones
+        self._fans = {name: BlowerFan(fan_config, self._gpio, pulse_counter if name == 'fan' else None)
+                      for name, fan_config in fan_configs(config).items()}
 
         # Our MQTT client
         self._client = mqtt_client.Client(client_id=get_cpu_id())
+        # Publishes go through a bounded outbox, so a broker outage does not pile them up in paho's memory
+        self._outbox = None
+        self._publisher = self._client
+        if config['mqtt'].get('outbox', {}).get('enabled', False):
+            self._outbox = MqttOutbox(config['mqtt']['outbox'], self._client)
+            self._publisher = self._outbox
 
         # Data logger
-        self._data_logger = DataLogger(config['data_logger']['path'], get_cpu_id())
+        self._data_logger = DataLogger(config['data_logger']['path'], get_cpu_id(), config['data_logger'])
+
+        # Instrumentation
+        self._metrics = Metrics(config.get('metrics', {}))
+        self._metrics.gauge('data_logger.queue_depth', lambda: self._data_logger.queue_depth)
+        self._metrics.gauge('data_logger.dropped_samples', lambda: self._data_logger.dropped_samples)
+        self._metrics.gauge('sensors.timing', lambda: self._temp_sensors.timing)
+        for name, fan in self._fans.items():
+            if fan.monitor is not None:
+                self._metrics.gauge(name + '.monitor', lambda monitor=fan.monitor: monitor.stats)
+        if self._outbox is not None:
+            self._metrics.gauge('mqtt.outbox', lambda: self._outbox.stats)
+        self._last_metrics_publish = -float('inf')
+
+        # Config and state changes are saved off the MQTT thread
+        self._persistence = PersistenceService(config.get('persistence', {}))
+        self._metrics.gauge('persistence', lambda: self._persistence.stats)
+
+        # Push notifications to registered devices, queued in an outbox next to the logged data
+        self._notifier = None
+        if config.get('notifications', {}).get('enabled', False):
+            self._notifier = Notifier(config['notifications'], config['data_logger']['path'], self._data_logger)
+            self._metrics.gauge('notifications', lambda: self._notifier.stats)
 
         # IController
-        self._controller = TempController(self._config, self._temp_sensors, self._blower_fan, self._client,
-                                          self._data_logger)
+        self._controller = TempController(self._config, self._temp_sensors, self._fans, self._publisher,
+                                          self._data_logger, self._metrics, persistence=self._persistence,
+                                          notifier=self._notifier)
+
+        self._commands = Commands(self._config, self._publisher, self._data_logger, self._metrics)
 
-        self._commands = Commands(self._config, self._client, self._data_logger)
+        # Threads per peripheral by default, or everything on a single event loop.
+        if config.get('runtime', {}).get('mode', 'threads') == 'asyncio':
+            self._runtime = AsyncRuntime(config, self._client, self._controller, self._temp_sensors,
+                                         self._fans, self._data_logger, self._metrics, self._after_tick)
 
     def _setup_logger(self):
         # Setup logger
@@ -65,16 +120,40 @@ class Agent:
 
         # Connect to MQTT
         self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
         self._client.connect_async(host=self._config["mqtt"]["broker_host"],
                                    port=self._config["mqtt"]["broker_port"])
-        self._client.loop_start()
+        if self._runtime is None:
+            self._client.loop_start()
+            # Start data logger, possibly in write-behind mode
+            self._data_logger.start()
+        self._persistence.start()
+        if self._outbox is not None:
+            self._outbox.start()
+        if self._notifier is not None:
+            self._notifier.start()
         # Initialise controller
         self._controller.initialise()
         self._commands.init()
 
     def run(self):
         self._go = True
-        self._control_loop()
+        if self._runtime is not None:
+            try:
+                self._runtime.run(self._create_pacer())
+            finally:
+                self._commands.stop()
+                self._persistence.stop()
+                if self._notifier is not None:
+                    self._notifier.stop()
+                if self._outbox is not None:
+                    self._outbox.stop()
+                self._stop_monitors()
+                # We are done with GPIOs.
+                self._gpio.cleanup()
+                logger.info('Event loop terminated.')
+        else:
+            self._control_loop()
 
     def terminate(self):
         # Causes the control loop to stop
@@ -82,40 +161,86 @@ class Agent:
         self._controller.stop()
         self._client.loop_stop()
 
+        self._commands.stop()
+
+        # Flush whatever the data logger still has queued, pending config and state changes, and keep what was
+        # learned about the fan
+        self._data_logger.stop()
+        self._persistence.stop()
+        if self._notifier is not None:
+            self._notifier.stop()
+        if self._outbox is not None:
+            self._outbox.stop()
+        self._stop_monitors()
+
         # We are done with GPIOs.
-        GPIO.cleanup()
+        self._gpio.cleanup()
         # Terminates communications.
         self._client.disconnect()
         logger.info('Control loop terminated.')
 
+    def _stop_monitors(self):
+        for fan in self._fans.values():
+            if fan.monitor is not None:
+                fan.monitor.stop()
+
     def _control_loop(self):
         logger.info('Running control loop.')
-        pacer = Pacer()
+        pacer = self._create_pacer()
         self._controller.start()
+        pacer.start()
         try:
             while self._go:
+                # Wall clock for logging and publishing, monotonic for control.
                 now = time.time()
+                monotonic_now = time.monotonic()
 
                 # Tick controller
-                self._controller.tick(now)
+                with self._metrics.stage('tick'):
+                    self._controller.tick(now, monotonic_now)
+                self._after_tick(now, monotonic_now)
 
                 # Pace control loop per desired interval
                 try:
-                    pacer.pace(now, self._config['intervals']['control_loop_second'])
+                    lateness = pacer.pace()
+                    if lateness > 0:
+                        self._metrics.count('pacer.overruns')
+                        self._metrics.record('pacer.lateness', lateness)
                 except KeyboardInterrupt:
                     self._go = False
         finally:
             self.terminate()
 
+    def _create_pacer(self):
+        intervals = self._config['intervals']
+        pacer = Pacer(intervals['control_loop_second'], intervals.get('overrun_policy', Pacer.SKIP),
+                      intervals.get('max_catch_up', 5))
+        self._metrics.gauge('pacer', lambda: pacer.stats)
+        return pacer
+
+    def _after_tick(self, now, monotonic_now):
+        # Publish metrics periodically
+        if self._metrics.enabled and monotonic_now - self._last_metrics_publish >= self._metrics.publish_seconds:
+            self._publish_metrics()
+            self._last_metrics_publish = monotonic_now
+
+    def _publish_metrics(self):
+        topic = self._config['mqtt']['root_topic'] + get_cpu_id() + '/metrics'
+        self._publisher.publish(topic, json.dumps(self._metrics.snapshot()))
+
     def _on_connect(self, client, userdata, flags, rc):
         logger.info('MQTT Connected with result code ' + str(rc))
 
         # Subscribe to our control topics now that we have a connection
         root_topic = self._config['mqtt']['root_topic'] + get_cpu_id() + "/#"
         client.subscribe(root_topic)
+        if rc == 0 and self._outbox is not None:
+            self._outbox.connected()
 
     def _on_disconnect(self, client, userdata, rc):
         logger.info('MQTT Disonnected with result code ' + str(rc))
+        if self._outbox is not None:
+            self._outbox.disconnected()
 
 
 if __name__ == "__main__":
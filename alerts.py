@@ -0,0 +1,211 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+FIRED = 'fired'
+CLEARED = 'cleared'
+
+
+class Rule:
+    """ Alert raised while a metric of a sensor is beyond a limit.
+
+    The limit is either absolute, or relative to the set point of a state entry, e.g. 25 above the pit set point. An
+    alert fires as soon as the metric goes beyond the limit, and clears once it came back by hysteresis, so a value
+    hovering around the limit does not fire repeatedly. It will not fire again within cooldown_seconds of firing.
+
+    With require_clear, the rule is only armed once the metric was back within the limit, e.g. so the pit being cold
+    while it heats up does not count as too cold.
+    """
+
+    def __init__(self, config):
+        """
+        \:param config: Rule from the 'alerts.rules' config section.
+        """
+        self.name = config['name']
+        self.sensor = config['sensor']
+        self._above = 'above' in config
+        self._limit = config['above'] if self._above else config.get('below')
+        self._set_point = config.get('set_point')
+        self._hysteresis = config.get('hysteresis', 0)
+        self._cooldown = config.get('cooldown_seconds', 600)
+        self.active_only = config.get('active_only', True)
+        self.notify = config.get('notify', True)
+        self._message = config.get('message', '{name}: {sensor} at {value:.1f}, limit {limit:.1f}')
+        self._require_clear = config.get('require_clear', False)
+        self._last_fired = -float('inf')
+        Rule.reset(self)
+
+    def limit(self, state):
+        """ \:returns Limit against the current state, None when it depends on a set point which is not set. """
+        if self._set_point is None:
+            return self._limit
+        set_point = state.get(self._set_point, {}).get('setPoint')
+        return set_point + self._limit if set_point is not None else None
+
+    def metric(self, now, value):
+        """ \:returns Value compared against the limit, None while it is not known. """
+        return value
+
+    def reset(self):
+        self.firing = False
+        self._armed = not self._require_clear
+
+    def evaluate(self, now, value, state):
+        """ Updates the rule with a new sample of its sensor, in constant time.
+
+        \:returns FIRED or CLEARED when the alert changed, else None, along with the metric and the limit.
+        """
+        metric = self.metric(now, value)
+        limit = self.limit(state)
+        if metric is None or limit is None:
+            return None, metric, limit
+        if self._above:
+            beyond, back = metric > limit, metric < limit - self._hysteresis
+        else:
+            beyond, back = metric < limit, metric > limit + self._hysteresis
+        if not self._armed:
+            self._armed = back
+        elif not self.firing:
+            if beyond and now - self._last_fired >= self._cooldown:
+                self.firing = True
+                self._last_fired = now
+                return FIRED, metric, limit
+        elif back:
+            self.firing = False
+            return CLEARED, metric, limit
+        return None, metric, limit
+
+    def message(self, metric, limit):
+        return self._message.format(name=self.name, sensor=self.sensor, value=metric, limit=limit)
+
+
+class RateRule(Rule):
+    """ Alert on the rate of change of a sensor in units per minute, e.g. the pit cooling fast when the fire is out.
+
+    The rate is an exponential moving average of the slope between samples over about window_seconds, and is only
+    trusted once that long went by.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._window = config.get('window_seconds', 120)
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self._rate = 0.0
+        self._prev_time = None
+        self._prev_value = None
+        self._since = None
+
+    def metric(self, now, value):
+        if value is None:
+            return None
+        if self._prev_time is None:
+            self._prev_time, self._prev_value, self._since = now, value, now
+            return None
+        dt = now - self._prev_time
+        if dt > 0:
+            slope = (value - self._prev_value) / dt * 60
+            self._rate += dt / (self._window + dt) * (slope - self._rate)
+            self._prev_time, self._prev_value = now, value
+        return self._rate if now - self._since >= self._window else None
+
+
+class NoChangeRule(Rule):
+    """ Alert once a sensor did not move by more than tolerance for a number of seconds, e.g. a probe in the stall.
+
+    The metric is the time since the sensor last moved, compared against seconds.
+    """
+
+    def __init__(self, config):
+        super().__init__(dict(config, above=config['seconds']))
+        self._tolerance = config.get('tolerance', 1)
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self._reference = None
+        self._since = None
+
+    def metric(self, now, value):
+        if value is None:
+            return None
+        if self._reference is None or abs(value - self._reference) > self._tolerance:
+            self._reference = value
+            self._since = now
+        return now - self._since
+
+
+RULES = {
+    'threshold': Rule,
+    'rate': RateRule,
+    'no_change': NoChangeRule,
+}
+
+
+class AlertEngine:
+    """ Evaluates alert rules against every sample the controller reads.
+
+    Each rule keeps its own running state, so a sample costs constant time per rule whatever the history. Alert
+    changes are handed to on_alert as a dict.
+    """
+
+    def __init__(self, config, on_alert=None):
+        """
+        \:param config: The 'alerts' config section, may be empty.
+        \:param on_alert: Called with an alert dict whenever a rule fires or clears.
+        """
+        config = config if config is not None else {}
+        self.enabled = config.get('enabled', True)
+        self.on_alert = on_alert
+        self.rules = [RULES[rule.get('type', 'threshold')](rule) for rule in config.get('rules', [])]
+        self.fired = 0
+
+    def feed(self, now, monotonic_now, values, state, active):
+        """ Evaluates all rules against a sample.
+
+        \:param now: Wall clock time, alerts are stamped with it.
+        \:param monotonic_now: Monotonic time, rate, no change and cooldowns run on it.
+        \:param values: dict of sensor name to value, None when unknown.
+        \:param state: Controller state, holding the set points.
+        \:param active: Whether the controller is active, rules which only apply then are reset otherwise.
+        """
+        if not self.enabled:
+            return
+        for rule in self.rules:
+            if rule.active_only and not active:
+                if rule.firing:
+                    self._alert(rule, CLEARED, now, None, None)
+                rule.reset()
+                continue
+            change, metric, limit = rule.evaluate(monotonic_now, values.get(rule.sensor), state)
+            if change is not None:
+                self._alert(rule, change, now, metric, limit)
+
+    def _alert(self, rule, change, now, metric, limit):
+        alert = {
+            'rule': rule.name,
+            'sensor': rule.sensor,
+            'state': change,
+            'value': round(metric, 2) if metric is not None else None,
+            'limit': round(limit, 2) if limit is not None else None,
+            'timestamp': now,
+            'notify': rule.notify,
+        }
+        if change == FIRED:
+            self.fired += 1
+            alert['message'] = rule.message(metric, limit)
+            logger.warning('Alert {}'.format(alert['message']))
+        else:
+            logger.info('Alert {} cleared'.format(rule.name))
+        if self.on_alert is not None:
+            try:
+                self.on_alert(alert)
+            except Exception as ex:
+                logger.error('Alert handler failed: {}'.format(ex))
+
+    @property
+    def firing(self):
+        """ \:returns Names of the rules currently firing. """
+        return [rule.name for rule in self.rules if rule.firing]
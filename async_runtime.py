@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt_client
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioMqttHelper:
+    """ Drives a paho client from an asyncio event loop, in place of its loop_start() network thread.
+
+    The client socket is watched by the event loop, and reads and writes happen on the loop when the socket is ready.
+    Socket callbacks may come from an executor thread while (re)connecting, so they are always marshalled onto the
+    loop.
+    """
+
+    def __init__(self, loop, client, executor):
+        self._loop = loop
+        self._client = client
+        self._executor = executor
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.add_reader, sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.remove_reader, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.remove_writer, sock)
+
+    async def run(self, retry_seconds=1, max_retry_seconds=60):
+        """ Keeps the connection alive and reconnects with backoff, until cancelled. """
+        retry = retry_seconds
+        while True:
+            if self._client.loop_misc() == mqtt_client.MQTT_ERR_SUCCESS:
+                retry = retry_seconds
+                await asyncio.sleep(1)
+                continue
+
+            # Not connected, connecting blocks on DNS and TCP so it goes to the executor.
+            try:
+                await self._loop.run_in_executor(self._executor, self._client.reconnect)
+                retry = retry_seconds
+            except (OSError, ValueError) as ex:
+                logger.warning('MQTT connection failed, retrying in {}s: {}'.format(retry, ex))
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, max_retry_seconds)
+
+
+class AsyncRuntime:
+    """ Runs the agent on a single asyncio event loop.
+
+    The control tick, sensor sampling, RPM calculation, data logger writes and MQTT I/O are coroutines. Blocking
+    1-wire calls go to a small I/O executor and SQLite writes to a single worker executor, which keeps them ordered.
+    """
+
+    def __init__(self, config, client, controller, temp_sensors, fans, data_logger, metrics, on_tick=None):
+        """
+        \:param fans: dict of fan name to BlowerFan.
+        """
+        self._config = config
+        self._client = client
+        self._controller = controller
+        self._temp_sensors = temp_sensors
+        self._fans = fans
+        self._data_logger = data_logger
+        self._metrics = metrics
+        self._on_tick = on_tick
+        self._stop = None
+
+        runtime = config.get('runtime', {})
+        self._io_executor = ThreadPoolExecutor(max_workers=runtime.get('executor_workers', 2))
+        self._db_executor = ThreadPoolExecutor(max_workers=1)
+
+        # Peripherals are driven by our coroutines rather than their own threads.
+        self._temp_sensors.run_in_thread = False
+        for fan in fans.values():
+            fan.pulse_counter.run_in_thread = False
+            if fan.monitor is not None:
+                fan.monitor.run_in_thread = False
+
+    def run(self, pacer):
+        """ Runs until SIGINT/SIGTERM or until one of the coroutines fails, then shuts down in order. """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._main(loop, pacer))
+        finally:
+            self._io_executor.shutdown(wait=True)
+            self._db_executor.shutdown(wait=True)
+            loop.close()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    async def _main(self, loop, pacer):
+        self._stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stop.set)
+
+        mqtt = AsyncioMqttHelper(loop, self._client, self._io_executor)
+        self._controller.start()
+
+        # Ordered as they get shut down: control first, then producers, then consumers.
+        coroutines = [
+            ('control', self._control_loop(pacer)),
+            ('sensors', self._temp_sensors.run_async(self._io_executor)),
+            ('rpm', self._rpm()),
+            ('fan_monitor', self._fan_monitors()),
+            ('data_logger', self._data_logger.run_async(self._db_executor)),
+            ('mqtt', mqtt.run()),
+        ]
+        tasks = []
+        for name, coroutine in coroutines:
+            task = asyncio.ensure_future(coroutine)
+            task.add_done_callback(lambda t, name=name: self._task_done(name, t))
+            tasks.append(task)
+        logger.info('Running on asyncio event loop.')
+
+        await self._stop.wait()
+        logger.info('Shutting down event loop.')
+        for task in tasks:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        # Peripherals off, then flush the data logger before the connection goes.
+        self._controller.stop()
+        await loop.run_in_executor(self._db_executor, self._data_logger.stop)
+        self._client.disconnect()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+    async def _rpm(self):
+        await asyncio.gather(*[fan.pulse_counter.run_async() for fan in self._fans.values()])
+
+    async def _fan_monitors(self):
+        await asyncio.gather(*[fan.monitor.run_async() for fan in self._fans.values() if fan.monitor is not None])
+
+    def _task_done(self, name, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Coroutine {} failed: {}'.format(name, task.exception()))
+            self.stop()
+
+    async def _control_loop(self, pacer):
+        pacer.start()
+        while True:
+            # Wall clock for logging and publishing, monotonic for control.
+            now = time.time()
+            monotonic_now = time.monotonic()
+
+            # Tick controller
+            with self._metrics.stage('tick'):
+                self._controller.tick(now, monotonic_now)
+            if self._on_tick is not None:
+                self._on_tick(now, monotonic_now)
+
+            # Pace control loop per desired interval
+            lateness = await pacer.pace_async()
+            if lateness > 0:
+                self._metrics.count('pacer.overruns')
+                self._metrics.record('pacer.lateness', lateness)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+""" Benchmarks the agent hot paths on simulated hardware, and optionally checks them against a baseline.
+
+Each benchmark reports per call latency percentiles and throughput, results are written as JSON. With --compare,
+exits non zero when a benchmark got slower than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from time import perf_counter
+
+from controller import Mode
+from db.data_logger import DataLogger, INSERT_SENSOR_DATA
+from pid import PID
+from simulate import SimulationRunner
+from telemetry import TelemetryPublisher
+from peripherals.simulation import SimulatedMqttClient
+
+logger = logging.getLogger(__name__)
+
+# Fields compared against a baseline, lower is better for all of them.
+COMPARED = ('p50', 'p90', 'alloc_peak_bytes')
+
+SENSORS = [
+    ('probe1', {'temp': 65.2, 'status': 0}),
+    ('probe2', {'temp': None, 'status': 1}),
+    ('pit', {'temp': 114.8, 'status': 0}),
+    ('board', {'temp': 35.1, 'status': 'OK'}),
+]
+
+
+def _summary(timings, total=None):
+    """ \:returns Latency percentiles and throughput of a list of per call durations in seconds. """
+    timings = sorted(timings)
+    n = len(timings)
+    total = total if total is not None else sum(timings)
+    return {
+        'iterations': n,
+        'mean': total / n,
+        'p50': timings[n // 2],
+        'p90': timings[min(n - 1, int(n * 0.9))],
+        'p99': timings[min(n - 1, int(n * 0.99))],
+        'max': timings[-1],
+        'ops_per_second': n / total if total > 0 else None,
+    }
+
+
+def measure(call, iterations, before=None):
+    """ Times each call individually, before runs untimed ahead of each call, e.g. to move simulated time on. """
+    timings = [0.0] * iterations
+    for i in range(iterations):
+        if before is not None:
+            before(i)
+        start = perf_counter()
+        call(i)
+        timings[i] = perf_counter() - start
+    return _summary(timings)
+
+
+def _config():
+    with open('config/config.json') as f:
+        return json.load(f)
+
+
+def _runner(config):
+    runner = SimulationRunner(config, {'mode': Mode.ACTIVE, 'pit': {'setPoint': 115}})
+    runner.start()
+    # Get the pit up to temperature, so ticks run the usual steady state path.
+    runner.run(3600)
+    return runner
+
+
+def bench_tick(config, iterations):
+    runner = _runner(config)
+    controller = runner.controller
+
+    def before(i):
+        runner.clock.advance(runner._interval)
+        runner.sensors.sample(sleeper=lambda seconds: None)
+
+    def call(i):
+        now = runner.clock.time()
+        controller.tick(now, now)
+
+    result = measure(call, iterations, before)
+
+    # Transient allocations per tick, and blocks left behind by ticks which would hint at a leak.
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    peaks = []
+    for i in range(min(iterations, 1000)):
+        before(i)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        call(i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    retained = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    result['alloc_peak_bytes'] = sorted(peaks)[len(peaks) // 2]
+    result['retained_blocks_per_tick'] = retained / len(peaks)
+    runner.stop()
+    return result
+
+
+def bench_get_temp(config, iterations):
+    runner = _runner(config)
+    sensors = runner.sensors
+    result = measure(lambda i: sensors.reading('pit'), iterations)
+    runner.stop()
+    return result
+
+
+def bench_pid_update(config, iterations):
+    pid = PID(config['controller']['P'], config['controller']['I'], config['controller']['D'])
+    pid.set_point = 115
+    return measure(lambda i: pid.update(i, 110 + (i % 10) * 0.5), iterations)
+
+
+def bench_log_sensors_sync(config, iterations):
+    data_logger = DataLogger(':memory:', 'bench', dict(config['data_logger'], write_behind=False))
+    now = time.time()
+    result = measure(lambda i: data_logger.log_sensors(now + i, SENSORS), iterations)
+    data_logger.stop()
+    return result
+
+
+def bench_log_sensors_batched(config, iterations):
+    """ Latency is the enqueue as seen by the control loop, throughput includes draining to disk. """
+    data_logger = DataLogger(':memory:', 'bench', dict(config['data_logger'], write_behind=True,
+                                                       queue_size=iterations + 1))
+    data_logger.start()
+    now = time.time()
+    start = perf_counter()
+    result = measure(lambda i: data_logger.log_sensors(now + i, SENSORS), iterations)
+    data_logger.stop()
+    result['ops_per_second'] = iterations / (perf_counter() - start)
+    result['dropped_samples'] = data_logger.dropped_samples
+    return result
+
+
+def bench_trim(config, iterations, hours=48):
+    """ Trims a database holding an extra 2 hours on top of its retention, at 1 sample per second per sensor. """
+    results = []
+    for _ in range(max(1, iterations)):
+        with tempfile.TemporaryDirectory() as tmp:
+            data_logger = DataLogger(os.path.join(tmp, 'bench.sqlite'), 'bench',
+                                     dict(config['data_logger'], write_behind=False, retention_hours=hours))
+            now = time.time()
+            start = now - (hours + 2) * 3600
+            rows = [(start + t, 'bench', name, data['temp'], data['status'])
+                    for t in range((hours + 2) * 3600) for name, data in SENSORS]
+            data_logger.conn.executemany(INSERT_SENSOR_DATA, rows)
+            data_logger.conn.commit()
+            del rows
+
+            timer = perf_counter()
+            data_logger.trim()
+            results.append(perf_counter() - timer)
+            data_logger.conn.close()
+    return _summary(results)
+
+
+def bench_publish(config, iterations, mode=TelemetryPublisher.MODE_TOPICS):
+    client = SimulatedMqttClient()
+    publisher = TelemetryPublisher(dict(config['mqtt'].get('telemetry', {}), mode=mode), client, 'bbq/bench')
+    channels = [(name, data) for name, data in SENSORS]
+    fan = {'dutyCycle': 32.5, 'rpm': 980, 'healthy': True}
+    now = time.time()
+    return measure(lambda i: publisher.publish(now + i, channels, fan), iterations)
+
+
+BENCHMARKS = [
+    ('tick', bench_tick, 5000),
+    ('get_temp', bench_get_temp, 100000),
+    ('pid_update', bench_pid_update, 100000),
+    ('log_sensors_sync', bench_log_sensors_sync, 5000),
+    ('log_sensors_batched', bench_log_sensors_batched, 5000),
+    ('trim_48h', bench_trim, 1),
+    ('publish_topics', bench_publish, 20000),
+    ('publish_frame', lambda c, n: bench_publish(c, n, TelemetryPublisher.MODE_FRAME), 20000),
+]
+
+
+def compare(results, baseline, tolerance):
+    """ \:returns List of regressions as (benchmark, field, baseline value, new value). """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get('results', {}).get(name)
+        if old is None:
+            continue
+        for field in COMPARED:
+            if result.get(field) is None or old.get(field) is None:
+                continue
+            if result[field] > old[field] * (1 + tolerance):
+                regressions.append((name, field, old[field], result[field]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the agent hot paths.')
+    parser.add_argument('--output', default='benchmark.json', help='File to write results to')
+    parser.add_argument('--compare', help='Baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slow down over the baseline as a fraction, e.g. 0.25 for 25%%')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of iterations')
+    parser.add_argument('--only', nargs='*', help='Names of benchmarks to run')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    config = _config()
+
+    results = dict()
+    for name, bench, iterations in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        results[name] = bench(config, max(1, int(iterations * args.scale)))
+        print('{:<22} p50={:>10.2f}us p90={:>10.2f}us {:>12.0f} ops/s'.format(
+            name, results[name]['p50'] * 1e6, results[name]['p90'] * 1e6, results[name]['ops_per_second']))
+
+    output = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'node': platform.node(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, field, old, new in regressions:
+            print('REGRESSION {} {}: {:.3g} -> {:.3g} ({:+.0%})'.format(name, field, old, new, new / old - 1))
+        if regressions:
+            sys.exit(1)
+        print('No regressions beyond {:.0%}'.format(args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
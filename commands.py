@@ -1,17 +1,96 @@
 import logging
+import threading
+import time
 import uuid
 import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from hardware_id import get_cpu_id
+from metrics import Metrics
+from peripherals.temperature_sensors import named_sensors
 
 logger = logging.getLogger(__name__)
 
+# GetHistory defaults, overridden by the 'commands' config section.
+HISTORY_HOURS = 48
+HISTORY_MAX_POINTS = 500
+HISTORY_PAGE_SIZE = 100
+
+
+# Dispatcher defaults, overridden by the 'commands' config section.
+WORKERS = 2
+MAX_PENDING = 8
+DEDUPE_SIZE = 256
+
+# Fields every command carries, as field name to (accepted types, required).
+COMMAND_SCHEMA = {
+    'name': (str, True),
+    'id': ((str, int), True),
+    'reply_topic': (str, True),
+}
+
+
+def validate(cmd, schema):
+    """ Checks a command against a schema of field name to (accepted types, required).
+
+    \:returns Description of the first problem found, or None when the command is valid.
+    """
+    for field, (types, required) in schema.items():
+        if field not in cmd:
+            if required:
+                return 'missing {}'.format(field)
+        elif not isinstance(cmd[field], types) or (isinstance(cmd[field], bool) and bool not in _tuple(types)):
+            return 'invalid {}'.format(field)
+    return None
+
+
+def _tuple(types):
+    return types if isinstance(types, tuple) else (types,)
+
 
 class Commands:
-    def __init__(self, config, client, data_logger):
+    """ Dispatches commands received on the commands topic to registered handlers.
+
+    Handlers run on a bounded worker pool rather than on the MQTT network thread. A command is dropped when its id
+    was seen recently, and NACKed straight away with a reason when it is unknown, invalid, or when too many commands
+    are already pending.
+    """
+
+    def __init__(self, config, client, data_logger, metrics=None):
         self._config = config
         self._client = client
         self._data_logger = data_logger
+        self._metrics = metrics if metrics is not None else Metrics()
+        # What GetHistory streams when no sensors are asked for, as logged by the controller
+        self._history_sensors = [name for name, _, _ in named_sensors(config.get('temperature', {}))]
+
+        conf = config.get('commands', {})
+        self._executor = ThreadPoolExecutor(max_workers=conf.get('workers', WORKERS), thread_name_prefix='Commands')
+        self._slots = threading.BoundedSemaphore(conf.get('max_pending', MAX_PENDING))
+        self._dedupe_size = conf.get('dedupe_size', DEDUPE_SIZE)
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self._handlers = dict()
+
+        self.register('RegisterPushNotificationToken', self._handle_register_push_notification_token,
+                      {'token': (str, True)})
+        self.register('GetHistory', self._handle_get_history, {
+            'from': ((int, float), False),
+            'to': ((int, float), False),
+            'max_points': (int, False),
+            'page_size': (int, False),
+            'sensors': (list, False),
+        })
+        self.register('GetMetrics', self._handle_get_metrics)
+
+    def register(self, name, handler, schema=None):
+        """ Registers a handler for a command name.
+
+        \:param handler: Called with the command dict on a worker thread, returns True to ACK and False to NACK.
+        \:param schema: Command specific fields as field name to (accepted types, required).
+        """
+        self._handlers[name] = (handler, {**COMMAND_SCHEMA, **(schema or {})})
 
     def init(self):
         # Setup command topic
@@ -19,29 +98,131 @@ class Commands:
         self._client.message_callback_add(topic, self._handle_message)
         logger.info('Subscribed to {}'.format(topic))
 
+    def stop(self):
+        """ Stops taking commands, those already running are left to finish. """
+        self._executor.shutdown(wait=False)
+
     def _handle_message(self, mosq, obj, message):
+        """ Runs on the MQTT network thread, so it only validates and hands the command over. """
+        received = time.perf_counter()
         try:
             payload = message.payload.decode("utf-8")
             logger.debug('Received command payload {}'.format(payload))
+            if len(payload) == 0:
+                return
+            cmd = json.loads(payload)
+            if not isinstance(cmd, dict):
+                raise ValueError('Command is not an object')
+        except ValueError as ex:
+            self._metrics.count('commands.invalid')
+            logger.warning('Ignoring malformed command: {}'.format(ex))
+            return
+
+        # Without a reply topic and id there is no one to answer.
+        problem = validate(cmd, COMMAND_SCHEMA)
+        if problem is not None:
+            self._metrics.count('commands.invalid')
+            logger.warning('Ignoring command, {}: {}'.format(problem, payload))
+            return
+
+        if self._duplicate(cmd['id']):
+            self._metrics.count('commands.duplicate')
+            logger.info('Dropping duplicate command {} {}'.format(cmd['name'], cmd['id']))
+            return
+
+        entry = self._handlers.get(cmd['name'])
+        if entry is None:
+            logger.warning('Received unexpected command in payload {}'.format(payload))
+            self._reply(cmd, False, 'unknown_command')
+            return
+        handler, schema = entry
+        problem = validate(cmd, schema)
+        if problem is not None:
+            self._metrics.count('commands.invalid')
+            logger.warning('Invalid {} command, {}'.format(cmd['name'], problem))
+            self._reply(cmd, False, 'invalid: ' + problem)
+            return
+
+        # Back-pressure, rather than queueing without bounds.
+        if not self._slots.acquire(blocking=False):
+            self._metrics.count('commands.busy')
+            logger.warning('Too many pending commands, rejecting {} {}'.format(cmd['name'], cmd['id']))
+            self._reject_busy(cmd)
+            return
+        try:
+            self._executor.submit(self._run, handler, cmd, received)
+        except RuntimeError:
+            # Shutting down
+            self._slots.release()
+            self._reject_busy(cmd)
+
+    def _reject_busy(self, cmd):
+        # The command never ran, so a retry with the same id must not be dropped as a duplicate.
+        with self._seen_lock:
+            self._seen.pop(cmd['id'], None)
+        self._reply(cmd, False, 'busy')
+
+    def _duplicate(self, command_id):
+        """ Remembers the most recent command ids, \:returns True when an id was already seen. """
+        with self._seen_lock:
+            if command_id in self._seen:
+                self._seen.move_to_end(command_id)
+                return True
+            self._seen[command_id] = True
+            if len(self._seen) > self._dedupe_size:
+                self._seen.popitem(last=False)
+            return False
 
-            if len(payload) > 0:
-                cmd = json.loads(payload)
-                ok = False
-                if cmd['name'] == 'RegisterPushNotificationToken':
-                    ok = self._handle_register_push_notification_token(cmd)
-                else:
-                    logger.warn('Received unexpected command in payload {}'.format(payload))
-            
-                # Now ack/nack response
-                if ok:
-                    self._client.publish(cmd['reply_topic'], json.dumps({'id': cmd['id'], 'response': 'ACK'}))
-                else:
-                    self._client.publish(cmd['reply_topic'], json.dumps({'id': cmd['id'], 'response': 'NACK'}))
+    def _run(self, handler, cmd, received):
+        try:
+            ok = handler(cmd)
+            self._reply(cmd, ok, None if ok else 'failed')
         except Exception as ex:
-            logger.error('Error processing inbound command', ex)
+            logger.error('Error processing command {} {}: {}'.format(cmd['name'], cmd['id'], ex))
+            self._reply(cmd, False, 'failed')
+        finally:
+            self._slots.release()
+            self._metrics.record('command.' + cmd['name'], time.perf_counter() - received)
+
+    def _reply(self, cmd, ok, reason=None):
+        response = {'id': cmd['id'], 'response': 'ACK' if ok else 'NACK'}
+        if reason is not None:
+            response['reason'] = reason
+        self._client.publish(cmd['reply_topic'], json.dumps(response))
 
     def _handle_register_push_notification_token(self, cmd):
         token = cmd['token']
         logger.info('Push notification token {} received'.format(token))
         self._data_logger.save_push_tokens([token])
         return True
+
+    def _handle_get_metrics(self, cmd):
+        """ Replies with a snapshot of the agent metrics. """
+        self._client.publish(cmd['reply_topic'], json.dumps({'id': cmd['id'], 'metrics': self._metrics.snapshot()}))
+        return True
+
+    def _handle_get_history(self, cmd):
+        """ Streams logged sensor data back on the reply topic, one bounded page per message. """
+        conf = self._config.get('commands', {})
+        end = cmd.get('to', time.time())
+        start = cmd.get('from', end - HISTORY_HOURS * 3600)
+        max_points = min(cmd.get('max_points', HISTORY_MAX_POINTS), conf.get('history_max_points', HISTORY_MAX_POINTS))
+        page_size = min(cmd.get('page_size', HISTORY_PAGE_SIZE), conf.get('history_page_size', HISTORY_PAGE_SIZE))
+        sensors = cmd.get('sensors', self._history_sensors)
+        if end <= start or max_points <= 0 or page_size <= 0:
+            logger.warning('Invalid GetHistory request {}'.format(cmd))
+            return False
+
+        resolution, step, pages = self._data_logger.history(sensors, start, end, max_points, page_size)
+        logger.info('GetHistory {} for {} from {} to {} at {} resolution, step {}s'.format(
+            cmd['id'], sensors, start, end, resolution, step))
+        page_number = 0
+        for sensor, points in pages:
+            self._client.publish(cmd['reply_topic'], json.dumps({
+                'id': cmd['id'], 'page': page_number, 'sensor': sensor, 'resolution': resolution, 'step': step,
+                'points': points, 'last': False}))
+            page_number += 1
+        self._client.publish(cmd['reply_topic'], json.dumps({
+            'id': cmd['id'], 'page': page_number, 'resolution': resolution, 'step': step, 'points': [],
+            'last': True}))
+        return True
@@ -5,13 +5,83 @@ from json import JSONDecodeError
 
 from memoized import memoized
 
+from alerts import AlertEngine, FIRED
+from eta import CookEta
 from hardware_id import get_cpu_id
-from peripherals.temperature_sensors import Max31850Sensors
+from metrics import Metrics
+from peripherals.temperature_sensors import Max31850Sensors, named_sensors
 from pid import PID
 from notifications import notify
+from telemetry import TelemetryPublisher, Deadband, FRAME_CHANNELS
 
 logger = logging.getLogger(__name__)
 
+CONFIG_PATH = 'config/config.json'
+STATE_PATH = 'config/state.json'
+# Profile of a fan under 'fans' which sets none, by fan name.
+FAN_PROFILE_PATH = 'config/fan_profile_{}.json'
+
+# Zone of configs which define none, the pit held by the fan with both probes cooking in it.
+LEGACY_ZONE = {'name': 'pit', 'sensor': 'pit', 'fan': 'fan', 'probes': ['probe1', 'probe2']}
+
+
+def zone_configs(config):
+    """ \:returns Control zones defined in config, or the legacy pit zone. """
+    return config.get('zones') or [LEGACY_ZONE]
+
+
+def fan_configs(config):
+    """ \:returns Fan config sections by name, the 'fan' section first, then any under 'fans'.
+
+    A fan under 'fans' whose monitor sets no profile_path learns into a profile of its own, named after the fan.
+    """
+    fans = {'fan': config['fan']}
+    for name, fan_config in config.get('fans', {}).items():
+        monitor = fan_config.get('monitor')
+        if monitor is not None and 'profile_path' not in monitor:
+            fan_config = dict(fan_config, monitor=dict(monitor, profile_path=FAN_PROFILE_PATH.format(name)))
+        fans[name] = fan_config
+    return fans
+
+
+def check_zones(zones, sensor_names, fans, state):
+    """ Checks control zones against the sensors, fans and set points they refer to.
+
+    \:param zones: Zone config sections, as returned by zone_configs().
+    \:param sensor_names: Names of the configured temperature sensors.
+    \:param fans: Fan config sections by name, as returned by fan_configs().
+    \:param state: Controller state, holding the set point of each zone.
+    \:raises ValueError: Describing the first zone which could never be controlled.
+    """
+    names = set()
+    fan_zones = dict()
+    for zone in zones:
+        name = zone.get('name')
+        if name is None or name in names:
+            raise ValueError('Zone {} needs a name of its own'.format(zone))
+        names.add(name)
+        for sensor in [zone.get('sensor', name)] + zone.get('probes', []):
+            if sensor not in sensor_names:
+                raise ValueError('Zone {} refers to sensor {} which is not configured, sensors are {}'.format(
+                    name, sensor, sensor_names))
+        fan = zone.get('fan', 'fan')
+        if fan not in fans:
+            raise ValueError('Zone {} refers to fan {} which is not configured, fans are {}'.format(
+                name, fan, list(fans)))
+        if fan in fan_zones:
+            raise ValueError('Zones {} and {} both drive fan {}'.format(fan_zones[fan], name, fan))
+        fan_zones[fan] = name
+        if state.get(name, {}).get('setPoint') is None:
+            raise ValueError('Zone {} has no setPoint in the state'.format(name))
+
+    profile_paths = dict()
+    for name, fan_config in fans.items():
+        monitor = fan_config.get('monitor', {})
+        path = monitor.get('profile_path') if monitor.get('enabled', False) else None
+        if path is not None and path in profile_paths:
+            raise ValueError('Fans {} and {} would both learn into {}'.format(profile_paths[path], name, path))
+        profile_paths[path] = name
+
 
 class Mode(IntEnum):
     """ Records the state of each temp sensor. """
@@ -19,26 +89,96 @@ class Mode(IntEnum):
     ACTIVE = 1,
 
 
+class Zone:
+    """ A chamber held at its own set point by its own PID driving its own blower fan.
+
+    Its gains and blower cycle limits are the controller's, unless the zone config overrides them.
+    """
+    __slots__ = ('name', 'sensor', 'fan_name', 'fan', 'probes', 'pid', 'cycle_min', 'cycle_max', 'duty_cycle',
+                 '_config')
+
+    def __init__(self, config, fan):
+        """
+        \:param config: Zone from the 'zones' config section.
+        \:param fan: BlowerFan of the zone.
+        """
+        self._config = config
+        self.name = config['name']
+        self.sensor = config.get('sensor', self.name)
+        self.fan_name = config.get('fan', 'fan')
+        self.fan = fan
+        self.probes = config.get('probes', [])
+        self.pid = PID()
+        self.cycle_min = 0
+        self.cycle_max = 100
+        self.duty_cycle = 0
+
+    def update_params(self, controller_config, state):
+        config = {**controller_config, **self._config}
+        self.pid.Kp = config['P']
+        self.pid.Ki = config['I']
+        self.pid.Kd = config['D']
+        self.pid.set_point = state.get(self.name, {}).get('setPoint')
+        self.cycle_min = config['blower_cycle_min']
+        self.cycle_max = config['blower_cycle_max']
+
+
 class TempController:
 
-    def __init__(self, config, sensors, blower_fan, client, data_logger):
+    def __init__(self, config, sensors, blower_fan, client, data_logger, metrics=None, state=None, persistence=None,
+                 notifier=None):
+        """
+        \:param blower_fan: BlowerFan of the legacy zone, or dict of fan name to BlowerFan for every configured fan.
+        \:param state: Controller state, loaded from state.json when not given, e.g. for a simulation run.
+        \:param persistence: PersistenceService saving config and state changes, None to keep them in memory only.
+        \:param notifier: Notifier pushing fired alerts to registered devices, None to only publish them.
+        """
         self._config = config
+        self._persistence = persistence
         self._client = client
         self._data_logger = data_logger
-        self._pid = PID()
         self._temp_sensors = sensors
-        self._blower_fan = blower_fan
         self._send_loop_count = 0
 
-        # Load dynamic state configuration
-        with open('config/state.json') as f:
-            state = json.load(f)
+        # Sensors, fans and zones as generated from config, the tick loops over them.
+        self._sensor_names = [name for name, _, _ in named_sensors(config['temperature'])]
+        fans = blower_fan if isinstance(blower_fan, dict) else {'fan': blower_fan}
+        self._fans = list(fans.items())
+
+        # Load dynamic state configuration, unless given e.g. for a simulation run
+        if state is None:
+            with open(STATE_PATH) as f:
+                state = json.load(f)
         self._state = state
 
+        zones = zone_configs(config)
+        check_zones(zones, self._sensor_names, {name: conf for name, conf in fan_configs(config).items()
+                                                if name in fans}, state)
+        self._zones = [Zone(zone, fans[zone.get('fan', 'fan')]) for zone in zones]
+        self._fan_zones = {zone.fan_name: zone for zone in self._zones}
+
+        if sorted(self._sensor_names) == sorted(FRAME_CHANNELS[1:]):
+            frame_channels = FRAME_CHANNELS
+        else:
+            frame_channels = ['board'] + self._sensor_names
+        self._telemetry = TelemetryPublisher(config['mqtt'].get('telemetry', {}), client, self.topic, frame_channels)
+        self._deadband = Deadband(config['controller'].get('deadband', {}))
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._metrics.gauge('telemetry.suppressed', lambda: dict(self._deadband.suppressed))
+        self._metrics.gauge('telemetry.suppressed_frames', lambda: self._telemetry.suppressed_frames)
+        self._notifier = notifier
+        self._alerts = AlertEngine(config.get('alerts', {}), self._alert)
+        self._metrics.gauge('alerts.firing', lambda: self._alerts.firing)
+        chambers = {probe: zone.sensor for zone in self._zones for probe in zone.probes}
+        eta_config = config.get('eta', {})
+        self._eta = CookEta(eta_config, {probe: chambers.get(probe, self._zones[0].sensor)
+                                         for probe in eta_config.get('probes', chambers)})
+
     def initialise(self):
         # Initialise peripherals
         self._temp_sensors.initialise()
-        self._blower_fan.initisalise()
+        for _, fan in self._fans:
+            fan.initisalise()
 
         # Subscribe to topics
         topic = self._config['mqtt']['root_topic'] + get_cpu_id() + "/controller/config/desired"
@@ -50,6 +190,11 @@ class TempController:
         self._client.message_callback_add(topic, self._message_state)
         logger.info('Subscribed to {}'.format(topic))
 
+        # Fan faults are published as soon as they are detected, rather than on the next tick
+        for name, fan in self._fans:
+            if fan.monitor is not None:
+                fan.monitor.on_fault = lambda event, name=name: self._fan_fault(name, event)
+
         # Set pid params initially
         self._update_pid_params()
 
@@ -60,57 +205,107 @@ class TempController:
 
     def stop(self):
         self._temp_sensors.off()
-        self._blower_fan.off()
+        for _, fan in self._fans:
+            fan.off()
         logger.info('Controller stopped.')
 
-    def tick(self, now):
-        # Read sensor temps and publish
-        pit_temp = self._temp_sensors.pit_temp
-        probe1_temp = self._temp_sensors.probe1_temp
-        # TODO
-        probe2_temp = self._temp_sensors.probe2_temp
- 
-      
-        # Read fan state
-        rpm = self._blower_fan.rpm
-        healthy = self._blower_fan.is_healthy
-
-        # Calculate duty cycle
-        duty_cycle = 0
-        if self._state['mode'] == Mode.ACTIVE:
-            if pit_temp['status'] == Max31850Sensors.Status.OK:
-                duty_cycle = self._pid.update(now, pit_temp['temp'])
-                duty_cycle += self._config['controller']['blower_cycle_min']
-                duty_cycle = max(duty_cycle, self._config['controller']['blower_cycle_min'])
-                duty_cycle = min(duty_cycle, self._config['controller']['blower_cycle_max'])
-
-            # Set fan duty cycle and collect RPM
-            self._blower_fan.duty_cycle = duty_cycle
-            self._blower_fan.on()  # Always make sure fan is on
-        else:
-            self._blower_fan.off()  # Always make sure fan is off
-
-        # Publish data
+    def tick(self, now, monotonic_now=None):
+        """ Runs one control cycle.
+
+        \:param now: Wall clock time, used to timestamp published and logged data.
+        \:param monotonic_now: Monotonic time driving the PID, defaults to now.
+        """
+        if monotonic_now is None:
+            monotonic_now = now
+        metrics = self._metrics
+
+        sensors = self._temp_sensors
+        active = self._state['mode'] == Mode.ACTIVE
+        ok = Max31850Sensors.Status.OK
+
+        # Read sensor temps and fan states
+        with metrics.stage('tick.sensors'):
+            readings = [(name, sensors.reading(name)) for name in self._sensor_names]
+            values = {name: reading.temp if reading.status == ok else None for name, reading in readings}
+            fans = [(name, fan.rpm, fan.is_healthy) for name, fan in self._fans]
+
+        # Calculate duty cycle of each zone
+        for zone in self._zones:
+            duty_cycle = 0
+            if active:
+                # PID is fed the zone temperature through the configured filter, to avoid derivative kicks on noise
+                filtered = sensors.filtered_temp(zone.sensor)
+                if values.get(zone.sensor) is not None and filtered is not None and zone.pid.set_point is not None:
+                    with metrics.stage('tick.pid'):
+                        duty_cycle = zone.pid.update(monotonic_now, filtered) + zone.cycle_min
+                        duty_cycle = min(max(duty_cycle, zone.cycle_min), zone.cycle_max)
+
+                # Set fan duty cycle
+                with metrics.stage('tick.fan'):
+                    zone.fan.duty_cycle = duty_cycle
+                    zone.fan.on()  # Always make sure fan is on
+            else:
+                with metrics.stage('tick.fan'):
+                    zone.fan.off()  # Always make sure fan is off
+            zone.duty_cycle = duty_cycle
+
+        # Alert rules and ETA models see every sample, whether or not it gets published
+        with metrics.stage('tick.alerts'):
+            for name, rpm, healthy in fans:
+                values[name + '_rpm'] = rpm
+                values[name + '_healthy'] = 1 if healthy else 0
+            self._alerts.feed(now, monotonic_now, values, self._state, active)
+        with metrics.stage('tick.eta'):
+            for name in self._eta.feed(monotonic_now, values):
+                self._publish_eta(now, name)
+
+        # Publish data, only for channels which changed enough since they were last sent
         if self._send_loop_count == 0:
-            self._client.publish(self.topic + "/temperature/board", json.dumps({'temp': self._temp_sensors.board_temp}))
-            self._client.publish(self.topic + "/temperature/probe1", json.dumps(probe1_temp))
-            self._client.publish(self.topic + "/temperature/probe2", json.dumps(probe2_temp))
-            self._client.publish(self.topic + "/temperature/pit", json.dumps(pit_temp))
-            self._client.publish(self.topic + "/fan", json.dumps({'dutyCycle': duty_cycle, 'rpm': rpm, 'healthy': healthy}))
-            logger.debug('pit={}, probe={}, rpm={}, duty={}'.format(pit_temp, probe1_temp, rpm, duty_cycle))
-
-            temps=[
-                    ('probe1', probe1_temp),
-                    ('probe2', probe2_temp),
-                    ('pit', pit_temp),
-                    ('board', {'temp': self._temp_sensors.board_temp, 'status': 'OK'})
-            ]
-            self._data_logger.log_sensors(now, temps)
+            with metrics.stage('tick.publish'):
+                board_temp = sensors.board_temp
+                channels = [('board', {'temp': board_temp})]
+                channels += [(name, reading.as_dict()) for name, reading in readings]
+                fans = [(name, {'dutyCycle': self._fan_zones[name].duty_cycle if name in self._fan_zones else 0,
+                                'rpm': rpm, 'healthy': healthy}) for name, rpm, healthy in fans]
+                deadband = self._deadband
+                changed = {name for name, data in channels if deadband.changed(name, data, monotonic_now)}
+                changed.update(name for name, data in fans if deadband.changed(name, data, monotonic_now))
+                self._telemetry.publish(now, channels, fans[0][1], changed, fans[1:])
+                logger.debug('channels={}, fans={}'.format(channels, fans))
+
+            with metrics.stage('tick.log'):
+                temps = channels[1:]
+                temps.append(('board', {'temp': board_temp, 'status': 'OK'}))
+                temps = [(name, data) for name, data in temps if name in changed]
+                # Fan duty cycles are logged too, so cooks can be replayed and tuned offline
+                fan_states = [(name, data) for name, data in fans if name in changed]
+                if temps or fan_states:
+                    self._data_logger.log_sensors(now, temps, fan_states)
 
         self._send_loop_count += 1
         if self._send_loop_count > self._config['controller']['send_data_loop_count']:
             self._send_loop_count = 0
 
+    def _fan_fault(self, name, event):
+        """ Called back from the monitor of a fan whenever a fault is raised or cleared. """
+        self._metrics.count(name + '.faults.' + event['fault'])
+        topic = self.topic + ('/fan' if name == 'fan' else '/fan/' + name)
+        self._client.publish(topic + '/fault', json.dumps(event))
+
+    def _publish_eta(self, now, name):
+        """ Publishes the estimated time until a probe reaches its set point, next to its temperature. """
+        eta = self._eta.estimate(name, self._state)
+        eta['timestamp'] = now
+        eta['at'] = now + eta['seconds'] if eta['seconds'] is not None else None
+        self._client.publish(self.topic + '/temperature/' + name + '/eta', json.dumps(eta))
+
+    def _alert(self, alert):
+        """ Called back from the alert engine whenever a rule fires or clears. """
+        self._metrics.count('alerts.{}.{}'.format(alert['state'], alert['rule']))
+        self._client.publish(self.topic + '/alerts', json.dumps(alert))
+        if alert['state'] == FIRED and alert['notify'] and self._notifier is not None:
+            self._notifier.notify(alert['message'], 'BBQ alert', alert)
+
     def _message_config(self, mosq, obj, message):
         root_topic = self.topic
         payload = message.payload.decode("utf-8")
@@ -125,18 +320,17 @@ class TempController:
                 self._config['controller'] = {**self._config['controller'], **desired}
                 self._update_pid_params()
 
-                # Save config
-                with open('config/config.json', 'w') as f:
-                    json.dump(self._config, f, indent=4, sort_keys=True)
+                # Save config, written later off this thread
+                revision = self._save(CONFIG_PATH, self._config)
 
                 # Send config back as reply
-                config = json.dumps(self._config['controller'])
+                config = json.dumps({**self._config['controller'], 'revision': revision})
                 self._client.publish(root_topic + "/controller/config/reported", config)
             except JSONDecodeError as ex:
                 logger.error("Inbound payload isn't JSON: {}".format(ex.msg))
         else:
             # Send config back as reply
-            config = json.dumps(self._config['controller'])
+            config = json.dumps({**self._config['controller'], 'revision': self._revision(CONFIG_PATH)})
             self._client.publish(root_topic + "/controller/config/reported", config)
 
     def _message_state(self, mosq, obj, message):
@@ -153,20 +347,28 @@ class TempController:
                 self._state = {**self._state, **desired}
                 self._update_pid_params()
 
-                # Save state
-                with open('config/state.json', 'w') as f:
-                    json.dump(self._state, f, indent=4, sort_keys=True)
+                # Save state, written later off this thread
+                revision = self._save(STATE_PATH, self._state)
                 # Send state back as reply
-                state = json.dumps(self._state)
+                state = json.dumps({**self._state, 'revision': revision})
                 self._client.publish(root_topic + "/controller/state/reported", state)
 
             except JSONDecodeError as ex:
                 logger.error("Inbound payload isn't JSON: {}".format(ex.msg))
         else:
             # Send state back as reply
-            state = json.dumps(self._state)
+            state = json.dumps({**self._state, 'revision': self._revision(STATE_PATH)})
             self._client.publish(root_topic + "/controller/state/reported", state)
 
+    def _save(self, path, document):
+        """ \:returns Revision of the saved document, None when not persisting. """
+        if self._persistence is None:
+            return None
+        return self._persistence.save(path, document)
+
+    def _revision(self, path):
+        return self._persistence.revision(path) if self._persistence is not None else None
+
     @property
     @memoized
     def topic(self):
@@ -174,7 +376,5 @@ class TempController:
         return root_topic
 
     def _update_pid_params(self):
-        self._pid.Kp = self._config['controller']['P']
-        self._pid.Ki = self._config['controller']['I']
-        self._pid.Kd = self._config['controller']['D']
-        self._pid.set_point = self._state['pit']['setPoint']
+        for zone in self._zones:
+            zone.update_params(self._config['controller'], self._state)
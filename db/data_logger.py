@@ -1,6 +1,9 @@
 import sqlite3
+import asyncio
 import logging
-from datetime import datetime, timedelta
+import math
+import queue
+import threading
 import time
 
 logger = logging.getLogger(__name__)
@@ -16,76 +19,551 @@ CREATE TABLE IF NOT EXISTS sensor_data (
 );
 
 CREATE INDEX IF NOT EXISTS idx_sensor_timestamp ON sensor_data (timestamp);
+CREATE INDEX IF NOT EXISTS idx_sensor_device_name_timestamp ON sensor_data (device_id, sensor_name, timestamp);
 
 CREATE TABLE IF NOT EXISTS push_tokens (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     token STRING NOT NULL,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-    device_id STRING NOT NULL
+    device_id STRING NOT NULL,
+    active INTEGER NOT NULL DEFAULT 1
 );
+
+CREATE TABLE IF NOT EXISTS fan_data (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TIMESTAMP,
+    device_id STRING NOT NULL,
+    fan_name STRING NOT NULL,
+    duty_cycle FLOAT NOT NULL,
+    rpm FLOAT,
+    healthy INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_fan_timestamp ON fan_data (timestamp);
+CREATE INDEX IF NOT EXISTS idx_fan_device_name_timestamp ON fan_data (device_id, fan_name, timestamp);
 """
 
+rollup_schema = """
+CREATE TABLE IF NOT EXISTS {table} (
+    device_id STRING NOT NULL,
+    sensor_name STRING NOT NULL,
+    bucket INTEGER NOT NULL,
+    temp_min FLOAT,
+    temp_max FLOAT,
+    temp_mean FLOAT,
+    count INTEGER NOT NULL,
+    last_status STRING NOT NULL,
+    PRIMARY KEY (device_id, sensor_name, bucket)
+);
+
+CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table} (bucket);
+"""
+
+# Downsampled tables as (resolution name, table, bucket size in seconds, default retention in hours).
+ROLLUPS = (
+    ('1m', 'sensor_rollup_1m', 60, 24 * 7),
+    ('15m', 'sensor_rollup_15m', 900, 24 * 90),
+)
+
+INSERT_SENSOR_DATA = "INSERT INTO sensor_data (timestamp, device_id, sensor_name, temp, status) " \
+                     "VALUES (?, ?, ?, IFNULL(?, -1), ?);"
+INSERT_FAN_DATA = "INSERT INTO fan_data (timestamp, device_id, fan_name, duty_cycle, rpm, healthy) " \
+                  "VALUES (?, ?, ?, ?, ?, ?);"
+
+# History queries, grouped into buckets of a requested step and streamed from a cursor. The status of a bucket is the
+# one of its latest row, looked up by key, as a bare column next to aggregates would come from an arbitrary row.
+HISTORY_RAW = """
+SELECT g.t, g.temp_min, g.temp_max, g.temp_mean, g.count, (
+    SELECT status FROM sensor_data
+    WHERE device_id = :device_id AND sensor_name = :sensor AND timestamp = g.latest ORDER BY id DESC LIMIT 1)
+FROM (
+    SELECT CAST(timestamp / :step AS INTEGER) * :step AS t, MIN(NULLIF(temp, -1)) AS temp_min,
+        MAX(NULLIF(temp, -1)) AS temp_max, AVG(NULLIF(temp, -1)) AS temp_mean, COUNT(NULLIF(temp, -1)) AS count,
+        MAX(timestamp) AS latest
+    FROM sensor_data
+    WHERE device_id = :device_id AND sensor_name = :sensor AND timestamp >= :start AND timestamp < :end
+    GROUP BY t) AS g
+ORDER BY g.t;"""
+
+HISTORY_ROLLUP = """
+SELECT g.t, g.temp_min, g.temp_max, g.temp_mean, g.count, (
+    SELECT last_status FROM {table}
+    WHERE device_id = :device_id AND sensor_name = :sensor AND bucket = g.latest)
+FROM (
+    SELECT CAST(bucket / :step AS INTEGER) * :step AS t, MIN(temp_min) AS temp_min, MAX(temp_max) AS temp_max,
+        SUM(temp_mean * count) / NULLIF(SUM(count), 0) AS temp_mean, SUM(count) AS count, MAX(bucket) AS latest
+    FROM {table}
+    WHERE device_id = :device_id AND sensor_name = :sensor AND bucket >= :start AND bucket < :end
+    GROUP BY t) AS g
+ORDER BY g.t;"""
+
+# Raw samples of several sensors, merged in time order for replaying a session.
+SAMPLES = """
+SELECT timestamp, sensor_name, NULLIF(temp, -1), status
+FROM sensor_data
+WHERE device_id = ? AND sensor_name IN ({names}) AND timestamp >= ? AND timestamp < ?
+ORDER BY timestamp, id;"""
+
+FAN_SAMPLES = """
+SELECT timestamp, fan_name, duty_cycle, rpm, healthy
+FROM fan_data
+WHERE device_id = ? AND fan_name IN ({names}) AND timestamp >= ? AND timestamp < ?
+ORDER BY timestamp, id;"""
+
+DEVICES = "SELECT device_id, COUNT(*) FROM sensor_data GROUP BY device_id ORDER BY COUNT(*) DESC;"
+
+# Merges a bucket into any row already stored for it, e.g. a partial bucket written before a restart.
+UPSERT_ROLLUP = """
+INSERT INTO {table} (device_id, sensor_name, bucket, temp_min, temp_max, temp_mean, count, last_status)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (device_id, sensor_name, bucket) DO UPDATE SET
+    temp_min = MIN(IFNULL(temp_min, excluded.temp_min), IFNULL(excluded.temp_min, temp_min)),
+    temp_max = MAX(IFNULL(temp_max, excluded.temp_max), IFNULL(excluded.temp_max, temp_max)),
+    temp_mean = CASE WHEN count + excluded.count > 0 THEN
+        (IFNULL(temp_mean, 0) * count + IFNULL(excluded.temp_mean, 0) * excluded.count) / (count + excluded.count)
+    END,
+    count = count + excluded.count,
+    last_status = excluded.last_status;"""
+
 RETENTION_HOURS = 48
+TRIM_INTERVAL_SECONDS = 60
+TRIM_CHUNK_SIZE = 500
+
+TRIM_TABLE = """
+DELETE FROM {table} WHERE rowid IN (
+    SELECT rowid FROM {table} WHERE {column} < ? ORDER BY {column} LIMIT ?
+);"""
+
+# Write-behind defaults, overridden by the 'data_logger' config section.
+QUEUE_SIZE = 1000
+FLUSH_INTERVAL_SECONDS = 5
+BATCH_SIZE = 200
+
+
+class RollupAccumulator:
+    """ Keeps the open bucket of each sensor in memory, so rollups cost O(1) per sample.
+
+    Open buckets are written at every group commit, as what they took in since the last one, which the upsert merges
+    into the stored row. Rollups are then never behind the raw data by more than a commit.
+    """
+
+    def __init__(self, device_id, bucket_seconds):
+        self._device_id = device_id
+        self._bucket_seconds = bucket_seconds
+        self._buckets = dict()
+
+    def ingest(self, rows):
+        """ Adds raw rows to their buckets.
+
+        \:returns Rollup rows for buckets which got closed by these samples.
+        """
+        closed = []
+        for timestamp, _, name, temp, status in rows:
+            bucket = int(timestamp // self._bucket_seconds) * self._bucket_seconds
+            acc = self._buckets.get(name)
+            if acc is None or acc[0] != bucket:
+                if acc is not None:
+                    closed.append(self._rollup_row(name, acc))
+                # [bucket, min, max, sum, count, last status, whether it took samples since the last flush]
+                acc = [bucket, None, None, 0.0, 0, status, True]
+                self._buckets[name] = acc
+            if temp is not None:
+                acc[1] = temp if acc[1] is None else min(acc[1], temp)
+                acc[2] = temp if acc[2] is None else max(acc[2], temp)
+                acc[3] += temp
+                acc[4] += 1
+            acc[5] = status
+            acc[6] = True
+        return closed
+
+    def flush(self):
+        """ \:returns Rollup rows for what open buckets took in since the last flush, which then start over. """
+        rows = []
+        for name, acc in self._buckets.items():
+            if acc[6]:
+                rows.append(self._rollup_row(name, acc))
+                acc[1:5] = [None, None, 0.0, 0]
+                acc[6] = False
+        return rows
+
+    def drain(self):
+        """ \:returns Rollup rows for what open buckets took in since the last flush, which are then forgotten. """
+        rows = self.flush()
+        self._buckets.clear()
+        return rows
+
+    def checkpoint(self):
+        """ \:returns Copy of the open buckets, to restore() when the rows taken from them could not be written. """
+        return {name: list(acc) for name, acc in self._buckets.items()}
+
+    def restore(self, checkpoint):
+        self._buckets = checkpoint
+
+    def _rollup_row(self, name, acc):
+        bucket, temp_min, temp_max, temp_sum, count, status, _ = acc
+        mean = temp_sum / count if count > 0 else None
+        return self._device_id, name, bucket, temp_min, temp_max, mean, count, status
 
 
 class DataLogger:
-    def __init__(self, sqlite_file, device_id):
+    def __init__(self, sqlite_file, device_id, config=None, read_only=False):
+        """ Logs sensor data to SQLite.
+
+        When 'write_behind' is enabled in config, samples are queued and written by a dedicated thread in
+        group commits so callers never wait on the disk. When read_only, the file is opened as is for tools which
+        only read the log, without creating or migrating anything.
+        """
+        config = config if config is not None else {}
         self.sqlite_file = sqlite_file
         self.device_id = device_id
-        self.conn = sqlite3.connect(sqlite_file)
-        self._check_schema()
-        self._last_trim_datetime = None
+        self.read_only = read_only
+        self.conn = self._connect(check_same_thread=False)
+        # The connection is shared by the writer and whoever logs or trims, and its transaction with them.
+        self._conn_lock = threading.Lock()
+        if not read_only:
+            self._check_schema()
+
+        # Downsampled rollups, updated as samples are ingested
+        self._rollups = [(UPSERT_ROLLUP.format(table=table), RollupAccumulator(device_id, seconds))
+                         for _, table, seconds, _ in ROLLUPS]
+
+        # Retention, trimmed incrementally in bounded chunks. Rollups can be kept for longer than raw data.
+        rollup_retention = config.get('rollup_retention_hours', {})
+        self._retention = [('sensor_data', 'timestamp', config.get('retention_hours', RETENTION_HOURS)),
+                           ('fan_data', 'timestamp', config.get('retention_hours', RETENTION_HOURS))]
+        self._retention += [(table, 'bucket', rollup_retention.get(name, hours))
+                            for name, table, _, hours in ROLLUPS]
+        self._trim_interval = config.get('trim_interval_seconds', TRIM_INTERVAL_SECONDS)
+        self._trim_chunk_size = config.get('trim_chunk_size', TRIM_CHUNK_SIZE)
+        self._next_trim_time = 0
+        self._trim_pending = False
+
+        # Write-behind
+        self._write_behind = config.get('write_behind', False)
+        self._flush_interval = config.get('flush_interval_seconds', FLUSH_INTERVAL_SECONDS)
+        self._batch_size = config.get('batch_size', BATCH_SIZE)
+        self._queue = queue.Queue(maxsize=config.get('queue_size', QUEUE_SIZE))
+        self._writer_thread = None
+        self._queued = False
+        self.dropped_samples = 0
+
+    def _connect(self, **kwargs):
+        if self.read_only:
+            return sqlite3.connect('file:{}?mode=ro'.format(self.sqlite_file), uri=True, **kwargs)
+        return sqlite3.connect(self.sqlite_file, **kwargs)
 
     def _check_schema(self):
         logger.info('Setting Data Logger')
+        # WAL lets readers carry on while the writer appends, and makes commits much cheaper on SD cards.
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
         self.conn.executescript(sensor_schema)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(push_tokens);')]
+        if 'active' not in columns:
+            # Databases created before tokens could be deactivated.
+            self.conn.execute('ALTER TABLE push_tokens ADD COLUMN active INTEGER NOT NULL DEFAULT 1;')
+        for _, table, _, _ in ROLLUPS:
+            self.conn.executescript(rollup_schema.format(table=table))
         self.conn.commit()
         logger.info('Data Logger ready');
 
-    def log_sensors(self, timestamp, sensors):
-        c = self.conn.cursor()
-        for name, data in sensors:
-            temp = data['temp']
-            if temp is None:
-                temp = -1
-            c.execute(
-                "INSERT INTO sensor_data (timestamp, device_id, sensor_name, temp, status) VALUES ({}, '{}', '{}', {}, '{}');". \
-                format(timestamp, self.device_id, name, temp, data['status']))
-        self.conn.commit()
+    def start(self):
+        """ Starts the background writer when running in write-behind mode. """
+        if self._write_behind and self._writer_thread is None:
+            self._writer_thread = threading.Thread(target=self._writer_loop, name='Data Logger writer')
+            self._writer_thread.daemon = True
+            self._queued = True
+            self._writer_thread.start()
+            logger.info('Data Logger write-behind started, flushing every {}s or {} rows'.format(
+                self._flush_interval, self._batch_size))
+
+    def stop(self):
+        """ Flushes any pending samples and open rollup buckets, and stops the background writer. """
+        if self._writer_thread is not None:
+            # Sentinel has to get through even when the queue is full.
+            self._queue.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+            self._queued = False
+            logger.info('Data Logger write-behind stopped, {} samples dropped'.format(self.dropped_samples))
+        else:
+            # Whatever an async writer left behind
+            self._queued = False
+            self._drain()
+            self._flush_rollups()
+
+    async def run_async(self, executor):
+        """ Write-behind as a coroutine, batches are written on the executor which must have a single worker.
+
+        Runs until cancelled, stop() then writes whatever is still queued.
+        """
+        if not self._write_behind:
+            return
+        loop = asyncio.get_event_loop()
+        self._queued = True
+        logger.info('Data Logger async write-behind started, flushing every {}s'.format(self._flush_interval))
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await loop.run_in_executor(executor, self._drain)
+
+    def _drain(self):
+        """ Writes everything currently queued in one batch. """
+        pending = []
+        pending_fans = []
+        try:
+            while True:
+                item = self._queue.get_nowait()
+                if item is not None:
+                    pending.extend(item[0])
+                    pending_fans.extend(item[1])
+        except queue.Empty:
+            pass
+        count = len(pending) + len(pending_fans)
+        if count:
+            try:
+                self._write(pending, pending_fans)
+            except sqlite3.Error as ex:
+                logger.error('Data Logger failed to write {} samples: {}'.format(count, ex))
+
+    @property
+    def queue_depth(self):
+        """ Number of samples waiting to be written. """
+        return self._queue.qsize()
+
+    def log_sensors(self, timestamp, sensors, fans=()):
+        """ Logs temperatures, and the state of blower fans which is kept apart in fan_data.
+
+        \:param sensors: List of (name, data) with data holding temp and status.
+        \:param fans: List of (name, data) with data holding dutyCycle, rpm and healthy.
+        """
+        rows = [self._row(timestamp, name, data) for name, data in sensors]
+        fan_rows = [self._fan_row(timestamp, name, data) for name, data in fans]
+        if self._queued:
+            try:
+                self._queue.put_nowait((rows, fan_rows))
+            except queue.Full:
+                self.dropped_samples += len(rows) + len(fan_rows)
+                logger.debug('Data Logger queue full, dropped {} samples'.format(len(rows) + len(fan_rows)))
+        else:
+            self._write(rows, fan_rows)
+
+    def _row(self, timestamp, name, data):
+        return timestamp, self.device_id, name, data['temp'], data['status']
+
+    def _fan_row(self, timestamp, name, data):
+        return timestamp, self.device_id, name, data['dutyCycle'], data.get('rpm'), 1 if data['healthy'] else 0
+
+    def _write(self, rows, fan_rows=()):
+        with self._conn_lock:
+            # Rollups have to leave out whatever raw rows do not make it either
+            checkpoints = [accumulator.checkpoint() for _, accumulator in self._rollups]
+            try:
+                self.conn.executemany(INSERT_SENSOR_DATA, rows)
+                if fan_rows:
+                    self.conn.executemany(INSERT_FAN_DATA, fan_rows)
+                for upsert, accumulator in self._rollups:
+                    self.conn.executemany(upsert, accumulator.ingest(rows) + accumulator.flush())
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                self._restore_rollups(checkpoints)
+                raise
+
+        # Delete old entries periodically, one bounded chunk per write so cost never depends on database size
+        now = time.time()
+        if now >= self._next_trim_time:
+            self._trim_pending = True
+            self._next_trim_time = now + self._trim_interval
+        if self._trim_pending:
+            self._trim_pending = self.trim_chunk(now) >= self._trim_chunk_size
 
-        # Delete old entries periodically
-        now = datetime.now()
-        threshold = now - timedelta(hours=RETENTION_HOURS)
-        if self._last_trim_datetime is None or threshold > self._last_trim_datetime:
-            self.trim()
-            self._last_trim_datetime = now
+    def _writer_loop(self):
+        """ Drains the queue and writes samples in batches, until the stop sentinel is received. """
+        pending = []
+        pending_fans = []
+        deadline = time.monotonic() + self._flush_interval
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                if item is None:
+                    running = False
+                else:
+                    pending.extend(item[0])
+                    pending_fans.extend(item[1])
+            except queue.Empty:
+                pass
+
+            count = len(pending) + len(pending_fans)
+            if count and (not running or count >= self._batch_size or time.monotonic() >= deadline):
+                try:
+                    self._write(pending, pending_fans)
+                except sqlite3.Error as ex:
+                    logger.error('Data Logger failed to write {} samples: {}'.format(count, ex))
+                pending = []
+                pending_fans = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self._flush_interval
+        self._flush_rollups()
+
+    def _flush_rollups(self):
+        """ Writes open rollup buckets, merging with whatever gets written for them later. """
+        try:
+            with self._conn_lock:
+                checkpoints = [accumulator.checkpoint() for _, accumulator in self._rollups]
+                try:
+                    for upsert, accumulator in self._rollups:
+                        self.conn.executemany(upsert, accumulator.drain())
+                    self.conn.commit()
+                except sqlite3.Error:
+                    self.conn.rollback()
+                    self._restore_rollups(checkpoints)
+                    raise
+        except sqlite3.Error as ex:
+            logger.error('Data Logger failed to write rollups: {}'.format(ex))
+
+    def _restore_rollups(self, checkpoints):
+        for (_, accumulator), checkpoint in zip(self._rollups, checkpoints):
+            accumulator.restore(checkpoint)
+
+    def trim_chunk(self, now=None):
+        """ Deletes at most one chunk of entries per table older than their retention period.
+
+        \:returns Largest number of rows deleted from a table, a full chunk means more may be left to trim.
+        """
+        if now is None:
+            now = time.time()
+        deleted = 0
+        with self._conn_lock:
+            try:
+                for table, column, hours in self._retention:
+                    since = now - hours * 3600
+                    c = self.conn.execute(TRIM_TABLE.format(table=table, column=column),
+                                          (since, self._trim_chunk_size))
+                    if c.rowcount > 0:
+                        logger.debug('Trimmed {} entries from {}'.format(c.rowcount, table))
+                    deleted = max(deleted, c.rowcount)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+        return deleted
 
     def trim(self):
+        """ Deletes all entries older than the retention period, chunk by chunk. """
         logger.debug('Trimming data logger entries');
-        c = self.conn.cursor()
-        now = datetime.now()
-        since = now - timedelta(hours=RETENTION_HOURS)
-        epoch = time.mktime(since.timetuple())
-        c.execute('DELETE FROM sensor_data WHERE timestamp < {};'.format(epoch))
-        self.conn.commit()
+        now = time.time()
+        while self.trim_chunk(now) >= self._trim_chunk_size:
+            pass
 
-    def push_tokens(self):
-        """ Get all known push tokens registered under for this device"""
-        c = self.conn.cursor()
-        return c.execute("SELECT token FROM push_tokens WHERE device_id ='{}';".format(self.device_id)).fetchall()
+    def history(self, sensors, start, end, max_points, page_size):
+        """ Streams logged data for sensors between start and end, at most max_points per sensor.
 
-    def save_push_tokens(self, tokens):
-        """ Register push tokens for this device"""
-        with sqlite3.connect(self.sqlite_file) as conn:
-            c = conn.cursor()
-            for token in tokens:
-                # First find out if this compbo exists
-                count = c.execute("SELECT COUNT(*) FROM push_tokens WHERE device_id ='{}' AND token = '{}';".format(self.device_id, token)).fetchall()[0]
-                if count[0] == 0:
-                    c.execute(
-                        "INSERT INTO push_tokens (device_id, token) VALUES ('{}', '{}');".format(self.device_id, token))
-            conn.commit()
+        The coarsest source which still resolves the requested step is picked, raw data or one of the rollups,
+        and rows are read from a cursor page by page so memory use does not depend on the time range.
 
+        \:returns Tuple as (resolution, step, pages) where pages yields (sensor, points) with each point as
+        [timestamp, min, max, mean, count, status].
+        """
+        step = max(1, int(math.ceil((end - start) / max(1, max_points))))
+        resolution, query = 'raw', HISTORY_RAW
+        for name, table, seconds, _ in ROLLUPS:
+            if seconds <= step:
+                resolution, query = name, HISTORY_ROLLUP.format(table=table)
+        return resolution, step, self._history_pages(query, sensors, step, start, end, page_size)
 
+    def _history_pages(self, query, sensors, step, start, end, page_size):
+        # Own connection, so reads never interfere with the writer.
+        conn = self._connect()
+        try:
+            for sensor in sensors:
+                c = conn.execute(query, {'step': step, 'device_id': self.device_id, 'sensor': sensor, 'start': start,
+                                         'end': end})
+                rows = c.fetchmany(page_size)
+                while rows:
+                    yield sensor, [list(row) for row in rows]
+                    rows = c.fetchmany(page_size)
+        finally:
+            conn.close()
 
+    def samples(self, sensors, start=0, end=float('inf'), page_size=500):
+        """ Streams raw samples of sensors between start and end in time order, read from a cursor page by page.
+
+        \:returns Generator of (timestamp, sensor, temp, status), temp being None when the sensor had no value.
+        """
+        # Own connection, so reads never interfere with the writer.
+        conn = self._connect()
+        try:
+            query = SAMPLES.format(names=', '.join('?' * len(sensors)))
+            c = conn.execute(query, (self.device_id, *sensors, start, end if math.isfinite(end) else 1e18))
+            rows = c.fetchmany(page_size)
+            while rows:
+                yield from rows
+                rows = c.fetchmany(page_size)
+        finally:
+            conn.close()
+
+    def fan_samples(self, fans, start=0, end=float('inf'), page_size=500):
+        """ Streams the logged state of blower fans between start and end in time order, page by page.
+
+        \:returns Generator of (timestamp, fan, duty cycle, rpm, healthy).
+        """
+        # Own connection, so reads never interfere with the writer.
+        conn = self._connect()
+        try:
+            query = FAN_SAMPLES.format(names=', '.join('?' * len(fans)))
+            try:
+                c = conn.execute(query, (self.device_id, *fans, start, end if math.isfinite(end) else 1e18))
+            except sqlite3.OperationalError as ex:
+                # Opened read only as logged before fan duty cycles were, there is no fan_data table.
+                if not self.read_only or 'no such table' not in str(ex):
+                    raise
+                return
+            rows = c.fetchmany(page_size)
+            while rows:
+                yield from rows
+                rows = c.fetchmany(page_size)
+        finally:
+            conn.close()
+
+    def devices(self):
+        """ \:returns List of (device_id, sample count) found in the log, busiest first. """
+        with self._conn_lock:
+            return self.conn.execute(DEVICES).fetchall()
+
+    def push_tokens(self):
+        """ Get all active push tokens registered under for this device"""
+        # Own connection, as tokens are read and written from threads other than the writer.
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT token FROM push_tokens WHERE device_id = ? AND active = 1;",
+                                (self.device_id,)).fetchall()
+        finally:
+            conn.close()
+
+    def save_push_tokens(self, tokens):
+        """ Register push tokens for this device, reactivating any which were marked inactive"""
+        conn = self._connect()
+        try:
+            with conn:
+                c = conn.cursor()
+                for token in tokens:
+                    # First find out if this compbo exists
+                    count = c.execute("SELECT COUNT(*) FROM push_tokens WHERE device_id = ? AND token = ?;",
+                                      (self.device_id, token)).fetchall()[0]
+                    if count[0] == 0:
+                        c.execute("INSERT INTO push_tokens (device_id, token) VALUES (?, ?);", (self.device_id, token))
+                    else:
+                        c.execute("UPDATE push_tokens SET active = 1 WHERE device_id = ? AND token = ?;",
+                                  (self.device_id, token))
+        finally:
+            conn.close()
 
+    def deactivate_push_token(self, token):
+        """ Marks a push token inactive, once the push service reports its device as no longer registered"""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("UPDATE push_tokens SET active = 0 WHERE token = ?;", (token,))
+        finally:
+            conn.close()
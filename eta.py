@@ -0,0 +1,194 @@
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+LEARNING = 'learning'
+OK = 'ok'
+PLATEAU = 'plateau'
+DONE = 'done'
+UNKNOWN = 'unknown'
+
+
+class ProbeEta:
+    """ Predicts when a probe reaches its set point, from a heating model learned online.
+
+    The probe is modelled as heating towards the pit, less a constant loss such as evaporation:
+
+        dT/dt = k * (pit - T) + c
+
+    k and c are fitted by recursive least squares with exponential forgetting, from the probe and pit temperatures
+    averaged over each interval, so every update costs the same whatever the length of the cook. The model gives the
+    temperature the probe tends to, pit + c / k, and the time to reach the set point in closed form.
+
+    A probe which barely moves for plateau_seconds is in a plateau, e.g. the stall of a brisket, and has no estimate
+    until it moves on. A probe dropping by reset_drop or more within an interval was moved to another piece of meat, and
+    the model starts over.
+    """
+
+    def __init__(self, config):
+        """
+        \:param config: The 'eta' config section.
+        """
+        self._interval = config.get('interval_seconds', 60)
+        self._forgetting = config.get('forgetting', 0.98)
+        self._min_updates = config.get('min_updates', 5)
+        self._plateau_rate = config.get('plateau_rate', 0.05)
+        self._plateau_seconds = config.get('plateau_seconds', 1200)
+        self._rate_alpha = config.get('rate_alpha', 0.3)
+        self._reset_drop = config.get('reset_drop', 10)
+        self._p0 = (config.get('initial_variance_k', 1e-3), config.get('initial_variance_c', 1.0))
+        self.reset()
+
+    def reset(self):
+        # Model parameters [k, c] in per minute units, and their covariance as [[p00, p01], [p01, p11]].
+        self.k = 0.0
+        self.c = 0.0
+        self._p00, self._p01, self._p11 = self._p0[0], 0.0, self._p0[1]
+        self.updates = 0
+        # Running sums over the current interval.
+        self._start = None
+        self._n = 0
+        self._sum_temp = 0.0
+        self._sum_pit = 0.0
+        # Averages of the previous interval.
+        self._prev_time = None
+        self._prev_temp = None
+        self.temp = None
+        self.pit = None
+        self.rate = None
+        self._now = None
+        self._moving_since = None
+
+    def feed(self, now, temp, pit):
+        """ Adds a sample, in constant time.
+
+        \:param now: Monotonic time in seconds.
+        \:param temp: Probe temperature, None when unknown.
+        \:param pit: Pit temperature, None when unknown.
+        \:returns True when the model was updated, once per interval.
+        """
+        if temp is None or pit is None:
+            return False
+        if self._start is None:
+            self._start = now
+        self._n += 1
+        self._sum_temp += temp
+        self._sum_pit += pit
+        if now - self._start < self._interval:
+            return False
+
+        # Close the interval, the sample times are about equally spaced so its middle stands for the averages.
+        middle = (self._start + now) / 2
+        temp = self._sum_temp / self._n
+        pit = self._sum_pit / self._n
+        self._start, self._n, self._sum_temp, self._sum_pit = None, 0, 0.0, 0.0
+        prev_time, prev_temp = self._prev_time, self._prev_temp
+        if prev_temp is not None and temp <= prev_temp - self._reset_drop:
+            logger.info('Probe dropped from {:.1f} to {:.1f}, restarting its ETA model'.format(prev_temp, temp))
+            self.reset()
+            prev_time = None
+        self._prev_time, self._prev_temp = middle, temp
+        if prev_time is None:
+            self.temp, self.pit = temp, pit
+            self._moving_since = middle
+            return False
+
+        minutes = (middle - prev_time) / 60
+        rate = (temp - prev_temp) / minutes
+        # Regress the rate against the pit to probe difference at the middle of the step.
+        self._update((pit + self.pit) / 2 - (temp + prev_temp) / 2, rate)
+        self.temp, self.pit = temp, pit
+        self.rate = rate if self.rate is None else self.rate + self._rate_alpha * (rate - self.rate)
+        if abs(self.rate) > self._plateau_rate:
+            self._moving_since = middle
+        self._now = middle
+        return True
+
+    def _update(self, x0, rate):
+        """ One recursive least squares step for regressors x = [pit - T, 1] against the observed rate. """
+        p00, p01, p11 = self._p00, self._p01, self._p11
+        px0 = p00 * x0 + p01
+        px1 = p01 * x0 + p11
+        denominator = self._forgetting + x0 * px0 + px1
+        g0 = px0 / denominator
+        g1 = px1 / denominator
+        error = rate - (self.k * x0 + self.c)
+        self.k += g0 * error
+        self.c += g1 * error
+        lam = self._forgetting
+        self._p00 = (p00 - g0 * px0) / lam
+        self._p01 = (p01 - g0 * px1) / lam
+        self._p11 = (p11 - g1 * px1) / lam
+        # Without excitation, e.g. at a steady pit, forgetting would grow the covariance without bound.
+        if self._p00 > self._p0[0] or self._p11 > self._p0[1]:
+            scale = min(self._p0[0] / self._p00, self._p0[1] / self._p11)
+            self._p00 *= scale
+            self._p01 *= scale
+            self._p11 *= scale
+        self.updates += 1
+
+    def estimate(self, set_point):
+        """ \:returns Estimate as dict with status, seconds to go (None when unknown) and rate in degrees per minute. """
+        estimate = {'status': UNKNOWN, 'seconds': None,
+                    'rate': round(self.rate, 3) if self.rate is not None else None}
+        temp = self.temp
+        if temp is None or set_point is None:
+            return estimate
+        if temp >= set_point:
+            estimate['status'] = DONE
+            estimate['seconds'] = 0
+            return estimate
+        if self.updates < self._min_updates:
+            estimate['status'] = LEARNING
+            return estimate
+        if self._now - self._moving_since >= self._plateau_seconds:
+            estimate['status'] = PLATEAU
+            return estimate
+
+        minutes = None
+        k, c = self.k, self.c
+        if k > 1e-6:
+            # Heads towards pit + c / k exponentially, which must be past the set point to get there at all.
+            target = self.pit + c / k
+            if target > set_point:
+                minutes = math.log((target - temp) / (target - set_point)) / k
+        if minutes is None and self.rate > self._plateau_rate:
+            # The model has not caught up with the probe still creeping up, extrapolate its current rate.
+            minutes = (set_point - temp) / self.rate
+        if minutes is None:
+            estimate['status'] = PLATEAU
+            return estimate
+        estimate['status'] = OK
+        estimate['seconds'] = round(minutes * 60)
+        return estimate
+
+
+class CookEta:
+    """ Keeps an ETA predictor per probe, fed with every sample the controller reads. """
+
+    def __init__(self, config, probes):
+        """
+        \:param config: The 'eta' config section, may be empty.
+        \:param probes: dict of probe name to the sensor of the chamber it cooks in, e.g. {'probe1': 'pit'}. Their set
+        points are looked up in the state.
+        """
+        config = config if config is not None else {}
+        self.enabled = config.get('enabled', True)
+        self.predictors = {name: (ProbeEta(config), chamber) for name, chamber in probes.items()}
+
+    def feed(self, now, temps):
+        """ Adds a sample of every probe.
+
+        \:param now: Monotonic time in seconds.
+        \:param temps: dict of sensor name to temperature, None when unknown, holding probes and their chambers.
+        \:returns Names of the probes whose model was updated.
+        """
+        if not self.enabled:
+            return []
+        return [name for name, (predictor, chamber) in self.predictors.items()
+                if predictor.feed(now, temps.get(name), temps.get(chamber))]
+
+    def estimate(self, name, state):
+        """ \:returns Estimate for a probe against its set point in the state. """
+        return self.predictors[name][0].estimate(state.get(name, {}).get('setPoint'))
@@ -0,0 +1,154 @@
+import logging
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Latency bucket upper bounds in seconds, doubling from 5us to ~2.6s, plus an overflow bucket.
+BUCKET_BOUNDS = tuple(5e-6 * 2 ** i for i in range(20))
+
+
+class Histogram:
+    """ Fixed bucket latency histogram, recording is O(log buckets) and allocation free. """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """ Upper bound of the bucket holding the given fraction of samples, or None when empty. """
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        }
+
+
+class _Stage:
+    """ Reusable timer recording the duration of a with block into a histogram. """
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._histogram.record(perf_counter() - self._start)
+        return False
+
+
+class _NullStage:
+    """ Does nothing, handed out when metrics are disabled. """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Metrics:
+    """ Low overhead instrumentation: per stage latency histograms, counters and gauges read on demand.
+
+    When disabled, stages are a shared no-op and recording returns straight away. Counters, record() and the creation
+    of histograms are locked as they are used from several threads, stages are not as each is timed by one thread.
+    """
+
+    def __init__(self, config=None):
+        """
+        \:param config: The 'metrics' config section, metrics are disabled when empty.
+        """
+        config = config if config is not None else {}
+        self.enabled = config.get('enabled', False)
+        self.publish_seconds = config.get('publish_seconds', 60)
+        self._histograms = dict()
+        self._stages = dict()
+        self._counters = dict()
+        self._gauges = dict()
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """ \:returns Context manager timing a stage of work into its histogram. """
+        if not self.enabled:
+            return _NULL_STAGE
+        stage = self._stages.get(name)
+        if stage is None:
+            with self._lock:
+                stage = self._stages.get(name)
+                if stage is None:
+                    stage = self._stages[name] = _Stage(self._histogram(name))
+        return stage
+
+    def record(self, name, seconds):
+        """ Records a duration into a histogram. """
+        if self.enabled:
+            with self._lock:
+                self._histogram(name).record(seconds)
+
+    def count(self, name, n=1):
+        """ Increments a counter. """
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name, read):
+        """ Registers a callable which is read whenever a snapshot is taken, e.g. a queue depth. """
+        self._gauges[name] = read
+
+    def _histogram(self, name):
+        """ Histogram of a name, created on first use. Callers hold the lock. """
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram()
+        return histogram
+
+    def snapshot(self):
+        """ \:returns All metrics as a JSON serialisable dict. """
+        gauges = dict()
+        for name, read in list(self._gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as ex:
+                logger.debug('Failed to read gauge {}: {}'.format(name, ex))
+                gauges[name] = None
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            'enabled': self.enabled,
+            'latency': {name: h.as_dict() for name, h in list(self._histograms.items())},
+            'counters': counters,
+            'gauges': gauges,
+            'threads': sorted(t.name for t in threading.enumerate() if t.is_alive()),
+        }
@@ -0,0 +1,285 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt_client
+
+logger = logging.getLogger(__name__)
+
+outbox_schema = """
+CREATE TABLE IF NOT EXISTS mqtt_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TIMESTAMP NOT NULL,
+    topic STRING NOT NULL,
+    payload BLOB,
+    qos INTEGER NOT NULL,
+    retain INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+
+INSERT_MESSAGE = "INSERT INTO mqtt_outbox (created_at, topic, payload, qos, retain, size) VALUES (?, ?, ?, ?, ?, ?);"
+OLDEST_MESSAGES = "SELECT id, created_at, topic, payload, qos, retain, size FROM mqtt_outbox ORDER BY id LIMIT ?;"
+OLDEST_SIZES = "SELECT id, size FROM mqtt_outbox WHERE id > ? ORDER BY id LIMIT 1000;"
+DELETE_UP_TO = "DELETE FROM mqtt_outbox WHERE id <= ?;"
+DEPTH = "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM mqtt_outbox;"
+
+MEMORY_MESSAGES = 500
+MAX_DISK_BYTES = 20 * 1024 * 1024
+REPLAY_RATE = 50
+BATCH_SIZE = 25
+MAX_QUEUED_MESSAGES = 200
+RETRY_SECONDS = 5
+
+
+def _size(topic, payload):
+    return len(topic) + (len(payload) if payload is not None else 0)
+
+
+class MqttOutbox:
+    """ Stands between the agent and its paho client, so a broker outage cannot grow memory without bound.
+
+    While connected and with nothing held back, messages go straight to paho. Otherwise they are held in memory, and
+    once memory_messages are held the outbox thread spills them to a SQLite outbox in one batch. Once the outbox
+    outgrows max_disk_bytes, its oldest messages are evicted. After a reconnect the same thread replays everything in
+    order, disk first, in batches at up to replay_rate messages per second with the QoS and retain flag each was
+    published with.
+
+    Publishing only ever appends to memory, all disk I/O happens on the outbox thread and outside the lock, so the
+    control tick never waits on it. Should the thread fall behind, memory is capped at twice memory_messages by
+    dropping its oldest messages.
+
+    paho's own queue is capped at max_queued_messages, a publish it refuses is held back like any other.
+
+    Everything but publish is handed on to the client, so the outbox can stand in for it.
+    """
+
+    def __init__(self, config, client):
+        """
+        \:param config: The 'mqtt.outbox' config section.
+        \:param client: paho client to publish through.
+        """
+        self._client = client
+        self._memory_messages = config.get('memory_messages', MEMORY_MESSAGES)
+        self._max_disk_bytes = config.get('max_disk_bytes', MAX_DISK_BYTES)
+        self._replay_rate = config.get('replay_rate', REPLAY_RATE)
+        self._batch_size = config.get('batch_size', BATCH_SIZE)
+        self._retry = config.get('retry_seconds', RETRY_SECONDS)
+        client.max_queued_messages_set(config.get('max_queued_messages', MAX_QUEUED_MESSAGES))
+
+        self._condition = threading.Condition()
+        self._memory = deque()
+        # Messages taken out of memory by the outbox thread, on their way to disk or paho.
+        self._in_flight = 0
+        # Only used by the outbox thread once started.
+        self._conn = sqlite3.connect(config.get('path', ':memory:'), check_same_thread=False)
+        self._conn.executescript(outbox_schema)
+        self._conn.commit()
+        self._disk_count, self._disk_bytes = self._conn.execute(DEPTH).fetchone()
+        if self._disk_count:
+            logger.info('MQTT outbox holds {} messages from a previous run'.format(self._disk_count))
+        self._connected = False
+        self._thread = None
+        self._running = False
+        self.direct = 0
+        self.held = 0
+        self.spilled = 0
+        self.evicted = 0
+        self.replayed = 0
+
+    def __getattr__(self, name):
+        if name == '_client':
+            raise AttributeError(name)
+        return getattr(self._client, name)
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Timer(0, self._run)
+            self._thread.name = 'MQTT outbox'
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Stops the outbox thread, whatever is still held in memory goes to disk for next time. """
+        if self._thread is not None:
+            with self._condition:
+                self._running = False
+                self._condition.notify()
+            self._thread.join()
+            self._thread = None
+        with self._condition:
+            rows = list(self._memory)
+            self._memory.clear()
+        self._spill(rows)
+
+    def connected(self):
+        """ To be called once the client connected, starts replaying whatever was held back. """
+        with self._condition:
+            self._connected = True
+            self._condition.notify()
+
+    def disconnected(self):
+        with self._condition:
+            self._connected = False
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """ Publishes straight away when possible, else holds the message back until the broker is back. """
+        with self._condition:
+            if self._connected and not self._memory and not self._in_flight and not self._disk_count:
+                if self._send(topic, payload, qos, retain):
+                    self.direct += 1
+                    return
+            if len(self._memory) >= 2 * self._memory_messages:
+                # The outbox thread fell behind, most likely stuck on the disk.
+                self._memory.popleft()
+                self.evicted += 1
+            self._memory.append((time.time(), topic, payload, qos, retain))
+            self.held += 1
+            self._condition.notify()
+
+    def _send(self, topic, payload, qos, retain):
+        """ \:returns Whether paho took the message. """
+        rc = self._client.publish(topic, payload, qos, retain).rc
+        if rc == mqtt_client.MQTT_ERR_SUCCESS:
+            return True
+        if rc == mqtt_client.MQTT_ERR_NO_CONN:
+            with self._condition:
+                self._connected = False
+        return False
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._has_work():
+                    self._condition.wait()
+                if not self._running:
+                    return
+                spill = len(self._memory) >= self._memory_messages
+                if spill:
+                    rows = list(self._memory)
+                    self._memory.clear()
+                    self._in_flight += len(rows)
+            if spill:
+                try:
+                    self._spill(rows)
+                finally:
+                    with self._condition:
+                        self._in_flight -= len(rows)
+                continue
+            sent, refused = self._replay_batch()
+            # When paho refused some, the connection probably went or its queue is full.
+            self._pause(self._retry if refused else sent / self._replay_rate)
+
+    def _has_work(self):
+        """ \:returns Whether there is anything to spill or replay, must be called with the lock held. """
+        return len(self._memory) >= self._memory_messages or (self._connected and (self._memory or self._disk_count))
+
+    def _pause(self, seconds):
+        """ Sleeps between batches, waking early only to stop or to spill. """
+        deadline = time.monotonic() + seconds
+        with self._condition:
+            while self._running and len(self._memory) < self._memory_messages:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+    def _spill(self, messages):
+        """ Writes messages taken out of memory to disk, from the outbox thread only. """
+        if not messages:
+            return
+        rows = []
+        size = 0
+        for created_at, topic, payload, qos, retain in messages:
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            rows.append((created_at, topic, payload, qos, int(retain), _size(topic, payload)))
+            size += rows[-1][-1]
+        self._conn.executemany(INSERT_MESSAGE, rows)
+        self._conn.commit()
+        with self._condition:
+            self._disk_count += len(rows)
+            self._disk_bytes += size
+            self.spilled += len(rows)
+            over = self._disk_bytes - self._max_disk_bytes
+        if over > 0:
+            self._evict(over)
+
+    def _evict(self, over):
+        """ Deletes the oldest messages on disk until over bytes were freed, from the outbox thread only. """
+        last_id = 0
+        count = 0
+        freed = 0
+        while freed < over:
+            rows = self._conn.execute(OLDEST_SIZES, (last_id,)).fetchall()
+            if not rows:
+                break
+            for last_id, size in rows:
+                count += 1
+                freed += size
+                if freed >= over:
+                    break
+        if count:
+            self._conn.execute(DELETE_UP_TO, (last_id,))
+            self._conn.commit()
+            with self._condition:
+                self._disk_count -= count
+                self._disk_bytes -= freed
+                self.evicted += count
+            logger.warning('MQTT outbox over budget, evicted its {} oldest messages'.format(count))
+
+    def _replay_batch(self):
+        """ Sends up to a batch of the oldest messages, from the outbox thread only.
+
+        Nothing is published directly while messages are on disk or in flight, so they go out in order even though
+        the lock is not held while sending.
+
+        \:returns Tuple as (number of messages sent, whether paho refused one).
+        """
+        sent = 0
+        refused = False
+        with self._condition:
+            from_disk = self._disk_count > 0
+            if not from_disk:
+                batch = [self._memory.popleft() for _ in range(min(self._batch_size, len(self._memory)))]
+                self._in_flight += len(batch)
+        if from_disk:
+            rows = self._conn.execute(OLDEST_MESSAGES, (self._batch_size,)).fetchall()
+            last_id = None
+            size = 0
+            for message_id, _, topic, payload, qos, retain, message_size in rows:
+                if not self._send(topic, payload, qos, bool(retain)):
+                    refused = True
+                    break
+                last_id = message_id
+                size += message_size
+                sent += 1
+            if last_id is not None:
+                self._conn.execute(DELETE_UP_TO, (last_id,))
+                self._conn.commit()
+                with self._condition:
+                    self._disk_count -= sent
+                    self._disk_bytes -= size
+        else:
+            for _, topic, payload, qos, retain in batch:
+                if not self._send(topic, payload, qos, retain):
+                    refused = True
+                    break
+                sent += 1
+            with self._condition:
+                # Whatever paho refused goes back in front, to be tried again first.
+                self._memory.extendleft(reversed(batch[sent:]))
+                self._in_flight -= len(batch)
+        with self._condition:
+            self.replayed += sent
+        return sent, refused
+
+    @property
+    def stats(self):
+        with self._condition:
+            return {'connected': self._connected, 'memory': len(self._memory) + self._in_flight,
+                    'disk': self._disk_count, 'disk_bytes': self._disk_bytes, 'direct': self.direct,
+                    'held': self.held, 'spilled': self.spilled, 'evicted': self.evicted, 'replayed': self.replayed}
@@ -1,54 +1,259 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+
 from exponent_server_sdk import DeviceNotRegisteredError
 from exponent_server_sdk import PushClient
 from exponent_server_sdk import PushMessage
-from exponent_server_sdk import PushResponseError
 from exponent_server_sdk import PushServerError
+try:
+    from exponent_server_sdk import PushTicketError
+except ImportError:
+    # Older SDKs call per message errors response errors
+    from exponent_server_sdk import PushResponseError as PushTicketError
 from requests.exceptions import ConnectionError
 from requests.exceptions import HTTPError
 
+logger = logging.getLogger(__name__)
+
+outbox_schema = """
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TIMESTAMP NOT NULL,
+    token STRING NOT NULL,
+    title STRING,
+    body STRING NOT NULL,
+    data STRING,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL,
+    status STRING NOT NULL DEFAULT 'pending',
+    last_error STRING
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_status_next_attempt ON notification_outbox (status, next_attempt_at);
+"""
+
+INSERT_MESSAGE = "INSERT INTO notification_outbox (created_at, token, title, body, data, next_attempt_at) " \
+                 "VALUES (?, ?, ?, ?, ?, ?);"
+DUE_MESSAGES = "SELECT id, token, title, body, data, attempts FROM notification_outbox " \
+               "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?;"
+NEXT_ATTEMPT = "SELECT MIN(next_attempt_at) FROM notification_outbox WHERE status = 'pending';"
+DELETE_MESSAGE = "DELETE FROM notification_outbox WHERE id = ?;"
+RETRY_MESSAGE = "UPDATE notification_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?;"
+FAIL_TOKEN = "UPDATE notification_outbox SET status = 'failed', last_error = ? WHERE token = ? AND status = 'pending';"
+FAIL_MESSAGE = "UPDATE notification_outbox SET attempts = ?, status = 'failed', last_error = ? WHERE id = ?;"
+PRUNE_FAILED = "DELETE FROM notification_outbox WHERE status = 'failed' AND created_at < ?;"
+COUNT_BY_STATUS = "SELECT status, COUNT(*) FROM notification_outbox GROUP BY status;"
+
+# Expo accepts up to 100 messages per request
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 5
+MAX_BACKOFF_SECONDS = 600
+POLL_SECONDS = 30
+RETENTION_HOURS = 48
+
+
+class Notifier:
+    """ Sends push notifications to every device registered with the agent, through an outbox kept in SQLite.
+
+    Messages are queued per token in the outbox, so they survive restarts and network outages, and a background
+    thread sends whatever is due in batches. Transient failures are retried with jittered exponential backoff until
+    max_attempts, tokens the push service no longer knows are marked inactive and never tried again.
+    """
+
+    def __init__(self, config, sqlite_file, data_logger, push_client=None):
+        """
+        \:param config: The 'notifications' config section, may be empty.
+        \:param sqlite_file: SQLite file holding the outbox, usually the data logger's.
+        \:param data_logger: DataLogger holding the push tokens.
+        \:param push_client: Expo PushClient, or anything with a compatible publish_multiple().
+        """
+        config = config if config is not None else {}
+        self._data_logger = data_logger
+        self._client = push_client if push_client is not None else PushClient(host=config.get('push_host'))
+        self._batch_size = min(config.get('batch_size', BATCH_SIZE), BATCH_SIZE)
+        self._max_attempts = config.get('max_attempts', MAX_ATTEMPTS)
+        self._backoff = config.get('backoff_seconds', BACKOFF_SECONDS)
+        self._max_backoff = config.get('max_backoff_seconds', MAX_BACKOFF_SECONDS)
+        self._poll = config.get('poll_seconds', POLL_SECONDS)
+        self._retention = config.get('retention_hours', RETENTION_HOURS)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        # Notifications handed over by notify(), until the sender puts them in the outbox
+        self._pending = deque()
+        self._conn = sqlite3.connect(sqlite_file, check_same_thread=False)
+        self._conn.executescript(outbox_schema)
+        self._conn.commit()
+        self._thread = None
+        self._running = False
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.deactivated_tokens = 0
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Timer(0, self._send_loop)
+            self._thread.name = 'Notifier'
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Stops the sender, whatever is still queued stays in the outbox for next time. """
+        if self._thread is not None:
+            with self._wakeup:
+                self._running = False
+                self._wakeup.notify()
+            self._thread.join()
+            self._thread = None
+
+    def notify(self, body, title=None, data=None):
+        """ Hands a notification over to the sender, to be queued for every active push token of this device.
+
+        Only touches memory, so it is safe to call from the control loop.
+        """
+        self._pending.append((body, title, data))
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def queue_pending(self):
+        """ Puts the notifications handed over by notify() in the outbox, one message per active push token.
+
+        \:returns Number of messages queued.
+        """
+        queued = 0
+        while self._pending:
+            body, title, data = self._pending.popleft()
+            tokens = [row[0] for row in self._data_logger.push_tokens()]
+            if not tokens:
+                logger.debug('No push tokens to notify')
+                continue
+            now = time.time()
+            payload = json.dumps(data) if data is not None else None
+            with self._lock:
+                self._conn.executemany(INSERT_MESSAGE, [(now, token, title, body, payload, now) for token in tokens])
+                self._conn.commit()
+            queued += len(tokens)
+        return queued
+
+    def _send_loop(self):
+        while True:
+            try:
+                self.queue_pending()
+                while self.send_due() >= self._batch_size:
+                    pass
+                self.prune()
+                wait = self._wait_time()
+            except Exception as ex:
+                logger.error('Failed to send notifications: {}'.format(ex))
+                wait = self._poll
+            with self._wakeup:
+                if self._running and not self._pending:
+                    self._wakeup.wait(wait)
+                running = self._running
+            if not running:
+                # Whatever was handed over still makes it to the outbox, to be sent after a restart
+                try:
+                    self.queue_pending()
+                except Exception as ex:
+                    logger.error('Failed to queue notifications: {}'.format(ex))
+                return
+
+    def _wait_time(self):
+        with self._lock:
+            next_attempt = self._conn.execute(NEXT_ATTEMPT).fetchone()[0]
+        if next_attempt is None:
+            return self._poll
+        return max(0, min(self._poll, next_attempt - time.time()))
+
+    def send_due(self, now=None):
+        """ Sends one batch of messages which are due.
+
+        \:returns Number of messages in the batch.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._conn.execute(DUE_MESSAGES, (now, self._batch_size)).fetchall()
+        if not rows:
+            return 0
+
+        messages = [PushMessage(to=token, title=title, body=body, data=json.loads(data) if data else None)
+                    for _, token, title, body, data, _ in rows]
+        try:
+            tickets = self._client.publish_multiple(messages)
+        except PushServerError as ex:
+            # Likely a malformed request, or the service having trouble, which may be transient either way.
+            self._retry_all(rows, now, 'Push server error: {} {}'.format(ex, getattr(ex, 'errors', '')))
+            return len(rows)
+        except (ConnectionError, HTTPError) as ex:
+            self._retry_all(rows, now, 'Connection error: {}'.format(ex))
+            return len(rows)
+
+        with self._lock:
+            unregistered = {row[1] for row, ticket in zip(rows, tickets) if not self._handle_ticket(row, ticket, now)}
+            # Nothing else queued for those devices will get through either.
+            for token in unregistered:
+                self.failed += self._conn.execute(FAIL_TOKEN, ('DeviceNotRegistered', token)).rowcount
+            self._conn.commit()
+        # Once the outbox is committed, as the push tokens live in the same database.
+        for token in unregistered:
+            logger.info('Push token {} is no longer registered, deactivating it'.format(token))
+            self._data_logger.deactivate_push_token(token)
+            self.deactivated_tokens += 1
+        return len(rows)
+
+    def _handle_ticket(self, row, ticket, now):
+        """ \:returns False when the device of the message is no longer registered. """
+        message_id, _, _, _, _, attempts = row
+        try:
+            ticket.validate_response()
+            self._conn.execute(DELETE_MESSAGE, (message_id,))
+            self.sent += 1
+        except DeviceNotRegisteredError:
+            self._conn.execute(FAIL_MESSAGE, (attempts + 1, 'DeviceNotRegistered', message_id))
+            self.failed += 1
+            return False
+        except PushTicketError as ex:
+            self._retry(row, now, 'Push ticket error: {}'.format(ex))
+        return True
+
+    def _retry_all(self, rows, now, error):
+        logger.warning('Failed to send {} notifications: {}'.format(len(rows), error))
+        with self._lock:
+            for row in rows:
+                self._retry(row, now, error)
+            self._conn.commit()
+
+    def _retry(self, row, now, error):
+        message_id, _, _, _, _, attempts = row
+        attempts += 1
+        if attempts >= self._max_attempts:
+            logger.warning('Giving up on notification {} after {} attempts: {}'.format(message_id, attempts, error))
+            self._conn.execute(FAIL_MESSAGE, (attempts, error, message_id))
+            self.failed += 1
+            return
+        # Full backoff for this attempt with up to half of it as jitter, so devices do not retry in lock step.
+        delay = min(self._max_backoff, self._backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+        self._conn.execute(RETRY_MESSAGE, (attempts, now + delay, error, message_id))
+        self.retried += 1
+
+    def prune(self, now=None):
+        """ Deletes failed messages past the retention period. """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._conn.execute(PRUNE_FAILED, (now - self._retention * 3600,))
+            self._conn.commit()
 
-# Basic arguments. You should extend this function with the push features you
-# want to use, or simply pass in a `PushMessage` object.
-def send_push_message(token, message, extra=None):
-    try:
-        response = PushClient().publish(
-            PushMessage(to=token,
-                        body=message,
-                        data=extra))
-    except PushServerError as exc:
-        # Encountered some likely formatting/validation error.
-        rollbar.report_exc_info(
-            extra_data={
-                'token': token,
-                'message': message,
-                'extra': extra,
-                'errors': exc.errors,
-                'response_data': exc.response_data,
-            })
-        raise
-    except (ConnectionError, HTTPError) as exc:
-        # Encountered some Connection or HTTP error - retry a few times in
-        # case it is transient.
-        rollbar.report_exc_info(
-            extra_data={'token': token, 'message': message, 'extra': extra})
-        raise self.retry(exc=exc)
-
-    try:
-        # We got a response back, but we don't know whether it's an error yet.
-        # This call raises errors so we can handle them with normal exception
-        # flows.
-        response.validate_response()
-    except DeviceNotRegisteredError:
-        # Mark the push token as inactive
-        from notifications.models import PushToken
-        PushToken.objects.filter(token=token).update(active=False)
-    except PushResponseError as exc:
-        # Encountered some other per-notification error.
-        rollbar.report_exc_info(
-            extra_data={
-                'token': token,
-                'message': message,
-                'extra': extra,
-                'push_response': exc.push_response._asdict(),
-            })
-        raise self.retry(exc=exc)
+    @property
+    def stats(self):
+        with self._lock:
+            outbox = dict(self._conn.execute(COUNT_BY_STATUS).fetchall())
+        return {'sent': self.sent, 'retried': self.retried, 'failed': self.failed,
+                'deactivated_tokens': self.deactivated_tokens, 'outbox': outbox}
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+""" Local stand-in for the Expo push service, to exercise the notifier without sending anything to real devices.
+
+Point notifications.push_host at it, e.g. http://localhost:8765, then run:
+
+    python -m notifications.stub_push_server --port 8765 --unregistered ExponentPushToken[gone] --fail-rate 0.2
+
+Every message received is printed as a JSON line. Tokens listed as unregistered get a DeviceNotRegistered ticket, and
+a share of requests can be failed with a 503 to exercise retries.
+"""
+import argparse
+import json
+import random
+import sys
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+SEND_PATH = '/--/api/v2/push/send'
+
+
+class StubPushServer(HTTPServer):
+    def __init__(self, address, unregistered=(), fail_rate=0.0, out=sys.stdout):
+        """
+        \:param address: (host, port) to listen on, port 0 picks a free one.
+        \:param unregistered: Tokens answered with DeviceNotRegistered.
+        \:param fail_rate: Share of requests failed as a whole with a 503.
+        \:param out: Stream every received message is written to, None for none.
+        """
+        super().__init__(address, StubPushHandler)
+        self.unregistered = set(unregistered)
+        self.fail_rate = fail_rate
+        self.out = out
+        self.messages = []
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+
+class StubPushHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        server.requests += 1
+        if self.path.split('?')[0] != SEND_PATH:
+            self._reply(404, {'errors': [{'code': 'NOT_FOUND', 'message': 'Unknown path {}'.format(self.path)}]})
+            return
+        if random.random() < server.fail_rate:
+            self._reply(503, {'errors': [{'code': 'UNAVAILABLE', 'message': 'Injected failure'}]})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        messages = json.loads(self.rfile.read(length) or b'[]')
+        if isinstance(messages, dict):
+            messages = [messages]
+        tickets = []
+        for message in messages:
+            server.messages.append(message)
+            if server.out is not None:
+                server.out.write(json.dumps(message) + '\n')
+                server.out.flush()
+            if message.get('to') in server.unregistered:
+                tickets.append({'status': 'error',
+                                'message': '"{}" is not a registered push notification recipient'.format(message['to']),
+                                'details': {'error': 'DeviceNotRegistered'}})
+            else:
+                tickets.append({'status': 'ok', 'id': str(uuid.uuid4())})
+        self._reply(200, {'data': tickets})
+
+    def _reply(self, code, document):
+        content = json.dumps(document).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub Expo push service.')
+    parser.add_argument('--host', default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--unregistered', nargs='*', default=[], help='Tokens to report as not registered')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Share of requests to fail with a 503')
+    args = parser.parse_args()
+
+    server = StubPushServer((args.host, args.port), args.unregistered, args.fail_rate)
+    sys.stderr.write('Stub push service listening on {}\n'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
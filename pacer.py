@@ -1,16 +1,99 @@
-from time import sleep
+import asyncio
+import logging
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
 
 
 class Pacer:
-    def __init__(self):
+    """ Paces a loop on a fixed time line, driven by a monotonic clock so wall clock steps (e.g. NTP) can't affect it.
+
+    A tick overruns when it ends after the start of its next slot. What happens next depends on the policy:
+    - skip: missed slots are dropped, the next tick waits for the next slot on the time line.
+    - catch_up: ticks run back to back without sleeping until the time line is caught up, at most max_catch_up
+      slots, beyond which missed slots are skipped.
+    - shift: the next tick runs straight away and the time line is moved to start from it.
+    """
+
+    SKIP = 'skip'
+    CATCH_UP = 'catch_up'
+    SHIFT = 'shift'
+
+    def __init__(self, interval, policy=SKIP, max_catch_up=5, clock=monotonic, sleeper=sleep):
+        if policy not in (Pacer.SKIP, Pacer.CATCH_UP, Pacer.SHIFT):
+            raise ValueError('Unknown pacer overrun policy {}'.format(policy))
+        self.interval = interval
+        self.policy = policy
+        self._max_catch_up = max_catch_up
+        self._clock = clock
+        self._sleep = sleeper
         self._time_line = None
 
-    def pace(self, time_now, interval):
-        """ Paces the control loop at desired intervals. """
-        if self._time_line is not None:
-            sleep_time = self._time_line - time_now
-            if sleep_time > 0:
-                sleep(sleep_time)
-        else:
-            self._time_line = time_now
-        self._time_line += interval
+        self.ticks = 0
+        self.overruns = 0
+        self.missed_slots = 0
+        self.lateness = 0
+        self.max_lateness = 0
+
+    def start(self):
+        """ Anchors the time line on now, before the first tick. """
+        self._time_line = self._clock()
+
+    def pace(self):
+        """ Paces the loop at the desired interval, to be called at the end of each tick.
+
+        \:returns How late the tick ended past the start of its next slot, 0 when on time.
+        """
+        lateness, delay = self._advance()
+        if delay > 0:
+            self._sleep(delay)
+        return lateness
+
+    async def pace_async(self):
+        """ Same as pace, for a loop running as a coroutine. """
+        lateness, delay = self._advance()
+        await asyncio.sleep(delay)
+        return lateness
+
+    def _advance(self):
+        """ Moves the time line on by one tick.
+
+        \:returns Tuple as (lateness, delay) where delay is how long to wait until the next tick.
+        """
+        now = self._clock()
+        self.ticks += 1
+        if self._time_line is None:
+            self._time_line = now
+        self._time_line += self.interval
+
+        lateness = now - self._time_line
+        if lateness <= 0:
+            self.lateness = 0
+            return 0, -lateness
+
+        self.overruns += 1
+        self.lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        missed = int(lateness // self.interval)
+        delay = 0
+        if self.policy == Pacer.SHIFT:
+            self._time_line = now
+        elif self.policy == Pacer.SKIP or missed >= self._max_catch_up:
+            # Resume on the next slot still ahead of us.
+            self.missed_slots += missed + 1
+            self._time_line += (missed + 1) * self.interval
+            delay = self._time_line - now
+        logger.debug('Tick overran by {:.3f}s, {} slots missed'.format(lateness, missed))
+        return lateness, delay
+
+    @property
+    def stats(self):
+        """ Tick, overrun and lateness counts. """
+        return {
+            'policy': self.policy,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'missed_slots': self.missed_slots,
+            'lateness': self.lateness,
+            'max_lateness': self.max_lateness,
+        }
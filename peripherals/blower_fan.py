@@ -1,36 +1,65 @@
+import asyncio
 import logging
 import threading
-from time import time, sleep
+from array import array
+from time import time, sleep, perf_counter, monotonic
 
-import RPi.GPIO as GPIO
+from peripherals.fan_monitor import FanMonitor
 
 logger = logging.getLogger(__name__)
 
+# The fan sensor wire pulses twice per rotation.
+PULSES_PER_ROTATION = 2
+
 
 class BlowerFan:
     """ Controls the Blower fan by using PWM. """
 
-    def __init__(self, config):
+    def __init__(self, config, gpio=None, pulse_counter=None, clock=monotonic):
+        """
+        \:param config: The 'fan' config section.
+        \:param gpio: GPIO backend, the RPi.GPIO module unless given e.g. a simulated one.
+        \:param pulse_counter: RPM counter, one counting pulses on the rpm gpio unless given.
+        \:param clock: Monotonic clock of the fault monitor.
+        """
+        if gpio is None:
+            import RPi.GPIO as gpio
         self._config = config
+        self._gpio = gpio
         self._pwm_freq = 70000 / 256  # Hz
         self._pwm = None
         self._duty_cycle = 0
         self.is_on = False
-        self._pulse_counter = RpmPulseCounter(self._config['rpm_gpio'])
+        if pulse_counter is None:
+            rpm_config = config.get('rpm', {})
+            if rpm_config.get('mode', 'count') == 'period':
+                pulse_counter = PeriodRpmCounter(self._config['rpm_gpio'], rpm_config, gpio)
+            else:
+                pulse_counter = RpmPulseCounter(self._config['rpm_gpio'], gpio)
+        self._pulse_counter = pulse_counter
+
+        # Fault detection against a learned duty cycle to RPM profile.
+        monitor_config = config.get('monitor', {})
+        self.monitor = FanMonitor(monitor_config, self, clock) if monitor_config.get('enabled', False) else None
 
     def initisalise(self):
         logger.info('Initialising Blower Fan on gpio {}'.format(self._config['pwm_gpio']))
 
         # PWM pin
-        GPIO.setup(self._config['pwm_gpio'], GPIO.OUT)
-        self._pwm = GPIO.PWM(self._config['pwm_gpio'], self._pwm_freq)
+        self._gpio.setup(self._config['pwm_gpio'], self._gpio.OUT)
+        self._pwm = self._gpio.PWM(self._config['pwm_gpio'], self._pwm_freq)
 
         # ON/OFF Relay
-        GPIO.setup(self._config['relay_gpio'], GPIO.OUT)
+        self._gpio.setup(self._config['relay_gpio'], self._gpio.OUT)
 
         # RPM handler
         self._pulse_counter.initialise()
 
+        # The monitor needs RPM while the fan is off too, to catch a stuck relay.
+        if self.monitor is not None:
+            self._pulse_counter.start()
+            self.monitor.start()
+
         logger.info('Blower Fan initialised.')
 
     def on(self):
@@ -41,7 +70,7 @@ class BlowerFan:
             # Start PWM
             self._pwm.start(self.duty_cycle)
             # Switch fan on
-            GPIO.output(self._config['relay_gpio'], 1)
+            self._gpio.output(self._config['relay_gpio'], 1)
             self.is_on = True
             logger.info('Blower Fan switched on.')
 
@@ -49,12 +78,13 @@ class BlowerFan:
         """ Switches the fan off, stops PWM and stops monitoring RPM. """
         if self.is_on:
             # Switch fan off
-            GPIO.output(self._config['relay_gpio'], 0)
+            self._gpio.output(self._config['relay_gpio'], 0)
             # Switch PWM off
             self.duty_cycle = 0
             self._pwm.stop()
-            # Switch pulse counter off
-            self._pulse_counter.stop()
+            # Switch pulse counter off, unless the monitor watches for the fan turning while off
+            if self.monitor is None:
+                self._pulse_counter.stop()
             self.is_on = False
             logger.info('Blower Fan switched off.')
 
@@ -63,6 +93,11 @@ class BlowerFan:
         """ Read RPM from Sensor wire. """
         return self._pulse_counter.rpm
 
+    @property
+    def pulse_counter(self):
+        """ RPM pulse counter of this fan. """
+        return self._pulse_counter
+
     @property
     def duty_cycle(self):
         """ Current duty cycle at which the Fan is running. """
@@ -79,6 +114,8 @@ class BlowerFan:
     @property
     def is_healthy(self):
         """ Checks that fan is spinning when we expect it to. """
+        if self.monitor is not None:
+            return self.monitor.healthy
         if self.is_on and self.duty_cycle > 0 and self.rpm == 0:
             return False
         else:
@@ -88,13 +125,19 @@ class BlowerFan:
 class RpmPulseCounter:
     """ Simple wrapper that counts pulses from the Fan's yellow wire to deduce RPM. """
 
-    def __init__(self, pin_rpm):
+    def __init__(self, pin_rpm, gpio=None):
         """ Creates this instance by binding it to a pin.
 
         \:param self._config['rpm_gpio']: Input pin to which the fan Sensor wire is connected.
+        \:param gpio: GPIO backend, the RPi.GPIO module unless given.
         """
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self._gpio = gpio
         self._pin_rpm = pin_rpm
         self.is_on = False
+        # When False, RPM updates are driven by run_async() on an event loop instead of a thread.
+        self.run_in_thread = True
         self._rpm_update_thread = None
         self._reset_rpm()
 
@@ -104,26 +147,33 @@ class RpmPulseCounter:
         self.stop()
 
         # Set up our pins as input, with event call back
-        GPIO.setup(self._pin_rpm, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(self._pin_rpm, GPIO.FALLING, self._sensed_rotation)
+        self._gpio.setup(self._pin_rpm, self._gpio.IN, pull_up_down=self._gpio.PUD_UP)
+        self._gpio.add_event_detect(self._pin_rpm, self._gpio.FALLING, self._sensed_rotation)
 
         logger.info('Initialised RPM pulse counter on gpio {}'.format(self._pin_rpm))
 
     def start(self):
         """ Start counting pulses in a background thread. """
         if not self.is_on:
-            # A timer will continuously update rpm based on pulses received.
-            self._rpm_update_thread = threading.Timer(0, self._update_rpm_loop)
-            self._rpm_update_thread.name = 'RPM Pulse counter'
-            self._rpm_update_thread.daemon = True
-            self.is_on = True
-            self._rpm_update_thread.start()
+            if self.run_in_thread:
+                # A timer will continuously update rpm based on pulses received.
+                self._rpm_update_thread = threading.Timer(0, self._update_rpm_loop)
+                self._rpm_update_thread.name = 'RPM Pulse counter'
+                self._rpm_update_thread.daemon = True
+                self.is_on = True
+                self._rpm_update_thread.start()
+            else:
+                self._reset_rpm()
+                self.is_on = True
             logger.info('Started RPM pulse counter on gpio {}'.format(self._pin_rpm))
 
     def stop(self):
         """ Start counting pulses in a background thread. """
         if self.is_on:
-            self._rpm_update_thread.cancel()
+            if self.run_in_thread:
+                self._rpm_update_thread.cancel()
+            else:
+                self._rpm = 0
             self.is_on = False
             logger.info('Stopped RPM pulse counter on gpio {}'.format(self._pin_rpm))
 
@@ -150,12 +200,125 @@ class RpmPulseCounter:
         """ Continuously runs at regular intervals to update the effective RPM value."""
         self._reset_rpm()
         while self.is_on:
-            now = time()
-            count = self._pulse_count
-            self._rpm = (count - self._last_pulse_count) / (now - self._last_rpm_calc)
-            self._rpm = int(60 * self._rpm / 2)  # 2 pulses per rotation
-
-            self._last_rpm_calc = now
-            self._last_pulse_count = count
+            self._update_rpm()
             sleep(1)  # 1 second resolution, plenty good.
         self._rpm = 0
+
+    async def run_async(self):
+        """ Updates the RPM value as a coroutine whenever the counter is on, until cancelled. """
+        while True:
+            if self.is_on:
+                self._update_rpm()
+            await asyncio.sleep(1)
+
+    def _update_rpm(self):
+        now = time()
+        count = self._pulse_count
+        self._rpm = (count - self._last_pulse_count) / (now - self._last_rpm_calc)
+        self._rpm = int(60 * self._rpm / PULSES_PER_ROTATION)
+
+        self._last_rpm_calc = now
+        self._last_pulse_count = count
+
+
+class PeriodRpmCounter:
+    """ Measures RPM from the period between pulses of the Fan's yellow wire, rather than counting them.
+
+    Edges only store a timestamp in a preallocated ring buffer, and RPM is computed on read from the most recent
+    periods, so it follows the fan within a few rotations and needs no thread. Glitches are rejected statistically:
+    periods far off the median of the window are ignored.
+    """
+
+    def __init__(self, pin_rpm, config=None, gpio=None):
+        """
+        \:param pin_rpm: Input pin to which the fan Sensor wire is connected.
+        \:param config: The 'fan.rpm' config section.
+        \:param gpio: GPIO backend, the RPi.GPIO module unless given.
+        """
+        if gpio is None:
+            import RPi.GPIO as gpio
+        config = config if config is not None else {}
+        self._gpio = gpio
+        self._pin_rpm = pin_rpm
+        self.is_on = False
+        # Kept for compatibility with RpmPulseCounter, there is never a thread.
+        self.run_in_thread = True
+
+        # Periods averaged per reading, and how far off the median a period may be before it counts as a glitch.
+        self._window = max(1, config.get('window', 16))
+        self._tolerance = config.get('glitch_tolerance', 0.5)
+        # No edge for this long means the fan stopped.
+        self._timeout = config.get('timeout_seconds', 1.0)
+
+        # Ring buffer of edge timestamps, sized to a power of 2 with room for edges arriving while reading.
+        size = 1
+        while size < 2 * (self._window + 1):
+            size *= 2
+        self._mask = size - 1
+        self._edges = array('d', [0.0] * size)
+        self._count = 0
+
+    def initialise(self):
+        logger.info('Initialising Blower Fan RPM Sensor on gpio {}'.format(self._pin_rpm))
+        self.stop()
+        self._gpio.setup(self._pin_rpm, self._gpio.IN, pull_up_down=self._gpio.PUD_UP)
+        self._gpio.add_event_detect(self._pin_rpm, self._gpio.FALLING, self._sensed_rotation)
+        logger.info('Initialised period RPM counter on gpio {}, window of {} periods'.format(
+            self._pin_rpm, self._window))
+
+    def start(self):
+        if not self.is_on:
+            self._count = 0
+            self.is_on = True
+            logger.info('Started RPM period counter on gpio {}'.format(self._pin_rpm))
+
+    def stop(self):
+        if self.is_on:
+            self.is_on = False
+            logger.info('Stopped RPM period counter on gpio {}'.format(self._pin_rpm))
+
+    def _sensed_rotation(self, pin):
+        """ Called back with pin for which the event occured, kept as short as possible. """
+        count = self._count
+        self._edges[count & self._mask] = perf_counter()
+        self._count = count + 1
+
+    @property
+    def rpm(self):
+        """ RPM from the recent periods between pulses, 0 when stopped. """
+        count = self._count
+        if not self.is_on or count < 2:
+            return 0
+        edges = self._edges
+        mask = self._mask
+        last = edges[(count - 1) & mask]
+        since = perf_counter() - last
+        if since > self._timeout:
+            return 0
+
+        n = min(count - 1, self._window)
+        periods = [last - edges[(count - 2) & mask]]
+        for i in range(count - 2, count - 1 - n, -1):
+            periods.append(edges[i & mask] - edges[(i - 1) & mask])
+
+        # Mean of the periods close enough to the median, glitches and missed pulses land far off it.
+        median = sorted(periods)[len(periods) // 2]
+        low = median * (1 - self._tolerance)
+        high = median * (1 + self._tolerance)
+        total = 0.0
+        kept = 0
+        for period in periods:
+            if low <= period <= high:
+                total += period
+                kept += 1
+        period = total / kept if kept else median
+
+        # Slowing down, the time since the last pulse already bounds the speed.
+        period = max(period, since)
+        if period <= 0:
+            return 0
+        return int(60 / (period * PULSES_PER_ROTATION))
+
+    async def run_async(self):
+        """ Nothing to update in the background, RPM is computed on read. """
+        return
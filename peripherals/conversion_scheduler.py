@@ -0,0 +1,119 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _SensorSchedule:
+    """ Read timing and failure state of one sensor on the bus. """
+    __slots__ = ('latency', 'failures', 'ready', 'skip_cycles', 'skipped', 'reads')
+
+    def __init__(self):
+        self.latency = None
+        self.failures = 0
+        # Whether it was read fine since the wait was last backed off
+        self.ready = False
+        self.skip_cycles = 0
+        self.skipped = 0
+        self.reads = 0
+
+
+class ConversionScheduler:
+    """ Adapts 1-wire conversion timing to what the bus actually achieves.
+
+    The wait after starting a conversion is shortened a little every cycle in which all healthy sensors could be
+    read, and backed off as soon as one could not, so it settles on the shortest wait which still works. Only sensors
+    which were read fine at a shorter wait, or most of the bus at once, count as not ready, so an empty socket does not
+    hold the wait up. Sensors which keep failing, e.g. an unplugged probe, are read less and less often with
+    exponential backoff.
+    """
+
+    def __init__(self, sampling_seconds, config):
+        """
+        \:param sampling_seconds: Initial and maximum conversion wait.
+        \:param config: The 'scheduler' section of the temperature config, may be empty.
+        """
+        self.conversion_seconds = sampling_seconds
+        self._enabled = config.get('adaptive', True)
+        self._min_wait = config.get('min_conversion_seconds', 0.1)
+        self._margin = config.get('safety_margin', 1.1)
+        self._max_wait = config.get('max_conversion_seconds', sampling_seconds)
+        self._shrink = config.get('shrink_factor', 0.9)
+        self._grow = config.get('grow_factor', 1.5)
+        self._failure_threshold = config.get('failure_threshold', 3)
+        self._max_skip_cycles = config.get('max_skip_cycles', 32)
+        self._sensors = dict()
+        self._not_ready = False
+        self._due = 0
+        self._not_ready_count = 0
+        self.cycles = 0
+        self.cycle_seconds = None
+
+    def due(self, sensor):
+        """ Whether a sensor should be read this cycle, or skipped because it is backing off. """
+        schedule = self._sensors.get(sensor)
+        if schedule is None:
+            schedule = self._sensors[sensor] = _SensorSchedule()
+        if schedule.skip_cycles > 0:
+            schedule.skip_cycles -= 1
+            schedule.skipped += 1
+            return False
+        self._due += 1
+        return True
+
+    def record(self, sensor, latency, ok, not_ready):
+        """ Records the outcome of reading a sensor.
+
+        \:param ok: Whether a valid temperature was read.
+        \:param not_ready: Whether the sensor did not answer at all, possibly because the conversion was not done.
+        """
+        schedule = self._sensors[sensor]
+        schedule.reads += 1
+        schedule.latency = latency if schedule.latency is None else 0.8 * schedule.latency + 0.2 * latency
+        if ok:
+            schedule.failures = 0
+            schedule.ready = True
+            return
+
+        # Only sensors which were fine until now tell us anything about the conversion wait, one which never answered
+        # is more likely missing.
+        if not_ready:
+            self._not_ready_count += 1
+            if schedule.ready and schedule.failures == 0:
+                self._not_ready = True
+        schedule.failures += 1
+        if schedule.failures >= self._failure_threshold:
+            schedule.skip_cycles = min(2 ** (schedule.failures - self._failure_threshold), self._max_skip_cycles)
+            logger.debug('Sensor {} failed {} times, skipping {} cycles'.format(
+                sensor, schedule.failures, schedule.skip_cycles))
+
+    def end_cycle(self, cycle_seconds):
+        """ Adapts the conversion wait once all due sensors have been read. """
+        self.cycles += 1
+        self.cycle_seconds = cycle_seconds
+        if self._enabled:
+            if self._not_ready or self._not_ready_count * 2 > self._due:
+                # Never shrink back down to a wait which proved too short.
+                self._min_wait = min(max(self._min_wait, self.conversion_seconds * self._margin), self._max_wait)
+                wait = min(self.conversion_seconds * self._grow, self._max_wait)
+                logger.debug('Conversion not ready, backing off wait to {:.3f}s'.format(wait))
+                # Sensors have to be read fine at the new wait before their failures count again
+                for schedule in self._sensors.values():
+                    schedule.ready = False
+            else:
+                wait = max(self.conversion_seconds * self._shrink, self._min_wait)
+            self.conversion_seconds = wait
+        self._not_ready = False
+        self._due = 0
+        self._not_ready_count = 0
+
+    @property
+    def stats(self):
+        """ Timing of the last cycle and per sensor read state. """
+        return {
+            'cycles': self.cycles,
+            'conversion_seconds': self.conversion_seconds,
+            'cycle_seconds': self.cycle_seconds,
+            'sample_rate': 1 / self.cycle_seconds if self.cycle_seconds else None,
+            'sensors': {sensor: {'latency': s.latency, 'failures': s.failures, 'reads': s.reads, 'skipped': s.skipped}
+                        for sensor, s in list(self._sensors.items())},
+        }
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from time import monotonic, time
+
+logger = logging.getLogger(__name__)
+
+
+class FanProfile:
+    """ Duty cycle to expected RPM lookup table, learned while the fan runs normally and kept on disk.
+
+    Duty cycles are binned, each bin holding a moving average of the RPM seen at steady state. Bins which were never
+    learned are interpolated from their learned neighbours.
+    """
+
+    def __init__(self, path, bin_width=5, alpha=0.05, min_samples=5):
+        """
+        \:param path: JSON file the profile is loaded from and saved to, None to keep it in memory only.
+        \:param bin_width: Width of a duty cycle bin, in percent.
+        \:param alpha: Weight of a new sample in the moving average of a bin.
+        \:param min_samples: Samples a bin needs before it is trusted.
+        """
+        self._path = path
+        self._bin_width = bin_width
+        self._alpha = alpha
+        self._min_samples = min_samples
+        bins = int(100 / bin_width) + 1
+        self._rpm = [0.0] * bins
+        self._count = [0] * bins
+        self.dirty = False
+        self._load()
+
+    def _bin(self, duty_cycle):
+        return max(0, min(len(self._rpm) - 1, int(round(duty_cycle / self._bin_width))))
+
+    def learn(self, duty_cycle, rpm):
+        """ Records the RPM seen at a steady duty cycle. """
+        i = self._bin(duty_cycle)
+        if self._count[i] == 0:
+            self._rpm[i] = float(rpm)
+        else:
+            # Average quickly until trusted, then follow slow drift only.
+            alpha = max(self._alpha, 1 / (self._count[i] + 1))
+            self._rpm[i] += alpha * (rpm - self._rpm[i])
+        self._count[i] += 1
+        self.dirty = True
+
+    def expected(self, duty_cycle):
+        """ \:returns RPM expected at a duty cycle, or None when nothing was learned around it yet. """
+        i = self._bin(duty_cycle)
+        if self._count[i] >= self._min_samples:
+            return self._rpm[i]
+        below = next((j for j in range(i - 1, -1, -1) if self._count[j] >= self._min_samples), None)
+        above = next((j for j in range(i + 1, len(self._rpm)) if self._count[j] >= self._min_samples), None)
+        if below is None or above is None:
+            return None
+        ratio = (i - below) / (above - below)
+        return self._rpm[below] + ratio * (self._rpm[above] - self._rpm[below])
+
+    def as_dict(self):
+        return {'bin_width': self._bin_width, 'rpm': [round(v, 1) for v in self._rpm], 'count': self._count}
+
+    def _load(self):
+        if self._path is None or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+            if data.get('bin_width') == self._bin_width and len(data['rpm']) == len(self._rpm):
+                self._rpm = [float(v) for v in data['rpm']]
+                self._count = [int(v) for v in data['count']]
+                logger.info('Loaded fan profile from {}'.format(self._path))
+            else:
+                logger.warning('Ignoring fan profile {}, its bins do not match'.format(self._path))
+        except (OSError, ValueError, KeyError) as ex:
+            logger.warning('Failed to load fan profile {}: {}'.format(self._path, ex))
+
+    def save(self):
+        """ Writes the profile if it changed, atomically so a power cut never leaves half a file. """
+        if self._path is None or not self.dirty:
+            return
+        tmp = self._path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.as_dict(), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._path)
+            self.dirty = False
+        except OSError as ex:
+            logger.warning('Failed to save fan profile {}: {}'.format(self._path, ex))
+
+
+class FanMonitor:
+    """ Watches the fan several times per second and flags faults against its learned profile.
+
+    - stall: commanded on with a duty cycle, but barely turning.
+    - degraded: turning well below the RPM learned for the duty cycle.
+    - stuck_on: commanded off, but still turning long after spinning down, e.g. a relay welded shut.
+
+    A fault is raised once it persisted for confirm_seconds, and cleared the same way. Checks are held off for
+    settle_seconds after the fan is switched or its duty cycle moves by settle_duty_cycle or more, while it spins up
+    or down. Smaller moves, as the PID makes every tick, do not hold checks off.
+    """
+
+    OK = 'ok'
+    STALL = 'stall'
+    DEGRADED = 'degraded'
+    STUCK_ON = 'stuck_on'
+
+    def __init__(self, config, fan, clock=monotonic):
+        """
+        \:param config: The 'fan.monitor' config section.
+        \:param fan: BlowerFan to watch.
+        \:param clock: Monotonic clock, in seconds.
+        """
+        self._fan = fan
+        self.clock = clock
+        self.run_in_thread = True
+        self.on_fault = None
+        self._interval = config.get('interval_seconds', 0.1)
+        self._confirm = config.get('confirm_seconds', 0.3)
+        self._settle = config.get('settle_seconds', 3)
+        self._settle_duty_cycle = config.get('settle_duty_cycle', 10)
+        # Only learn once the duty cycle held within this much for settle_seconds, so spin up or down is never learned.
+        self._learn_duty_cycle = config.get('learn_duty_cycle', 1)
+        self._stall_rpm = config.get('stall_rpm', 100)
+        self._degraded_ratio = config.get('degraded_ratio', 0.6)
+        self._save_seconds = config.get('save_seconds', 300)
+        self.profile = FanProfile(config.get('profile_path'), config.get('bin_width', 5),
+                                  config.get('learn_alpha', 0.05), config.get('min_samples', 5))
+
+        self.fault = FanMonitor.OK
+        self._candidate = FanMonitor.OK
+        self._candidate_since = None
+        self._commanded_on = None
+        self._commanded_duty_cycle = 0
+        self._commanded_since = None
+        self._steady_duty_cycle = 0
+        self._steady_since = None
+        self._last_save = None
+        self._thread = None
+        self._running = False
+        self._wakeup = threading.Condition()
+        self.rpm = 0
+        self.expected_rpm = None
+
+    @property
+    def healthy(self):
+        return self.fault == FanMonitor.OK
+
+    def start(self):
+        """ Starts checking in a background thread, unless driven by run_async() or by calling check(). """
+        if self.run_in_thread and self._thread is None:
+            self._running = True
+            self._thread = threading.Timer(0, self._check_loop)
+            self._thread.name = 'Fan monitor'
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Stops the check thread and waits for it, so the profile is saved once nothing touches the fan anymore. """
+        if self._thread is not None:
+            with self._wakeup:
+                self._running = False
+                self._wakeup.notify()
+            self._thread.join()
+            self._thread = None
+        self.profile.save()
+
+    def _check_loop(self):
+        while True:
+            self.check()
+            with self._wakeup:
+                if self._running:
+                    self._wakeup.wait(self._interval)
+                if not self._running:
+                    return
+
+    async def run_async(self):
+        """ Same as the check loop, as a coroutine. """
+        while True:
+            self.check()
+            await asyncio.sleep(self._interval)
+
+    def check(self):
+        """ Compares the fan speed with what is expected of it, learning when healthy and steady. """
+        now = self.clock()
+        fan = self._fan
+        is_on = fan.is_on
+        duty_cycle = fan.duty_cycle
+        if is_on != self._commanded_on or abs(duty_cycle - self._commanded_duty_cycle) >= self._settle_duty_cycle:
+            self._commanded_on = is_on
+            self._commanded_duty_cycle = duty_cycle
+            self._commanded_since = now
+        if self._steady_since is None or abs(duty_cycle - self._steady_duty_cycle) > self._learn_duty_cycle:
+            self._steady_duty_cycle = duty_cycle
+            self._steady_since = now
+        rpm = fan.rpm
+        self.rpm = rpm
+        settled = now - self._commanded_since >= self._settle
+        steady = now - self._steady_since >= self._settle
+        expected = self.profile.expected(duty_cycle) if is_on and duty_cycle > 0 else None
+        self.expected_rpm = expected
+
+        fault = FanMonitor.OK
+        if settled:
+            if is_on and duty_cycle > 0:
+                if rpm < self._stall_rpm:
+                    fault = FanMonitor.STALL
+                elif expected is not None and rpm < expected * self._degraded_ratio:
+                    fault = FanMonitor.DEGRADED
+                elif steady and self.fault == FanMonitor.OK:
+                    self.profile.learn(duty_cycle, rpm)
+            elif not is_on and rpm >= self._stall_rpm:
+                fault = FanMonitor.STUCK_ON
+        else:
+            # Keep whatever was flagged while the fan settles.
+            fault = self.fault
+
+        self._confirm_fault(fault, now, rpm, expected, duty_cycle)
+
+        if self._last_save is None:
+            self._last_save = now
+        elif now - self._last_save >= self._save_seconds:
+            self._last_save = now
+            self.profile.save()
+
+    def _confirm_fault(self, fault, now, rpm, expected, duty_cycle):
+        if fault != self._candidate:
+            self._candidate = fault
+            self._candidate_since = now
+        if fault != self.fault and now - self._candidate_since >= self._confirm:
+            previous = self.fault
+            self.fault = fault
+            event = {
+                'fault': fault,
+                'previous': previous,
+                'timestamp': time(),
+                'dutyCycle': duty_cycle,
+                'rpm': rpm,
+                'expectedRpm': round(expected) if expected is not None else None,
+            }
+            if fault == FanMonitor.OK:
+                logger.info('Fan fault {} cleared'.format(previous))
+            else:
+                logger.warning('Fan fault {}: rpm={} expected={} duty={}'.format(fault, rpm, expected, duty_cycle))
+            if self.on_fault is not None:
+                try:
+                    self.on_fault(event)
+                except Exception as ex:
+                    logger.error('Fan fault handler failed: {}'.format(ex))
+
+    @property
+    def stats(self):
+        return {'fault': self.fault, 'rpm': self.rpm, 'expected_rpm': self.expected_rpm,
+                'profile': self.profile.as_dict()}
@@ -0,0 +1,102 @@
+from array import array
+from bisect import bisect_left, insort
+
+
+class SampleHistory:
+    """ Fixed-size ring buffer of recent samples for one sensor, with incrementally maintained filters.
+
+    Mean, EMA and slope are updated in O(1) per sample from running sums, and the median from a sorted copy of the
+    window. Running sums are rebuilt from the window each time it wraps around, which keeps floating point drift in
+    check at an amortised O(1) cost.
+    """
+
+    def __init__(self, size, ema_alpha):
+        self._size = size
+        self._alpha = ema_alpha
+        self._times = array('d', [0.0]) * size
+        self._values = array('d', [0.0]) * size
+        self._sorted = []
+        self._index = 0
+        self._count = 0
+        self._added = 0
+        self._ema = None
+        self._reset_sums(0.0)
+
+    def _reset_sums(self, base_time):
+        # Times are kept relative to a base so the least squares sums keep their precision.
+        self._base_time = base_time
+        self._sum_t = 0.0
+        self._sum_v = 0.0
+        self._sum_tt = 0.0
+        self._sum_tv = 0.0
+
+    def _accumulate(self, t, value, sign):
+        t -= self._base_time
+        self._sum_t += sign * t
+        self._sum_v += sign * value
+        self._sum_tt += sign * t * t
+        self._sum_tv += sign * t * value
+
+    def add(self, timestamp, value):
+        """ Adds a sample, evicting the oldest one when the window is full. """
+        if self._added == 0:
+            self._base_time = timestamp
+        if self._count == self._size:
+            old_value = self._values[self._index]
+            self._accumulate(self._times[self._index], old_value, -1)
+            del self._sorted[bisect_left(self._sorted, old_value)]
+        else:
+            self._count += 1
+
+        self._times[self._index] = timestamp
+        self._values[self._index] = value
+        self._index = (self._index + 1) % self._size
+        insort(self._sorted, value)
+        self._ema = value if self._ema is None else self._ema + self._alpha * (value - self._ema)
+
+        self._added += 1
+        if self._added % self._size == 0:
+            self._rebuild(timestamp)
+        else:
+            self._accumulate(timestamp, value, 1)
+
+    def _rebuild(self, base_time):
+        self._reset_sums(base_time)
+        for i in range(self._count):
+            self._accumulate(self._times[i], self._values[i], 1)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def last(self):
+        """ Most recent sample, or None. """
+        return self._values[self._index - 1] if self._count > 0 else None
+
+    @property
+    def mean(self):
+        """ Rolling mean over the window, or None. """
+        return self._sum_v / self._count if self._count > 0 else None
+
+    @property
+    def ema(self):
+        """ Exponential moving average of all samples, or None. """
+        return self._ema
+
+    @property
+    def median(self):
+        """ Rolling median over the window, or None. """
+        n = self._count
+        if n == 0:
+            return None
+        mid = n // 2
+        return self._sorted[mid] if n % 2 else (self._sorted[mid - 1] + self._sorted[mid]) / 2
+
+    @property
+    def slope(self):
+        """ Least squares slope over the window in units per second, or None with fewer than 2 samples. """
+        n = self._count
+        denominator = n * self._sum_tt - self._sum_t * self._sum_t
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * self._sum_tv - self._sum_t * self._sum_v) / denominator
@@ -0,0 +1,298 @@
+""" Simulated hardware backend, so the agent can run and be tested off the Pi.
+
+A thermal model of the smoker stands in for the fire, pit, meat probes and blower fan. It is exposed through
+drop-in replacements for the RPi.GPIO and DS18B20 modules and for the RPM pulse counter, and advances lazily to
+whatever time its clock reports: real time when running the agent, or a SimClock for faster than realtime runs.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Flags reported by the Max31850 in the third value of a reading.
+FLAG_OPEN_CIRCUIT = 2
+
+# Longest integration step of the model in seconds.
+MAX_STEP_SECONDS = 1.0
+
+
+class SimClock:
+    """ Simulated time, only moving when advanced. Starts at the current wall clock time. """
+
+    def __init__(self, start=None):
+        self._now = time.time() if start is None else start
+
+    def time(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+    # Sleeping simply moves simulated time on.
+    sleep = advance
+
+
+class ThermalModel:
+    """ Lumped model of a charcoal smoker driven by its blower fan.
+
+    Fire intensity follows the airflow (natural draft plus fan duty) with a lag, the pit exchanges heat with the fire
+    and the ambient air, and opening the lid dumps heat. Meat probes lag behind the pit and stall while evaporation
+    cools the meat. The fan spins up towards an RPM proportional to its duty cycle when the relay is on.
+    """
+
+    def __init__(self, config, clock):
+        """
+        \:param config: The 'simulation' config section, may be empty.
+        \:param clock: Callable returning the current time in seconds.
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._random = random.Random(config.get('seed', 0))
+        self.ambient = config.get('ambient', 20.0)
+        self._natural_draft = config.get('natural_draft', 0.1)
+        self._fire_gain = config.get('fire_gain', 255.0)
+        self._fire_tau = config.get('fire_tau_seconds', 120.0)
+        self._pit_tau = config.get('pit_tau_seconds', 300.0)
+        self._lid_tau = config.get('lid_tau_seconds', 120.0)
+        self._probe_tau = config.get('probe_tau_seconds', 3600.0)
+        self._stall = config.get('stall', [65.0, 75.0, 0.2])
+        self._max_rpm = config.get('max_rpm', 3000.0)
+        self._fan_tau = config.get('fan_tau_seconds', 0.5)
+        self.noise = config.get('noise', 0.25)
+
+        # Lid open periods and faults as events with start and end, in seconds since the simulation started.
+        self._lid_events = config.get('lid_open', [])
+        self._faults = config.get('faults', [])
+
+        self.duty_cycle = 0.0
+        self.relay_on = False
+        self._start = clock()
+        self._last = self._start
+        self.fire = config.get('initial_pit', self.ambient) - self.ambient
+        self.pit = config.get('initial_pit', self.ambient)
+        self.probes = dict()
+        self._initial_probe = config.get('initial_probe', 4.0)
+        self.rpm = 0.0
+
+    @property
+    def elapsed(self):
+        """ Seconds since the simulation started. """
+        return self._clock() - self._start
+
+    def _active(self, events, **match):
+        t = self.elapsed
+        for event in events:
+            if event['start'] <= t < event.get('end', float('inf')) and \
+                    all(event.get(k) == v for k, v in match.items()):
+                return True
+        return False
+
+    def fault(self, kind, sensor=None):
+        """ Whether a fault of a kind, e.g. open_circuit, no_response or fan_stall, is currently active. """
+        if sensor is None:
+            return self._active(self._faults, fault=kind)
+        return self._active(self._faults, fault=kind, sensor=sensor)
+
+    def update(self):
+        """ Integrates the model up to the current clock time. """
+        with self._lock:
+            now = self._clock()
+            while self._last < now:
+                dt = min(MAX_STEP_SECONDS, now - self._last)
+                self._step(dt)
+                self._last += dt
+
+    def _step(self, dt):
+        # Fire follows airflow, the fan only helps when it actually spins.
+        fan = self.rpm / self._max_rpm if self._max_rpm > 0 else 0
+        target_fire = self._fire_gain * (self._natural_draft + fan)
+        self.fire += (target_fire - self.fire) * dt / self._fire_tau
+
+        # Pit heats towards ambient plus fire, and dumps heat to the air on top of that with the lid open.
+        rate = (self.ambient + self.fire - self.pit) / self._pit_tau
+        if self._active(self._lid_events):
+            rate -= (self.pit - self.ambient) / self._lid_tau
+        self.pit += rate * dt
+
+        # Meat lags the pit, and stalls while evaporation cools it.
+        low, high, factor = self._stall
+        for name, temp in self.probes.items():
+            rate = (self.pit - temp) / self._probe_tau
+            if low <= temp <= high:
+                rate *= factor
+            self.probes[name] = temp + rate * dt
+
+        # Fan spins up or down towards the speed set by its duty cycle.
+        target_rpm = 0.0
+        if self.relay_on and not self.fault('fan_stall'):
+            target_rpm = self._max_rpm * self.duty_cycle / 100
+        self.rpm += (target_rpm - self.rpm) * min(1.0, dt / self._fan_tau)
+
+    def temperature(self, name):
+        """ True temperature of the pit or of a named probe. """
+        if name == 'pit':
+            return self.pit
+        if name not in self.probes:
+            self.probes[name] = self._initial_probe
+        return self.probes[name]
+
+    def measure(self, name):
+        """ Temperature as a sensor would measure it, with noise. """
+        return self.temperature(name) + self._random.gauss(0, self.noise)
+
+
+class SimulatedPWM:
+    """ PWM channel as handed out by SimulatedGPIO, setting the fan duty cycle of the thermal model. """
+
+    def __init__(self, model):
+        self._model = model
+
+    def start(self, duty_cycle):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self._model.update()
+        self._model.duty_cycle = duty_cycle
+
+
+class SimulatedGPIO:
+    """ Stand-in for the RPi.GPIO module, steering the fan of the thermal model. """
+    BCM = 11
+    OUT = 0
+    IN = 1
+    PUD_UP = 22
+    FALLING = 32
+
+    def __init__(self, model, fan_config):
+        self._model = model
+        self._relay_gpio = fan_config['relay_gpio']
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        pass
+
+    def output(self, pin, value):
+        if pin == self._relay_gpio:
+            self._model.update()
+            self._model.relay_on = bool(value)
+
+    def add_event_detect(self, pin, edge, callback=None):
+        # RPM comes from SimulatedRpmCounter rather than from edges.
+        pass
+
+    def remove_event_detect(self, pin):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def PWM(self, pin, frequency):
+        return SimulatedPWM(self._model)
+
+
+class SimulatedDS:
+    """ Stand-in for the DS18B20 module, reading Max31850 boards attached to the thermal model. """
+
+    def __init__(self, model, temperature_config):
+        self._model = model
+        # Sensor id to (name, offset), the first name configured for an id wins.
+        self._sensors = dict()
+        for name, conf in temperature_config.items():
+            if isinstance(conf, dict) and 'id' in conf and conf['id'] not in self._sensors:
+                self._sensors[conf['id']] = (name, conf['temperature_offset'])
+
+    def scan(self, pin):
+        return list(self._sensors)
+
+    def pinsStartConversion(self, pins):
+        self._model.update()
+
+    def readMax31850(self, crc, pin, sensor):
+        """ \:returns Tuple as (thermocouple temp, board temp, flags), or None when the sensor does not respond. """
+        if sensor not in self._sensors:
+            return None
+        name, offset = self._sensors[sensor]
+        if self._model.fault('no_response', name):
+            return None
+        board = self._model.ambient + 15
+        if self._model.fault('open_circuit', name):
+            return 0.0, board, FLAG_OPEN_CIRCUIT
+        # Raw value, so the configured offset brings it back to the true temperature.
+        return self._model.measure(name) - offset, board, 0
+
+
+class SimulatedRpmCounter:
+    """ Stand-in for RpmPulseCounter, reporting the RPM of the simulated fan without any pulses or threads. """
+
+    def __init__(self, model):
+        self._model = model
+        self.is_on = False
+        self.run_in_thread = True
+
+    def initialise(self):
+        pass
+
+    def start(self):
+        self.is_on = True
+
+    def stop(self):
+        self.is_on = False
+
+    @property
+    def rpm(self):
+        if not self.is_on:
+            return 0
+        self._model.update()
+        return int(self._model.rpm)
+
+    async def run_async(self):
+        # Nothing to update in the background, RPM is computed on read.
+        while True:
+            await asyncio.sleep(3600)
+
+
+class SimulatedMqttClient:
+    """ Stand-in for a connected paho client, keeping the last payload and a count of messages per topic. """
+
+    def __init__(self):
+        self.callbacks = dict()
+        self.last = dict()
+        self.counts = dict()
+        self.published = 0
+        self.published_bytes = 0
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.last[topic] = payload
+        self.counts[topic] = self.counts.get(topic, 0) + 1
+        self.published += 1
+        self.published_bytes += len(payload) if payload is not None else 0
+
+
+class Simulation:
+    """ Wires a thermal model into simulated GPIO, 1-wire and RPM backends. """
+
+    def __init__(self, config, clock=None):
+        """
+        \:param config: Full agent config, using its 'simulation', 'fan' and 'temperature' sections.
+        \:param clock: SimClock for simulated time, or None to follow real time.
+        """
+        self.clock = clock
+        self.model = ThermalModel(config.get('simulation', {}), clock.time if clock is not None else time.time)
+        self.gpio = SimulatedGPIO(self.model, config['fan'])
+        self.ds = SimulatedDS(self.model, config['temperature'])
+        self.pulse_counter = SimulatedRpmCounter(self.model)
+        logger.info('Using simulated hardware backend.')
@@ -1,15 +1,46 @@
+import asyncio
 import logging
 import sys
 import threading
-from time import time, sleep
+from collections import namedtuple
+from time import time, sleep, perf_counter
 from enum import Enum, IntEnum
-from copy import deepcopy
 
-import DS18B20 as DS
+from peripherals.conversion_scheduler import ConversionScheduler
+from peripherals.sample_history import SampleHistory
 
 logger = logging.getLogger(__name__)
 
 
+def named_sensors(config):
+    """ \:returns Named sensors of the 'temperature' config section as (name, id, offset), in config order. """
+    return [(name, conf['id'], conf['temperature_offset'])
+            for name, conf in config.items() if isinstance(conf, dict) and 'id' in conf]
+
+
+class SensorReading(namedtuple('SensorReading', ['temp', 'status', 'seq', 'timestamp'])):
+    """ Immutable reading of a sensor, seq and timestamp identify the conversion cycle it was sampled in. """
+    __slots__ = ()
+
+    def as_dict(self):
+        """ \:returns Reading as published and logged, i.e. {'temp', 'status'}. """
+        return {'temp': self.temp, 'status': self.status}
+
+
+class SensorFilters(namedtuple('SensorFilters', ['mean', 'ema', 'median', 'slope'])):
+    """ Filtered values over the recent history of a sensor, slope is in degrees per second. """
+    __slots__ = ()
+
+
+class SensorSnapshot(namedtuple('SensorSnapshot', ['seq', 'timestamp', 'readings', 'board_temp', 'filters'])):
+    """ Immutable result of a conversion cycle, with readings and filters by sensor name and offsets already applied.
+
+    A new snapshot is swapped in as a whole once per cycle, so readers always see a consistent set of values without
+    copying or locking. Readings which could not be refreshed keep the seq of the cycle they were last sampled in.
+    """
+    __slots__ = ()
+
+
 class Max31850Sensors:
     """ Wrapper around DS18B20 to provide an adapter for the Max31850 boards.
 
@@ -23,73 +54,116 @@ class Max31850Sensors:
         SHORT_TO_GROUND = 2,
         SHORT_TO_VDD = 4
 
-    def __init__(self, config):
+    def __init__(self, config, ds=None, clock=time):
         """ We need to bind this instance to a specific 1-wire gpio, as given to this class.
 
         :param gpio_pin: GPIO pin to which the Max31850 data ports are attached.
+        \:param ds: 1-wire backend, the DS18B20 module unless given e.g. a simulated one.
+        \:param clock: Callable returning the wall clock time used to timestamp readings.
         """
+        if ds is None:
+            import DS18B20 as ds
+        self._ds = ds
+        self._clock = clock
         self._config = config
         self.is_on = False
+        # When False, reading is driven by run_async() on an event loop instead of a thread.
+        self.run_in_thread = True
         self._sensors = None
-        self._board_temp = None
-        self._temps = dict()
         self._update_thread = None
+        self._scheduler = ConversionScheduler(config['sampling_seconds'], config.get('scheduler', {}))
+        self._cycle_start = None
+        self._cycle_timestamp = None
+
+        # Named sensors as (name, id, offset), e.g. pit, probe1 and probe2, any number of them.
+        self._names = named_sensors(config)
+        # 1-wire buses by gpio, a sensor is on the default bus unless it names its own gpio.
+        self._buses = sorted({config['gpio']} | {conf['gpio'] for name, conf in config.items()
+                                                 if isinstance(conf, dict) and 'id' in conf and 'gpio' in conf})
+        self._unknown = SensorReading(None, Max31850Sensors.Status.UNKNOWN, 0, None)
+        self._snapshot = SensorSnapshot(0, None, dict(), None, dict())
+
+        # Recent valid samples per named sensor, feeding rolling filters.
+        filter_conf = config.get('filter', {})
+        self._filter = filter_conf.get('type', 'raw')
+        self._histories = {name: SampleHistory(filter_conf.get('window', 10), filter_conf.get('ema_alpha', 0.3))
+                           for name, _, _ in self._names}
 
     def initialise(self):
         self.off()
 
-        self._sensors = DS.scan(self._config['gpio'])
+        # Sensors found as (gpio, id), an id seen on several buses is read from the first.
+        self._sensors = []
+        found = set()
+        for gpio in self._buses:
+            for sensor in self._ds.scan(gpio):
+                if sensor not in found:
+                    found.add(sensor)
+                    self._sensors.append((gpio, sensor))
         if len(self._sensors) == 0:
             msg = 'No temperature sensors found, cowardly exiting.'
             logger.error(msg)
             sys.exit(msg)
 
-        logger.info('Found temperature sensors with ids {}'.format(self._sensors))
+        logger.info('Found temperature sensors with ids {}'.format([sensor for _, sensor in self._sensors]))
 
         # Preload reading with initial state.
-        for sensor in self._sensors:
-            self._temps[sensor] = {'temp': None, 'status': Max31850Sensors.Status.UNKNOWN}
+        self._snapshot = SensorSnapshot(0, None, {name: self._unknown for name, _, _ in self._names}, None, dict())
 
         self._update_thread = threading.Timer(0, self._update_loop)
+        self._update_thread.name = 'Temperature sensors'
         self._update_thread.daemon = True
-        logger.info('Initialised Temperature sensors on gpio {}'.format(self._config['gpio']))
+        logger.info('Initialised Temperature sensors on gpio {}'.format(self._gpios))
 
     def on(self):
         """ Start temperature reading in a background thread. """
         if not self.is_on:
             self.is_on = True
-            self._update_thread.start()
-            logger.info('Started Temperature reading on gpio {}'.format(self._config['gpio']))
+            if self.run_in_thread:
+                self._update_thread.start()
+            logger.info('Started Temperature reading on gpio {}'.format(self._gpios))
 
     def off(self):
         """ Stop temperature reading in a background thread. """
         if self.is_on:
-            self._update_thread.cancel()
+            if self.run_in_thread:
+                self._update_thread.cancel()
             self.is_on = False
-            logger.info('Stopped Temperature reading on gpio {}'.format(self._config['gpio']))
+            logger.info('Stopped Temperature reading on gpio {}'.format(self._gpios))
 
     @property
     def sensors(self):
-        """ \:returns List of sensors discovered by the system. """
+        """ \:returns List of sensors discovered by the system, as (gpio, id). """
         return self._sensors
 
+    @property
+    def names(self):
+        """ \:returns Names of the configured sensors, in config order. """
+        return [name for name, _, _ in self._names]
+
+    @property
+    def _gpios(self):
+        return ', '.join(str(gpio) for gpio in self._buses)
+
+    @property
+    def snapshot(self):
+        """ \:returns Latest SensorSnapshot, consistent across all sensors. """
+        return self._snapshot
+
     @property
     def probe1_temp(self):
-        """ \:returns Returns a tuple as (temp, status) for probe1. """
-        conf = self._config['probe1']
-        return self._get_temp(conf)
+        """ \:returns Returns a SensorReading as (temp, status, seq, timestamp) for probe1. """
+        return self.reading('probe1')
 
     @property
     def probe2_temp(self):
-        """ \:returns Returns a tuple as (temp, status) for probe2. """
-        conf = self._config['probe2']
-        return self._get_temp(conf)
+        """ \:returns Returns a SensorReading as (temp, status, seq, timestamp) for probe2. """
+        return self.reading('probe2')
 
     @property
     def pit_temp(self):
-        """ \:returns Returns a tuple as (temp, status) for bbq. """
-        conf = self._config['pit']
-        return self._get_temp(conf)
+        """ \:returns Returns a SensorReading as (temp, status, seq, timestamp) for bbq. """
+        return self.reading('pit')
 
     @property
     def board_temp(self):
@@ -97,56 +171,120 @@ class Max31850Sensors:
 
         \:returns Single value for board temperature, or None.
         """
-        if self._board_temp is not None:
-            return self._board_temp + self._config['board']['temperature_offset']
-        else:
-            return None
-
-    def _get_temp(self, conf):
-        if conf['id'] in self._temps:
-            sensor_info = deepcopy(self._temps[conf['id']])
-            if sensor_info['temp'] is not None:
-                sensor_info['temp'] = sensor_info['temp'] + conf['temperature_offset']
-            return sensor_info
-        else:
-            return {'temp': None, 'status': Max31850Sensors.Status.UNKNOWN}
+        return self._snapshot.board_temp
+
+    def filtered_temp(self, name):
+        """ Temperature of a named sensor through the configured filter, one of raw, mean, ema or median.
+
+        \:returns Filtered temperature, or None when there is no valid sample yet.
+        """
+        snapshot = self._snapshot
+        if self._filter == 'raw':
+            return snapshot.readings.get(name, self._unknown).temp
+        filters = snapshot.filters.get(name)
+        return getattr(filters, self._filter) if filters is not None else None
+
+    def reading(self, name):
+        """ \:returns Returns a SensorReading as (temp, status, seq, timestamp) for a named sensor. """
+        return self._snapshot.readings.get(name, self._unknown)
+
+    @property
+    def timing(self):
+        """ \:returns Conversion wait, last cycle duration, effective sample rate and per sensor read stats. """
+        return self._scheduler.stats
 
     def _update_loop(self):
         """ Continue to read temps in a loop until asked to stop. """
         while self.is_on:
-            # Start the conversion for the next loop
-            logger.debug('Start Conversion on pin {}'.format(self._config['gpio']))
-            DS.pinsStartConversion([self._config['gpio']])
-
-            # Requires sleep for samples to appear
-            sleep(self._config['sampling_seconds'])
-
-            # We can average out the board temperature for this device, nice indicator.
-            board_temps = 0
-            count_board_ok = 0
-            for sensor in self._sensors:
-                temps = DS.readMax31850(False, self._config['gpio'], sensor)
-                if temps is None:
-                    continue
-
-                # First we get our status, as we need to decide if this reading is going to be valid.
-                status = self._do_status(temps, sensor)
-                if status == Max31850Sensors.Status.OK:
-                    # Good, then we get the temperature reported by the 1-wire device
-                    logger.debug('Sensor {} reports a valid temperature as {}'.format(sensor, temps[0]))
-                    self._temps[sensor]['temp'] = temps[0]
-                    self._temps[sensor]['status'] = status
-                    board_temps += temps[1]
-                    count_board_ok += 1
-                else:
-                    # This is not good then, whatever the case is, we can't trust this temp
-                    logger.debug('Sensor {} reports an error as {}'.format(sensor, status))
-                    self._temps[sensor]['temp'] = None
-                    self._temps[sensor]['status'] = status
-
-            # Now we can get the mean of our board temps.
-            if count_board_ok > 0:
-                self._board_temp = board_temps / count_board_ok
+            self.sample()
+
+    def sample(self, sleeper=sleep):
+        """ Runs one conversion cycle in the calling thread, e.g. to drive sampling on simulated time.
+
+        \:param sleeper: Waits for the conversion, given how long in seconds.
+        """
+        # Requires sleep for samples to appear
+        sleeper(self._start_conversion())
+        self._read_conversion()
+
+    async def run_async(self, executor):
+        """ Same as the update loop, as a coroutine with the blocking 1-wire calls handed to an executor. """
+        loop = asyncio.get_event_loop()
+        while self.is_on:
+            wait = await loop.run_in_executor(executor, self._start_conversion)
+            await asyncio.sleep(wait)
+            await loop.run_in_executor(executor, self._read_conversion)
+
+    def _start_conversion(self):
+        """ Starts the conversion for the next cycle.
+
+        \:returns How long to wait before the conversion can be read.
+        """
+        logger.debug('Start Conversion on pin {}'.format(self._gpios))
+        self._cycle_start = perf_counter()
+        self._cycle_timestamp = self._clock()
+        self._ds.pinsStartConversion(self._buses)
+        return self._scheduler.conversion_seconds
+
+    def _read_conversion(self):
+        """ Reads all sensors due this cycle and publishes a new snapshot. """
+        timestamp = self._cycle_timestamp
+
+        # Work on a private copy, readers keep seeing the previous snapshot until it is swapped.
+        previous = self._snapshot
+        seq = previous.seq + 1
+        temps = dict()
+
+        # We can average out the board temperature for this device, nice indicator.
+        board_temps = 0
+        count_board_ok = 0
+        for gpio, sensor in self._sensors:
+            if not self._scheduler.due(sensor):
+                continue
+            read_start = perf_counter()
+            values = self._ds.readMax31850(False, gpio, sensor)
+            latency = perf_counter() - read_start
+            if values is None:
+                self._scheduler.record(sensor, latency, ok=False, not_ready=True)
+                continue
+
+            # First we get our status, as we need to decide if this reading is going to be valid.
+            status = self._do_status(values, sensor)
+            self._scheduler.record(sensor, latency, ok=status == Max31850Sensors.Status.OK, not_ready=False)
+            if status == Max31850Sensors.Status.OK:
+                # Good, then we get the temperature reported by the 1-wire device
+                logger.debug('Sensor {} reports a valid temperature as {}'.format(sensor, values[0]))
+                temps[sensor] = (values[0], status)
+                board_temps += values[1]
+                count_board_ok += 1
+            else:
+                # This is not good then, whatever the case is, we can't trust this temp
+                logger.debug('Sensor {} reports an error as {}'.format(sensor, status))
+                temps[sensor] = (None, status)
+
+        # Sensors which could not be read keep their previous reading.
+        readings = dict()
+        filters = dict(previous.filters)
+        for name, sensor, offset in self._names:
+            if sensor in temps:
+                temp, status = temps[sensor]
+                if temp is not None:
+                    temp += offset
+                    history = self._histories[name]
+                    history.add(timestamp, temp)
+                    filters[name] = SensorFilters(history.mean, history.ema, history.median, history.slope)
+                readings[name] = SensorReading(temp, status, seq, timestamp)
+            else:
+                readings[name] = previous.readings.get(name, self._unknown)
+
+        # Now we can get the mean of our board temps.
+        board_temp = previous.board_temp
+        if count_board_ok > 0:
+            board_temp = board_temps / count_board_ok + self._config['board']['temperature_offset']
+
+        # Single reference assignment, atomic for readers.
+        self._snapshot = SensorSnapshot(seq, timestamp, readings, board_temp, filters)
+        self._scheduler.end_cycle(perf_counter() - self._cycle_start)
 
     @staticmethod
     def _do_status(temps, sensor):
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PersistenceService:
+    """ Saves JSON documents such as config.json and state.json from a background thread.
+
+    Successive saves of a document are coalesced: it is written once no update came in for debounce_seconds, or at the
+    latest max_delay_seconds after the first pending update. Writes go through a temporary file which is synced and
+    renamed over the document, so a power cut leaves either the old or the new version, never half of one.
+
+    Every save gets a revision. Revisions start from the time the service started, in milliseconds, and count up from
+    there, so they keep increasing across restarts and clients can drop stale replies.
+    """
+
+    def __init__(self, config=None):
+        """
+        \:param config: The 'persistence' config section, may be empty.
+        """
+        config = config if config is not None else {}
+        self._debounce = config.get('debounce_seconds', 1)
+        self._max_delay = config.get('max_delay_seconds', 5)
+        self._condition = threading.Condition()
+        # Pending documents by path, as (revision, serialised content, first update time, last update time).
+        self._pending = dict()
+        self._revision = int(time.time() * 1000)
+        self._revisions = dict()
+        self._thread = None
+        self._running = False
+        self.writes = 0
+        self.coalesced = 0
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._writer_loop, name='Persistence writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Writes whatever is pending and stops the writer. """
+        if self._thread is not None:
+            with self._condition:
+                self._running = False
+                self._condition.notify()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def save(self, path, document):
+        """ Queues a document to be written, it is serialised straight away so the caller may go on changing it.
+
+        \:returns Revision of this save.
+        """
+        content = json.dumps(document, indent=4, sort_keys=True)
+        now = time.monotonic()
+        with self._condition:
+            self._revision += 1
+            revision = self._revision
+            self._revisions[path] = revision
+            pending = self._pending.get(path)
+            if pending is not None:
+                self.coalesced += 1
+            first = pending[2] if pending is not None else now
+            self._pending[path] = (revision, content, first, now)
+            self._condition.notify()
+        return revision
+
+    def revision(self, path):
+        """ \:returns Revision of the last save of a document, or the latest revision when it was not saved yet. """
+        with self._condition:
+            return self._revisions.get(path, self._revision)
+
+    def flush(self):
+        """ Writes every pending document now, in the calling thread. """
+        with self._condition:
+            pending = list(self._pending.items())
+            self._pending.clear()
+        for path, (revision, content, _, _) in pending:
+            self._write(path, revision, content)
+
+    def _due(self, now):
+        """ \:returns Tuple as (documents due now, seconds until the next one is due). """
+        due = []
+        wait = None
+        for path, (revision, content, first, last) in list(self._pending.items()):
+            at = min(last + self._debounce, first + self._max_delay)
+            if at <= now:
+                due.append((path, revision, content))
+                del self._pending[path]
+            else:
+                wait = at - now if wait is None else min(wait, at - now)
+        return due, wait
+
+    def _writer_loop(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._running:
+                        return
+                    due, wait = self._due(time.monotonic())
+                    if due:
+                        break
+                    self._condition.wait(wait)
+            for path, revision, content in due:
+                self._write(path, revision, content)
+
+    def _write(self, path, revision, content):
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            # Make the rename itself durable.
+            directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self.writes += 1
+            logger.debug('Saved {} at revision {}'.format(path, revision))
+        except OSError as ex:
+            logger.error('Failed to save {}: {}'.format(path, ex))
+
+    @property
+    def stats(self):
+        with self._condition:
+            pending = len(self._pending)
+        return {'writes': self.writes, 'coalesced': self.coalesced, 'pending': pending, 'revision': self._revision}
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+""" Offline PID gain sweep over a recorded cook.
+
+Fits a first order plus dead time model of the pit to the pit temperature and fan duty cycle logged in SQLite, then
+simulates the controller on that model for a whole grid of P, I and D gains at once with NumPy, replicating the exact
+update and windup behaviour of pid.PID, the configured temperature filter and the duty cycle clamping of the
+controller. Gains are ranked by overshoot, settling time and fan effort.
+
+Requires NumPy, which the agent itself does not need: pip install -r requirements-tools.txt
+"""
+import argparse
+import json
+import logging
+import math
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+LOAD_SERIES = """
+SELECT timestamp, 'pit', NULLIF(temp, -1) FROM sensor_data
+WHERE device_id = :device_id AND sensor_name = 'pit' AND timestamp >= :start AND timestamp < :end
+UNION ALL
+SELECT timestamp, 'fan', duty_cycle FROM fan_data
+WHERE device_id = :device_id AND fan_name = 'fan' AND timestamp >= :start AND timestamp < :end
+ORDER BY timestamp;"""
+
+BUSIEST_DEVICE = "SELECT device_id FROM sensor_data GROUP BY device_id ORDER BY COUNT(*) DESC LIMIT 1;"
+
+# Filters of the temperature fed to the PID, as in Max31850Sensors.filtered_temp()
+FILTERS = ('raw', 'ema', 'mean', 'median')
+
+
+class PlantModel:
+    """ First order plus dead time pit model, dT/dt = (gain * duty + base - T) / tau with duty delayed by dead_time. """
+
+    def __init__(self, gain, base, tau, dead_time, residual=None):
+        self.gain = gain
+        self.base = base
+        self.tau = tau
+        self.dead_time = dead_time
+        self.residual = residual
+
+    def as_dict(self):
+        return {'gain': self.gain, 'base': self.base, 'tau': self.tau, 'dead_time': self.dead_time,
+                'residual': self.residual}
+
+
+def load_series(sqlite_file, device_id=None, start=0, end=float('inf'), step=10):
+    """ Loads pit temperature and fan duty cycle, resampled on a regular grid by holding the last logged value.
+
+    Samples are only logged when they change, so holding the last value restores the signal as the controller saw it.
+
+    \:returns Tuple as (times, pit, duty), arrays with NaN where a value is unknown.
+    """
+    conn = sqlite3.connect(sqlite_file)
+    try:
+        if device_id is None:
+            row = conn.execute(BUSIEST_DEVICE).fetchone()
+            if row is None:
+                raise ValueError('No sensor data in {}'.format(sqlite_file))
+            device_id = row[0]
+        try:
+            rows = conn.execute(LOAD_SERIES, {'device_id': device_id, 'start': start,
+                                              'end': end if math.isfinite(end) else 1e12}).fetchall()
+        except sqlite3.OperationalError as ex:
+            # Logged before fan duty cycles were, there is no fan_data table.
+            if 'no such table' not in str(ex):
+                raise
+            rows = []
+    finally:
+        conn.close()
+
+    if not any(name == 'fan' for _, name, _ in rows):
+        raise ValueError('No fan duty cycle was logged for device {}, record a cook with this version first'.format(
+            device_id))
+
+    t0, t1 = rows[0][0], rows[-1][0]
+    times = np.arange(t0, t1, step)
+    series = dict()
+    for name in ('pit', 'fan'):
+        stamps = np.array([t for t, n, _ in rows if n == name])
+        values = np.array([np.nan if v is None else v for _, n, v in rows if n == name], dtype=float)
+        index = np.searchsorted(stamps, times, side='right') - 1
+        held = np.where(index >= 0, values[np.clip(index, 0, None)], np.nan)
+        series[name] = held
+    return times, series['pit'], series['fan']
+
+
+def fit_plant(pit, duty, step, ambient=None, max_dead_time=300):
+    """ Least squares fit of T[k+1] = a * T[k] + b * duty[k - d] + c for each dead time d, keeping the best one.
+
+    Closed loop data seldom moves the duty cycle enough to tell the fan apart from the natural draft, so by default
+    the pit is assumed to settle at ambient with the fan off (c = (1 - a) * ambient) and only a and b are fitted.
+
+    \:param ambient: Ambient temperature anchoring the model, None to fit it as well.
+    \:returns PlantModel in continuous time.
+    """
+    offset = ambient if ambient is not None else 0.0
+    best = None
+    for d in range(0, int(max_dead_time / step) + 1):
+        t_now = pit[d:-1] - offset
+        t_next = pit[d + 1:] - offset
+        u = duty[:len(duty) - d - 1]
+        valid = ~(np.isnan(t_now) | np.isnan(t_next) | np.isnan(u))
+        if valid.sum() < 10:
+            continue
+        columns = [t_now[valid], u[valid]]
+        if ambient is None:
+            columns.append(np.ones(valid.sum()))
+        x = np.column_stack(columns)
+        coefficients, _, rank, _ = np.linalg.lstsq(x, t_next[valid], rcond=None)
+        if rank < len(columns):
+            continue
+        residual = float(np.sqrt(np.mean((x @ coefficients - t_next[valid]) ** 2)))
+        if best is None or residual < best[0]:
+            best = (residual, d, coefficients)
+
+    if best is None:
+        raise ValueError('Not enough pit and fan samples to fit a model, the fan needs to have been active')
+    residual, d, coefficients = best
+    a, b = coefficients[0], coefficients[1]
+    c = coefficients[2] if ambient is None else 0.0
+    if not 0 < a < 1:
+        raise ValueError('Fitted pit model is unstable (a={:.4f}), try another time range'.format(a))
+    return PlantModel(gain=b / (1 - a), base=c / (1 - a) + offset, tau=-step / math.log(a), dead_time=d * step,
+                      residual=residual)
+
+
+def sweep(plant, p, i, d, controller, set_point, initial, minutes, dt, band, sensor_filter=None,
+          windup_guard=20.0):
+    """ Simulates the controller for every gain combination at once.
+
+    \:param p, i, d: Arrays of gains, one per combination, all the same shape.
+    \:param controller: The 'controller' config section, for blower_cycle_min/max.
+    \:param band: Settled once the pit stays within set point +/- band.
+    \:param sensor_filter: The 'filter' section of the temperature config, the PID is fed raw temperatures when None.
+    \:returns dict of metric name to array, one value per combination.
+    """
+    n = p.shape[0]
+    steps = int(minutes * 60 / dt)
+    duty_min = controller['blower_cycle_min']
+    duty_max = controller['blower_cycle_max']
+    decay = 1 - math.exp(-dt / plant.tau)
+    delay = max(0, int(round(plant.dead_time / dt)))
+
+    sensor_filter = sensor_filter if sensor_filter is not None else {}
+    filter_type = sensor_filter.get('type', 'raw')
+    if filter_type not in FILTERS:
+        raise ValueError('Unknown temperature filter {}'.format(filter_type))
+    alpha = sensor_filter.get('ema_alpha', 0.3)
+    window = sensor_filter.get('window', 10)
+
+    temp = np.full(n, float(initial))
+    measured = temp.copy()
+    # Recent samples for the mean and median windows, filled in order until the window is full.
+    recent = np.empty((window, n))
+    recent[0] = temp
+    i_term = np.zeros(n)
+    last_error = np.zeros(n)
+    error = np.empty(n)
+    output = np.empty(n)
+    duty = np.empty(n)
+    last_duty = np.full(n, float(duty_min))
+    # Duty cycles still travelling through the dead time, oldest first.
+    pipeline = np.full((delay + 1, n), float(duty_min))
+
+    peak = temp.copy()
+    last_outside = np.zeros(n)
+    iae = np.zeros(n)
+    duty_total = np.zeros(n)
+    duty_travel = np.zeros(n)
+
+    for k in range(steps):
+        # PID.update, the first call sees no elapsed time hence no integral or derivative.
+        delta_time = dt if k > 0 else 0.0
+        np.subtract(set_point, measured, out=error)
+        np.multiply(p, error, out=output)
+        i_term += error * delta_time
+        np.clip(i_term, -windup_guard, windup_guard, out=i_term)
+        output += i * i_term
+        if delta_time > 0:
+            output += d * (error - last_error) / delta_time
+        last_error[:] = error
+
+        # Controller clamping
+        np.add(output, duty_min, out=duty)
+        np.clip(duty, duty_min, duty_max, out=duty)
+
+        # Plant, driven by the duty cycle from dead time ago.
+        pipeline[k % (delay + 1)] = duty
+        applied = pipeline[(k + 1) % (delay + 1)]
+        temp += (plant.gain * applied + plant.base - temp) * decay
+        if filter_type == 'raw':
+            measured[:] = temp
+        elif filter_type == 'ema':
+            measured += alpha * (temp - measured)
+        else:
+            recent[(k + 1) % window] = temp
+            filled = recent[:min(k + 2, window)]
+            if filter_type == 'mean':
+                np.mean(filled, axis=0, out=measured)
+            else:
+                np.median(filled, axis=0, out=measured)
+
+        # Metrics
+        np.maximum(peak, temp, out=peak)
+        outside = np.abs(temp - set_point)
+        iae += outside * dt
+        last_outside[outside > band] = (k + 1) * dt
+        duty_total += duty
+        duty_travel += np.abs(duty - last_duty)
+        last_duty[:] = duty
+
+    horizon = steps * dt
+    settling = np.where(last_outside >= horizon, np.inf, last_outside)
+    return {
+        'overshoot': np.maximum(peak - set_point, 0),
+        'settling_minutes': settling / 60,
+        'iae': iae,
+        'mean_duty': duty_total / steps,
+        'duty_travel_per_minute': duty_travel / (horizon / 60),
+    }
+
+
+def score(metrics, weights):
+    """ Weighted sum of overshoot, settling time and fan effort, lower is better. Unsettled runs rank last. """
+    settling = np.where(np.isinf(metrics['settling_minutes']), 1e6, metrics['settling_minutes'])
+    return (weights['overshoot'] * metrics['overshoot'] + weights['settling'] * settling +
+            weights['effort'] * metrics['duty_travel_per_minute'])
+
+
+def _grid(spec):
+    """ Parses start:stop:count into evenly spaced values, or a comma separated list of values. """
+    if ':' in spec:
+        start, stop, count = spec.split(':')
+        return np.linspace(float(start), float(stop), int(count))
+    return np.array([float(v) for v in spec.split(',')])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep PID gains offline against a pit model fitted to a cook.')
+    parser.add_argument('--db', default=None, help='SQLite file of the data logger, defaults to the configured one')
+    parser.add_argument('--config', default='config/config.json', help='Agent config file')
+    parser.add_argument('--device', help='Device id, defaults to the one with most data')
+    parser.add_argument('--start', type=float, default=0, help='Start of the cook as a unix timestamp')
+    parser.add_argument('--end', type=float, default=float('inf'), help='End of the cook as a unix timestamp')
+    parser.add_argument('--fit-step', type=float, default=10, help='Resampling step for fitting, in seconds')
+    parser.add_argument('--ambient', type=float, default=20, help='Ambient temperature during the cook')
+    parser.add_argument('--fit-base', action='store_true',
+                        help='Fit the temperature the pit settles at with the fan off, rather than using ambient')
+    parser.add_argument('--P', default='0.5:10:20', help='Proportional gains as start:stop:count or a list')
+    parser.add_argument('--I', default='0:2:20', help='Integral gains as start:stop:count or a list')
+    parser.add_argument('--D', default='0:20:15', help='Derivative gains as start:stop:count or a list')
+    parser.add_argument('--set-point', type=float, default=115, help='Pit set point to simulate')
+    parser.add_argument('--initial', type=float, help='Initial pit temperature, defaults to the model at minimum duty')
+    parser.add_argument('--minutes', type=float, default=90, help='Simulated duration')
+    parser.add_argument('--dt', type=float, help='Simulation step, defaults to the control loop interval')
+    parser.add_argument('--band', type=float, default=2, help='Settling band around the set point')
+    parser.add_argument('--weights', default='1,1,0.5', help='Score weights for overshoot, settling and effort')
+    parser.add_argument('--top', type=int, default=10, help='Number of gain combinations to show')
+    parser.add_argument('--json', help='Write the model and ranking to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='%(message)s')
+    with open(args.config) as f:
+        config = json.load(f)
+    controller = config['controller']
+    dt = args.dt if args.dt is not None else config['intervals']['control_loop_second']
+    sensor_filter = config['temperature'].get('filter', {})
+    if sensor_filter.get('type', 'raw') not in FILTERS:
+        sys.exit('Unknown temperature filter {}, expected one of {}'.format(sensor_filter['type'], ', '.join(FILTERS)))
+    weights = dict(zip(('overshoot', 'settling', 'effort'), (float(w) for w in args.weights.split(','))))
+
+    try:
+        _, pit, duty = load_series(args.db or config['data_logger']['path'], args.device, args.start, args.end,
+                                   args.fit_step)
+        plant = fit_plant(pit, duty, args.fit_step, None if args.fit_base else args.ambient)
+    except ValueError as ex:
+        sys.exit(str(ex))
+    logger.info('Pit model: gain={:.3f} C/%, base={:.1f} C, tau={:.0f}s, dead time={:.0f}s, residual={:.3f} C'.format(
+        plant.gain, plant.base, plant.tau, plant.dead_time, plant.residual))
+
+    # Gain grid, with the current gains appended so they can be compared.
+    grid_p, grid_i, grid_d = np.meshgrid(_grid(args.P), _grid(args.I), _grid(args.D), indexing='ij')
+    p = np.append(grid_p.ravel(), controller['P'])
+    i = np.append(grid_i.ravel(), controller['I'])
+    d = np.append(grid_d.ravel(), controller['D'])
+    initial = args.initial if args.initial is not None else plant.gain * controller['blower_cycle_min'] + plant.base
+
+    start = time.perf_counter()
+    metrics = sweep(plant, p, i, d, controller, args.set_point, initial, args.minutes, dt, args.band,
+                    sensor_filter)
+    scores = score(metrics, weights)
+    logger.info('Simulated {} gain combinations over {} minutes in {:.2f}s'.format(
+        len(p), args.minutes, time.perf_counter() - start))
+
+    order = np.argsort(scores, kind='stable')
+    ranking = []
+    for rank, k in enumerate(order):
+        entry = {'rank': rank + 1, 'P': float(p[k]), 'I': float(i[k]), 'D': float(d[k]), 'score': float(scores[k])}
+        entry.update({name: float(values[k]) if np.isfinite(values[k]) else None for name, values in metrics.items()})
+        entry['current'] = bool(k == len(p) - 1)
+        ranking.append(entry)
+
+    print('{:>5} {:>7} {:>7} {:>7} {:>9} {:>10} {:>9} {:>9}'.format(
+        'rank', 'P', 'I', 'D', 'overshoot', 'settle min', 'duty', 'travel/m'))
+    current = next(e for e in ranking if e['current'])
+    for entry in ranking[:args.top] + ([current] if current['rank'] > args.top else []):
+        settling = entry['settling_minutes']
+        print('{rank:>5} {P:>7.3f} {I:>7.3f} {D:>7.3f} {overshoot:>9.2f} {settling:>10} '
+              '{mean_duty:>9.1f} {duty_travel_per_minute:>9.2f}{mark}'.format(
+                settling='never' if settling is None else '{:.1f}'.format(settling),
+                mark=' (current)' if entry['current'] else '', **entry))
+    best = ranking[0]
+    print('Apply with a controller/config/desired payload of {}'.format(
+        json.dumps({'P': round(best['P'], 3), 'I': round(best['I'], 3), 'D': round(best['D'], 3)})))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'model': plant.as_dict(), 'set_point': args.set_point, 'minutes': args.minutes,
+                       'ranking': ranking[:max(args.top, 100)]}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+""" Replays a logged session through the real TempController, as fast as the CPU allows.
+
+Logged samples are streamed from the data logger into stand-in sensors and the controller is ticked on the
+recorded time line, with a stand-in fan and MQTT client. The duty cycles and samples it produces are compared to what
+was recorded, so controller or config changes can be checked against real cooks before rolling them out.
+"""
+import argparse
+import csv
+import heapq
+import json
+import logging
+import math
+import sys
+import time
+
+from controller import TempController, Mode, fan_configs
+from db.data_logger import DataLogger
+from peripherals.sample_history import SampleHistory
+from peripherals.simulation import SimulatedMqttClient
+from peripherals.temperature_sensors import Max31850Sensors, SensorReading, SensorFilters, named_sensors
+
+logger = logging.getLogger(__name__)
+
+
+def logged_sensors(config):
+    """ \:returns Names of the sensors the controller logs for a config, temperatures then the board. """
+    return [name for name, _, _ in named_sensors(config['temperature'])] + ['board']
+
+
+def logged_samples(data_logger, config, start=0, end=float('inf')):
+    """ \:returns Logged sensor samples merged in time order with the logged fan duty cycles, as Replay takes them. """
+    samples = data_logger.samples(logged_sensors(config), start, end)
+    fan_samples = data_logger.fan_samples(list(fan_configs(config)), start, end)
+    fans = ((timestamp, name, duty_cycle, healthy) for timestamp, name, duty_cycle, _, healthy in fan_samples)
+    return heapq.merge(samples, fans, key=lambda row: row[0])
+
+
+def _status(status):
+    """ Status as logged, numeric for temperature sensors and a string for the board and fan. """
+    try:
+        return Max31850Sensors.Status(int(status))
+    except ValueError:
+        return status
+
+
+class ReplaySensors:
+    """ Stands in for Max31850Sensors, serving the last logged reading of each sensor.
+
+    Samples were only logged when they changed, so filters are fed the held readings once per tick to approximate the
+    samples the controller saw live.
+    """
+
+    def __init__(self, config):
+        """
+        \:param config: The 'temperature' config section.
+        """
+        self._unknown = SensorReading(None, Max31850Sensors.Status.UNKNOWN, 0, None)
+        self._readings = {name: self._unknown for name, _, _ in named_sensors(config)}
+        self._filters = dict()
+        self._seq = 0
+        self.board_temp = None
+
+        filter_conf = config.get('filter', {})
+        self._filter = filter_conf.get('type', 'raw')
+        self._histories = {name: SampleHistory(filter_conf.get('window', 10), filter_conf.get('ema_alpha', 0.3))
+                           for name in self._readings}
+
+    def initialise(self):
+        pass
+
+    def on(self):
+        pass
+
+    def off(self):
+        pass
+
+    def feed(self, timestamp, name, temp, status):
+        """ Applies a logged sample. """
+        if name == 'board':
+            self.board_temp = temp
+        elif name in self._readings:
+            self._seq += 1
+            self._readings[name] = SensorReading(temp, _status(status), self._seq, timestamp)
+
+    def sample(self, timestamp):
+        """ Feeds held readings to the filters, as a conversion cycle would. """
+        for name, reading in self._readings.items():
+            if reading.temp is not None and reading.status == Max31850Sensors.Status.OK:
+                history = self._histories[name]
+                history.add(timestamp, reading.temp)
+                self._filters[name] = SensorFilters(history.mean, history.ema, history.median, history.slope)
+
+    def reading(self, name):
+        return self._readings.get(name, self._unknown)
+
+    def filtered_temp(self, name):
+        if self._filter == 'raw':
+            return self._readings.get(name, self._unknown).temp
+        filters = self._filters.get(name)
+        return getattr(filters, self._filter) if filters is not None else None
+
+
+class ReplayFan:
+    """ Stands in for BlowerFan, spinning in proportion to its duty cycle unless the log says it was unhealthy. """
+
+    def __init__(self, max_rpm=3000):
+        self._max_rpm = max_rpm
+        self.duty_cycle = 0
+        self.is_on = False
+        self.stalled = False
+        self.monitor = None
+
+    def initisalise(self):
+        pass
+
+    def on(self):
+        self.is_on = True
+
+    def off(self):
+        self.duty_cycle = 0
+        self.is_on = False
+
+    @property
+    def rpm(self):
+        if not self.is_on or self.stalled:
+            return 0
+        return int(self._max_rpm * self.duty_cycle / 100)
+
+    @property
+    def is_healthy(self):
+        return not (self.is_on and self.duty_cycle > 0 and self.rpm == 0)
+
+
+class ReplayDataLogger:
+    """ Stands in for DataLogger, counting the samples the controller would have logged. """
+
+    def __init__(self):
+        self.counts = dict()
+
+    def log_sensors(self, timestamp, sensors, fans=()):
+        for name, _ in sensors:
+            self.counts[name] = self.counts.get(name, 0) + 1
+        for name, _ in fans:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+class Replay:
+    """ Streams a logged session through a TempController and diffs its duty cycles against the recorded ones. """
+
+    def __init__(self, config, state, samples, tolerance=1.0, on_tick=None):
+        """
+        \:param config: Full agent config, possibly a candidate one.
+        \:param state: Controller state, its mode follows the recorded duty cycle.
+        \:param samples: Iterable of (timestamp, sensor, temp, status) in time order, fans as (timestamp, fan, duty
+        cycle, healthy).
+        \:param tolerance: Duty cycle difference beyond which a tick counts as diverging.
+        \:param on_tick: Called with (timestamp, recorded duty, replayed duty) after every tick.
+        """
+        self._samples = iter(samples)
+        self._state = state
+        self._interval = config['intervals']['control_loop_second']
+        self._tolerance = tolerance
+        self._on_tick = on_tick
+
+        self.client = SimulatedMqttClient()
+        self.sensors = ReplaySensors(config['temperature'])
+        max_rpm = config.get('simulation', {}).get('max_rpm', 3000)
+        self.fans = {name: ReplayFan(max_rpm) for name in fan_configs(config)}
+        self.fan = self.fans['fan']
+        self.data_logger = ReplayDataLogger()
+        self.controller = TempController(config, self.sensors, self.fans, self.client, self.data_logger,
+                                         state=state)
+        self._logged = logged_sensors(config) + list(self.fans)
+
+        self.recorded = dict()
+        self.recorded_duty = None
+        self.ticks = 0
+        self.compared = 0
+        self.diverging = 0
+        self.abs_diff = 0.0
+        self.sq_diff = 0.0
+        self.max_diff = 0.0
+        self.max_diff_time = None
+
+    def _apply(self, row):
+        timestamp, name, temp, status = row
+        self.recorded[name] = self.recorded.get(name, 0) + 1
+        if name in self.fans:
+            # Duty cycles are compared on the first fan, the one of the legacy pit zone.
+            if name == 'fan':
+                self.recorded_duty = temp
+            self.fans[name].stalled = not status
+        else:
+            self.sensors.feed(timestamp, name, temp, status)
+
+    def run(self):
+        """ Replays every sample, ticking the controller on the recorded time line. """
+        row = next(self._samples, None)
+        if row is None:
+            return
+        self.controller.initialise()
+        self.controller.start()
+        now = row[0]
+        while row is not None:
+            # Everything logged up to this tick, as the controller would have seen it.
+            while row is not None and row[0] <= now:
+                self._apply(row)
+                row = next(self._samples, None)
+
+            # Follow the recorded mode, the fan only ran while active.
+            if self.recorded_duty is not None:
+                self._state['mode'] = Mode.ACTIVE if self.recorded_duty > 0 else Mode.READY
+
+            self.sensors.sample(now)
+            self.controller.tick(now, now)
+            self.ticks += 1
+            self._compare(now)
+            now += self._interval
+        self.controller.stop()
+
+    def _compare(self, now):
+        replayed = self.fan.duty_cycle if self.fan.is_on else 0
+        if self._on_tick is not None:
+            self._on_tick(now, self.recorded_duty, replayed)
+        if self.recorded_duty is None:
+            return
+        diff = abs(replayed - self.recorded_duty)
+        self.compared += 1
+        self.abs_diff += diff
+        self.sq_diff += diff * diff
+        if diff > self._tolerance:
+            self.diverging += 1
+        if diff > self.max_diff:
+            self.max_diff = diff
+            self.max_diff_time = now
+
+    @property
+    def summary(self):
+        """ \:returns Duty cycle and sample count differences as a JSON serialisable dict. """
+        n = self.compared
+        return {
+            'ticks': self.ticks,
+            'duty_cycle': {
+                'compared_ticks': n,
+                'mean_abs_diff': self.abs_diff / n if n else None,
+                'rms_diff': math.sqrt(self.sq_diff / n) if n else None,
+                'max_diff': self.max_diff,
+                'max_diff_time': self.max_diff_time,
+                'diverging_ticks': self.diverging,
+                'tolerance': self._tolerance,
+            },
+            'samples': {name: {'recorded': self.recorded.get(name, 0),
+                               'replayed': self.data_logger.counts.get(name, 0)} for name in self._logged},
+            'publishes': dict(sorted(self.client.counts.items())),
+            'published_bytes': self.client.published_bytes,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a logged session through the controller.')
+    parser.add_argument('--db', help='SQLite file of the data logger, defaults to the configured one')
+    parser.add_argument('--config', default='config/config.json', help='Agent config to replay with')
+    parser.add_argument('--state', default='config/state.json', help='Controller state to replay with')
+    parser.add_argument('--set-point', type=float, help='Pit set point, overrides the state')
+    parser.add_argument('--device', help='Device id, defaults to the one with most data')
+    parser.add_argument('--start', type=float, default=0, help='Start of the session as a unix timestamp')
+    parser.add_argument('--end', type=float, default=float('inf'), help='End of the session as a unix timestamp')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='Duty cycle difference counted as diverging')
+    parser.add_argument('--max-mean-diff', type=float,
+                        help='Exit non zero when the mean duty cycle difference exceeds this')
+    parser.add_argument('--csv', help='Write (timestamp, recorded duty, replayed duty) per tick to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING, format='%(message)s')
+    with open(args.config) as f:
+        config = json.load(f)
+    with open(args.state) as f:
+        state = json.load(f)
+    if args.set_point is not None:
+        state['pit']['setPoint'] = args.set_point
+
+    # Read only, so replaying never changes the agent's database
+    data_logger = DataLogger(args.db or config['data_logger']['path'], args.device, read_only=True)
+    if args.device is None:
+        devices = data_logger.devices()
+        if not devices:
+            sys.exit('Nothing logged to replay')
+        data_logger.device_id = devices[0][0]
+    samples = logged_samples(data_logger, config, args.start, args.end)
+
+    on_tick = None
+    csv_file = None
+    if args.csv:
+        csv_file = open(args.csv, 'w', newline='')
+        writer = csv.writer(csv_file)
+        writer.writerow(['timestamp', 'recorded_duty', 'replayed_duty'])
+        on_tick = writer.writerow
+
+    replay = Replay(config, state, samples, args.tolerance,
+                    (lambda *values: on_tick(values)) if on_tick is not None else None)
+    start = time.perf_counter()
+    try:
+        replay.run()
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+    summary = replay.summary
+    summary['device_id'] = data_logger.device_id
+    summary['wall_seconds'] = round(time.perf_counter() - start, 3)
+    print(json.dumps(summary, indent=4))
+
+    mean_diff = summary['duty_cycle']['mean_abs_diff']
+    if args.max_mean_diff is not None and mean_diff is not None and mean_diff > args.max_mean_diff:
+        sys.exit('Mean duty cycle difference {:.2f} exceeds {}'.format(mean_diff, args.max_mean_diff))
+
+
+if __name__ == '__main__':
+    main()
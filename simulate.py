@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+""" Runs the controller against the simulated smoker on simulated time, as fast as the CPU allows.
+
+Sensors, fan, controller and data logger run in lockstep from a single thread, with MQTT replaced by a client which
+only counts messages. Prints a summary of how well the pit held its set point.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+from controller import TempController, Mode
+from db.data_logger import DataLogger
+from hardware_id import get_cpu_id
+from metrics import Metrics
+from peripherals.blower_fan import BlowerFan
+from peripherals.simulation import Simulation, SimClock, SimulatedMqttClient
+from peripherals.temperature_sensors import Max31850Sensors
+
+logger = logging.getLogger(__name__)
+
+
+class SimulationRunner:
+    """ Drives a TempController wired to a Simulation, one control tick at a time on a SimClock. """
+
+    def __init__(self, config, state, db_path=':memory:', metrics=None):
+        """
+        \:param config: Full agent config.
+        \:param state: Controller state, e.g. mode and set points.
+        \:param db_path: SQLite file for the data logger.
+        """
+        self.clock = SimClock()
+        self.simulation = Simulation(config, self.clock)
+        self.client = SimulatedMqttClient()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.sensors = Max31850Sensors(config['temperature'], self.simulation.ds, self.clock.time)
+        self.sensors.run_in_thread = False
+        # The fan monitor follows simulated time, checked once per tick, and never saves its profile.
+        fan_config = dict(config['fan'], monitor=dict(config['fan'].get('monitor', {}), profile_path=None))
+        self.blower_fan = BlowerFan(fan_config, self.simulation.gpio, self.simulation.pulse_counter,
+                                    self.clock.time)
+        if self.blower_fan.monitor is not None:
+            self.blower_fan.monitor.run_in_thread = False
+
+        # Writes happen in line, there is no writer thread to keep up with simulated time.
+        data_logger_config = dict(config['data_logger'], write_behind=False)
+        self.data_logger = DataLogger(db_path, get_cpu_id(), data_logger_config)
+        self.controller = TempController(config, self.sensors, self.blower_fan, self.client, self.data_logger,
+                                         self.metrics, state)
+
+        self._interval = config['intervals']['control_loop_second']
+        self._sampling_seconds = config['temperature']['sampling_seconds']
+        self._next_sample = None
+        self.ticks = 0
+
+    def start(self):
+        self.controller.initialise()
+        self.controller.start()
+        self._next_sample = self.clock.time()
+
+    def stop(self):
+        self.controller.stop()
+        self.data_logger.stop()
+
+    def tick(self):
+        """ Samples sensors when due, runs one control tick and moves simulated time on by one interval. """
+        now = self.clock.time()
+        while self._next_sample <= now:
+            # Conversions are instant on simulated hardware.
+            self.sensors.sample(sleeper=lambda seconds: None)
+            self._next_sample += self._sampling_seconds
+        self.controller.tick(now, now)
+        if self.blower_fan.monitor is not None:
+            self.blower_fan.monitor.check()
+        self.ticks += 1
+        self.clock.advance(self._interval)
+
+    def run(self, seconds, on_tick=None):
+        """ Runs ticks until the given simulated duration has elapsed. """
+        end = self.clock.time() + seconds
+        while self.clock.time() < end:
+            self.tick()
+            if on_tick is not None:
+                on_tick(self)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the controller against a simulated smoker.')
+    parser.add_argument('--config', default='config/config.json', help='Agent config file')
+    parser.add_argument('--hours', type=float, default=12, help='Simulated hours to run for')
+    parser.add_argument('--set-point', type=float, default=115, help='Pit set point')
+    parser.add_argument('--settle-minutes', type=float, default=60,
+                        help='Ignore pit error for this long after starting')
+    parser.add_argument('--seed', type=int, help='Random seed for sensor noise')
+    parser.add_argument('--db', default=':memory:', help='SQLite file to log into')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING, format='%(asctime)s %(levelname)s: %(message)s')
+    with open(args.config) as f:
+        config = json.load(f)
+    if args.seed is not None:
+        config.setdefault('simulation', {})['seed'] = args.seed
+    state = {'mode': Mode.ACTIVE, 'pit': {'setPoint': args.set_point}}
+
+    runner = SimulationRunner(config, state, args.db)
+    model = runner.simulation.model
+    errors = []
+
+    def on_tick(r):
+        if model.elapsed >= args.settle_minutes * 60:
+            errors.append(model.pit - args.set_point)
+
+    runner.start()
+    wall_start = time.perf_counter()
+    runner.run(args.hours * 3600, on_tick)
+    wall = time.perf_counter() - wall_start
+    runner.stop()
+
+    summary = {
+        'simulated_hours': args.hours,
+        'ticks': runner.ticks,
+        'wall_seconds': round(wall, 3),
+        'ticks_per_second': round(runner.ticks / wall, 1) if wall > 0 else None,
+        'pit': round(model.pit, 2),
+        'probes': {name: round(temp, 2) for name, temp in model.probes.items()},
+        'pit_error_mean': round(sum(errors) / len(errors), 3) if errors else None,
+        'pit_error_max': round(max(abs(e) for e in errors), 3) if errors else None,
+        'published': runner.client.published,
+        'published_bytes': runner.client.published_bytes,
+    }
+    print(json.dumps(summary, indent=4))
+
+
+if __name__ == '__main__':
+    main()
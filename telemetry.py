@@ -0,0 +1,168 @@
+import json
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+# Version of the binary frame layout, bump whenever the layout changes.
+FRAME_VERSION = 1
+
+# Binary frame layout, little endian:
+#   header:      version (uint8), timestamp (float64), channel count (uint8)
+#   per channel: temperature in tenths of a degree (int16, TEMP_NONE when unknown), status (int8)
+#   fan:         duty cycle in tenths of a percent (int16), rpm (uint16), healthy (uint8)
+# Channels always come in FRAME_CHANNELS order, or in the order of the configured sensors when they differ.
+FRAME_CHANNELS = ('board', 'probe1', 'probe2', 'pit')
+_HEADER = struct.Struct('<BdB')
+_CHANNEL = struct.Struct('<hb')
+_FAN = struct.Struct('<hHB')
+TEMP_SCALE = 10
+TEMP_NONE = -32768
+
+STATUS_OK = 0
+STATUS_UNKNOWN = -1
+
+
+def _fixed(value, scale):
+    """ Converts a float to a clamped int16 fixed point value. """
+    return max(-32767, min(32767, int(round(value * scale))))
+
+
+def _status(data):
+    """ Numeric status of a channel, channels without one (e.g. the board) are OK whenever they have a value. """
+    status = data.get('status')
+    if status is None or status == 'OK':
+        return STATUS_OK if data['temp'] is not None else STATUS_UNKNOWN
+    return int(status)
+
+
+def encode_frame(timestamp, channels, fan, names=FRAME_CHANNELS):
+    """ Packs a full telemetry sample in a compact binary frame.
+
+    \:param channels: dict of channel name to {'temp', 'status'}, for each of names.
+    \:param fan: dict as {'dutyCycle', 'rpm', 'healthy'}.
+    \:param names: Channels in frame order, the decoder has to be given the same.
+    """
+    parts = [_HEADER.pack(FRAME_VERSION, timestamp, len(names))]
+    for name in names:
+        data = channels[name]
+        temp = TEMP_NONE if data['temp'] is None else _fixed(data['temp'], TEMP_SCALE)
+        parts.append(_CHANNEL.pack(temp, _status(data)))
+    parts.append(_FAN.pack(_fixed(fan['dutyCycle'], TEMP_SCALE), min(int(fan['rpm']), 0xFFFF), bool(fan['healthy'])))
+    return b''.join(parts)
+
+
+def decode_frame(frame, names=FRAME_CHANNELS):
+    """ Unpacks a binary frame back into (timestamp, channels, fan), as given to encode_frame. """
+    version, timestamp, count = _HEADER.unpack_from(frame, 0)
+    if version != FRAME_VERSION:
+        raise ValueError('Unsupported telemetry frame version {}'.format(version))
+    offset = _HEADER.size
+    channels = dict()
+    for name in names[:count]:
+        temp, status = _CHANNEL.unpack_from(frame, offset)
+        offset += _CHANNEL.size
+        channels[name] = {'temp': None if temp == TEMP_NONE else temp / TEMP_SCALE, 'status': status}
+    duty, rpm, healthy = _FAN.unpack_from(frame, offset)
+    return timestamp, channels, {'dutyCycle': duty / TEMP_SCALE, 'rpm': rpm, 'healthy': bool(healthy)}
+
+
+class Deadband:
+    """ Publish-on-change filter, a channel is only sent again once a value moved past its delta, its status or any
+    other non numeric value changed, or the heartbeat interval expired.
+    """
+
+    def __init__(self, config):
+        """
+        \:param config: The 'deadband' section of the controller config, filtering is disabled when empty.
+        """
+        self.enabled = config.get('enabled', False)
+        self._deltas = {
+            'temp': config.get('temp', 0.5),
+            'dutyCycle': config.get('duty_cycle', 1),
+            'rpm': config.get('rpm', 100),
+        }
+        self._heartbeat = config.get('heartbeat_seconds', 60)
+        self._last_sent = dict()
+        self.suppressed = dict()
+
+    def changed(self, name, values, now):
+        """ Checks whether a channel has to be sent, and if so remembers it as the last sent value. """
+        if self.enabled:
+            last = self._last_sent.get(name)
+            if last is not None and now - last[0] < self._heartbeat and not self._moved(last[1], values):
+                self.suppressed[name] = self.suppressed.get(name, 0) + 1
+                return False
+            self._last_sent[name] = (now, values)
+        return True
+
+    def _moved(self, last, values):
+        for key, value in values.items():
+            previous = last.get(key)
+            delta = self._deltas.get(key)
+            if delta is None or value is None or previous is None:
+                if value != previous:
+                    return True
+            elif abs(value - previous) >= delta:
+                return True
+        return False
+
+    @property
+    def suppressed_total(self):
+        """ Number of channel samples suppressed so far, across all channels. """
+        return sum(self.suppressed.values())
+
+
+class TelemetryPublisher:
+    """ Publishes each sample either per topic as JSON (compatibility mode), or as a single frame per tick. """
+
+    MODE_TOPICS = 'topics'
+    MODE_FRAME = 'frame'
+    ENCODING_BINARY = 'binary'
+    ENCODING_JSON = 'json'
+
+    def __init__(self, config, client, topic, frame_channels=FRAME_CHANNELS):
+        """
+        \:param config: The 'telemetry' section of the mqtt config, may be empty.
+        \:param topic: Root topic of this device.
+        \:param frame_channels: Channels in binary frame order.
+        """
+        self._client = client
+        self._topic = topic
+        self._frame_channels = tuple(frame_channels)
+        self._mode = config.get('mode', TelemetryPublisher.MODE_TOPICS)
+        self._encoding = config.get('encoding', TelemetryPublisher.ENCODING_BINARY)
+        self._frame_topic = topic + '/telemetry'
+        self.suppressed_frames = 0
+        logger.info('Publishing telemetry in {} mode'.format(
+            self._mode if self._mode == TelemetryPublisher.MODE_TOPICS else self._encoding + ' ' + self._mode))
+
+    def publish(self, timestamp, channels, fan, changed=None, fans=()):
+        """ Publishes one sample.
+
+        \:param channels: List of (name, data) for each temperature channel.
+        \:param fan: dict as {'dutyCycle', 'rpm', 'healthy'}.
+        \:param changed: Names of channels, including 'fan', which need sending, or None for all. Frames carry every
+        channel and are sent whenever anything changed.
+        \:param fans: List of (name, data) for any fans besides the first, published on their own topics in either mode.
+        """
+        if changed is not None and len(changed) == 0:
+            if self._mode == TelemetryPublisher.MODE_FRAME:
+                self.suppressed_frames += 1
+        elif self._mode == TelemetryPublisher.MODE_FRAME:
+            if self._encoding == TelemetryPublisher.ENCODING_JSON:
+                frame = {'v': FRAME_VERSION, 'ts': timestamp, 'fan': fan}
+                frame.update(channels)
+                self._client.publish(self._frame_topic, json.dumps(frame, separators=(',', ':')))
+            else:
+                self._client.publish(self._frame_topic,
+                                     encode_frame(timestamp, dict(channels), fan, self._frame_channels))
+        else:
+            for name, data in channels:
+                if changed is None or name in changed:
+                    self._client.publish(self._topic + '/temperature/' + name, json.dumps(data))
+            if changed is None or 'fan' in changed:
+                self._client.publish(self._topic + '/fan', json.dumps(fan))
+        for name, data in fans:
+            if changed is None or name in changed:
+                self._client.publish(self._topic + '/fan/' + name, json.dumps(data))
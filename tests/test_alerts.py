@@ -0,0 +1,97 @@
+import unittest
+
+from alerts import AlertEngine, FIRED, CLEARED
+
+STATE = {'pit': {'setPoint': 110}, 'probe1': {'setPoint': 90}}
+
+
+class AlertEngineTest(unittest.TestCase):
+    def engine(self, *rules):
+        self.alerts = []
+        return AlertEngine({'rules': list(rules)}, self.alerts.append)
+
+    def feed(self, engine, samples, active=True, state=STATE):
+        """ Feeds (time, value) samples of the pit, or of whatever sensor the values dict names. """
+        for now, values in samples:
+            engine.feed(1.7e9 + now, now, values if isinstance(values, dict) else {'pit': values}, state, active)
+        return [(alert['rule'], alert['state']) for alert in self.alerts]
+
+    def test_threshold_with_hysteresis(self):
+        engine = self.engine({'name': 'pit_high', 'sensor': 'pit', 'above': 130, 'hysteresis': 5,
+                              'cooldown_seconds': 0})
+        changes = self.feed(engine, [(0, 125), (1, 131), (2, 129), (3, 131), (4, 124), (5, 131)])
+        self.assertEqual(changes, [('pit_high', FIRED), ('pit_high', CLEARED), ('pit_high', FIRED)])
+        fired = self.alerts[0]
+        self.assertEqual((fired['value'], fired['limit'], fired['timestamp']), (131, 130, 1.7e9 + 1))
+        self.assertIn('pit_high', fired['message'])
+        self.assertEqual(engine.firing, ['pit_high'])
+
+    def test_cooldown(self):
+        engine = self.engine({'name': 'pit_high', 'sensor': 'pit', 'above': 130, 'cooldown_seconds': 60})
+        changes = self.feed(engine, [(0, 131), (1, 120), (2, 131), (3, 120), (61, 131)])
+        self.assertEqual(changes, [('pit_high', FIRED), ('pit_high', CLEARED), ('pit_high', FIRED)])
+        self.assertEqual(self.alerts[-1]['timestamp'], 1.7e9 + 61)
+
+    def test_relative_to_set_point(self):
+        engine = self.engine({'name': 'probe1_done', 'sensor': 'probe1', 'set_point': 'probe1', 'above': 0})
+        self.assertEqual(self.feed(engine, [(0, {'probe1': 89}), (1, {'probe1': 90.5})]), [('probe1_done', FIRED)])
+        self.assertEqual(self.alerts[0]['limit'], 90)
+        # No set point, no limit
+        self.assertEqual(self.engine({'name': 'x', 'sensor': 'pit', 'set_point': 'probe9', 'above': 0}).rules[0]
+                         .evaluate(0, 200, STATE), (None, 200, None))
+
+    def test_require_clear_arms_once_back_in_range(self):
+        engine = self.engine({'name': 'pit_low', 'sensor': 'pit', 'set_point': 'pit', 'below': -20,
+                              'require_clear': True})
+        # Heating up from cold is not too cold
+        self.assertEqual(self.feed(engine, [(0, 20), (60, 60), (120, 95)]), [])
+        self.assertEqual(self.feed(engine, [(180, 105), (240, 85)]), [('pit_low', FIRED)])
+
+    def test_active_only_rules_clear_and_reset_when_inactive(self):
+        engine = self.engine({'name': 'pit_high', 'sensor': 'pit', 'above': 130})
+        self.feed(engine, [(0, 140)])
+        self.assertEqual(self.feed(engine, [(1, 140)], active=False), [('pit_high', FIRED), ('pit_high', CLEARED)])
+        self.assertEqual(engine.firing, [])
+
+    def test_rate_of_change(self):
+        engine = self.engine({'name': 'fire_out', 'type': 'rate', 'sensor': 'pit', 'below': -2, 'window_seconds': 60,
+                              'cooldown_seconds': 0})
+        steady = [(t, 110) for t in range(0, 120, 5)]
+        falling = [(120 + t, 110 - t * 0.1) for t in range(0, 300, 5)]
+        changes = self.feed(engine, steady + falling)
+        self.assertEqual(changes, [('fire_out', FIRED)])
+        # Falling 6 degrees a minute, the average gets past the limit well within a window
+        self.assertLess(self.alerts[0]['value'], -2)
+        self.assertLess(self.alerts[0]['timestamp'], 1.7e9 + 120 + 60)
+
+    def test_rate_needs_a_full_window(self):
+        engine = self.engine({'name': 'fire_out', 'type': 'rate', 'sensor': 'pit', 'below': -2, 'window_seconds': 60})
+        self.assertEqual(self.feed(engine, [(0, 110), (10, 100), (20, 90)]), [])
+
+    def test_no_change(self):
+        engine = self.engine({'name': 'probe1_stall', 'type': 'no_change', 'sensor': 'probe1', 'seconds': 600,
+                              'tolerance': 1})
+        samples = [(t, {'probe1': 70 + (t % 120) / 200}) for t in range(0, 660, 30)]
+        self.assertEqual(self.feed(engine, samples), [('probe1_stall', FIRED)])
+        # First sample past 600 seconds without moving by more than the tolerance
+        self.assertEqual(self.alerts[0]['timestamp'], 1.7e9 + 630)
+        self.assertEqual(self.feed(engine, [(690, {'probe1': 72})]), [('probe1_stall', FIRED),
+                                                                       ('probe1_stall', CLEARED)])
+
+    def test_unknown_values_are_skipped(self):
+        engine = self.engine({'name': 'pit_high', 'sensor': 'pit', 'above': 130})
+        self.assertEqual(self.feed(engine, [(0, None), (1, {})]), [])
+
+    def test_failing_handler_is_contained(self):
+        engine = AlertEngine({'rules': [{'name': 'pit_high', 'sensor': 'pit', 'above': 130}]}, lambda alert: 1 / 0)
+        engine.feed(0, 0, {'pit': 140}, STATE, True)
+        self.assertEqual(engine.fired, 1)
+
+    def test_disabled(self):
+        engine = AlertEngine({'enabled': False, 'rules': [{'name': 'pit_high', 'sensor': 'pit', 'above': 130}]})
+        engine.feed(0, 0, {'pit': 140}, STATE, True)
+        self.assertEqual(engine.firing, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+from peripherals.conversion_scheduler import ConversionScheduler
+
+
+class ConversionSchedulerTest(unittest.TestCase):
+    def cycle(self, scheduler, outcomes):
+        """ Runs one conversion cycle, outcomes by sensor as (ok, not_ready). """
+        read = []
+        for sensor, (ok, not_ready) in outcomes.items():
+            if scheduler.due(sensor):
+                read.append(sensor)
+                scheduler.record(sensor, 0.01, ok, not_ready)
+        scheduler.end_cycle(0.8)
+        return read
+
+    def test_shrinks_wait_down_to_minimum(self):
+        scheduler = ConversionScheduler(0.75, {'min_conversion_seconds': 0.1})
+        for _ in range(50):
+            self.cycle(scheduler, {'pit': (True, False)})
+        self.assertAlmostEqual(scheduler.conversion_seconds, 0.1)
+
+    def test_backs_off_and_never_shrinks_below_a_failed_wait(self):
+        scheduler = ConversionScheduler(0.75, {'min_conversion_seconds': 0.1})
+        for _ in range(10):
+            self.cycle(scheduler, {'pit': (True, False)})
+        too_short = scheduler.conversion_seconds
+        self.cycle(scheduler, {'pit': (False, True)})
+        self.assertAlmostEqual(scheduler.conversion_seconds, too_short * 1.5)
+        for _ in range(50):
+            self.cycle(scheduler, {'pit': (True, False)})
+        self.assertAlmostEqual(scheduler.conversion_seconds, too_short * 1.1)
+
+    def test_wait_is_capped(self):
+        scheduler = ConversionScheduler(0.75, {})
+        self.cycle(scheduler, {'pit': (False, True)})
+        self.assertEqual(scheduler.conversion_seconds, 0.75)
+
+    def test_failing_sensor_backs_off_exponentially(self):
+        scheduler = ConversionScheduler(0.75, {'failure_threshold': 2, 'max_skip_cycles': 4})
+        reads = [self.cycle(scheduler, {'pit': (True, False), 'probe1': (False, False)}) for _ in range(20)]
+        probe_cycles = [i for i, read in enumerate(reads) if 'probe1' in read]
+        # Read twice, then skipping 1, 2, 4 and at most 4 cycles
+        self.assertEqual(probe_cycles, [0, 1, 3, 6, 11, 16])
+        self.assertTrue(all('pit' in read for read in reads))
+        # A sensor which only ever failed says nothing about the conversion wait
+        self.assertAlmostEqual(scheduler.conversion_seconds, 0.1)
+
+    def test_recovered_sensor_is_read_every_cycle(self):
+        scheduler = ConversionScheduler(0.75, {'failure_threshold': 1})
+        self.cycle(scheduler, {'probe1': (False, False)})
+        self.cycle(scheduler, {'probe1': (True, False)})
+        self.assertEqual(self.cycle(scheduler, {'probe1': (True, False)}), ['probe1'])
+        stats = scheduler.stats['sensors']['probe1']
+        self.assertEqual(stats['failures'], 0)
+        self.assertEqual(stats['skipped'], 1)
+
+    def test_missing_sensor_does_not_hold_the_wait_up(self):
+        scheduler = ConversionScheduler(0.75, {'min_conversion_seconds': 0.1})
+        for _ in range(100):
+            self.cycle(scheduler, {'pit': (True, False), 'probe1': (True, False), 'probe2': (False, True)})
+        self.assertAlmostEqual(scheduler.conversion_seconds, 0.1)
+
+    def test_backs_off_when_most_of_the_bus_is_not_ready(self):
+        scheduler = ConversionScheduler(0.2, {'max_conversion_seconds': 0.75})
+        self.cycle(scheduler, {'pit': (False, True), 'probe1': (False, True), 'probe2': (True, False)})
+        self.assertAlmostEqual(scheduler.conversion_seconds, 0.3)
+
+    def test_fixed_wait_when_not_adaptive(self):
+        scheduler = ConversionScheduler(0.75, {'adaptive': False})
+        self.cycle(scheduler, {'pit': (True, False)})
+        self.assertEqual(scheduler.conversion_seconds, 0.75)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from db.data_logger import DataLogger
+
+
+class FailingCommit:
+    """ Stands in for the connection of a data logger, failing its next commit. """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.fail = True
+
+    def commit(self):
+        if self.fail:
+            self.fail = False
+            raise sqlite3.OperationalError('database or disk is full')
+        self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class DataLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'agent.sqlite')
+        self.addCleanup(shutil.rmtree, self.dir)
+        # Recent enough to be kept by retention, on a 15 minute boundary.
+        self.start = int(time.time() - 3600) // 900 * 900
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_rollups_include_open_buckets(self):
+        data_logger = DataLogger(self.path, 'device')
+        for i in range(150):
+            temp = None if i % 10 == 0 else 100.0 + i % 7
+            data_logger.log_sensors(self.start + i, [('pit', {'temp': temp, 'status': 0})])
+
+        # Before stop(), the 1m bucket still open and the 15m one are already written
+        raw = self.query('SELECT CAST(timestamp / 60 AS INTEGER) * 60 AS b, MIN(NULLIF(temp, -1)), '
+                         'MAX(NULLIF(temp, -1)), AVG(NULLIF(temp, -1)), COUNT(NULLIF(temp, -1)) '
+                         'FROM sensor_data GROUP BY b ORDER BY b;')
+        rollup = self.query('SELECT bucket, temp_min, temp_max, temp_mean, count FROM sensor_rollup_1m '
+                            'ORDER BY bucket;')
+        self.assertEqual(len(rollup), 3)
+        for expected, actual in zip(raw, rollup):
+            self.assertEqual(expected[:3] + expected[4:], actual[:3] + actual[4:])
+            self.assertAlmostEqual(expected[3], actual[3])
+        self.assertEqual(self.query('SELECT bucket, count FROM sensor_rollup_15m;'), [(self.start, 135)])
+
+        data_logger.stop()
+        self.assertEqual(self.query('SELECT SUM(count) FROM sensor_rollup_1m;'), [(135,)])
+
+    def test_rollups_leave_out_a_failed_commit(self):
+        data_logger = DataLogger(self.path, 'device')
+        data_logger.log_sensors(self.start + 50, [('pit', {'temp': 100.0, 'status': 0})])
+        conn = data_logger.conn
+        data_logger.conn = FailingCommit(conn)
+        with self.assertRaises(sqlite3.OperationalError):
+            data_logger.log_sensors(self.start + 59, [('pit', {'temp': None, 'status': 3})])
+        data_logger.log_sensors(self.start + 61, [('pit', {'temp': 101.0, 'status': 0})])
+        data_logger.stop()
+
+        self.assertEqual(self.query('SELECT timestamp, status FROM sensor_data;'),
+                         [(self.start + 50, 0), (self.start + 61, 0)])
+        # Not even the status of the lost sample makes it to its bucket
+        self.assertEqual(self.query('SELECT bucket, count, last_status FROM sensor_rollup_1m ORDER BY bucket;'),
+                         [(self.start, 1, 0), (self.start + 60, 1, 0)])
+
+    def test_write_behind_rollups(self):
+        data_logger = DataLogger(self.path, 'device', {'write_behind': True, 'flush_interval_seconds': 0.01})
+        data_logger.start()
+        for i in range(100):
+            data_logger.log_sensors(self.start + i, [('pit', {'temp': 100.0, 'status': 0})])
+        data_logger.stop()
+        self.assertEqual(self.query('SELECT SUM(count), MIN(temp_min) FROM sensor_rollup_1m;'), [(100, 100.0)])
+
+    def test_trim_deletes_a_chunk_at_a_time(self):
+        data_logger = DataLogger(self.path, 'device', {'retention_hours': 1, 'trim_chunk_size': 10})
+        now = time.time()
+        expired = now - 7200
+        conn = data_logger.conn
+        conn.executemany('INSERT INTO sensor_data (timestamp, device_id, sensor_name, temp, status) '
+                         'VALUES (?, ?, ?, ?, ?);',
+                         [(expired + i, 'device', 'pit', 100.0, 0) for i in range(25)] +
+                         [(now - i, 'device', 'pit', 100.0, 0) for i in range(5)])
+        conn.executemany('INSERT INTO fan_data (timestamp, device_id, fan_name, duty_cycle, rpm, healthy) '
+                         'VALUES (?, ?, ?, ?, ?, ?);', [(expired + i, 'device', 'fan', 50, 1000, 1) for i in range(15)])
+        conn.commit()
+
+        counts = []
+        while True:
+            deleted = data_logger.trim_chunk(now)
+            counts.append((deleted, self.query('SELECT COUNT(*) FROM sensor_data;')[0][0],
+                           self.query('SELECT COUNT(*) FROM fan_data;')[0][0]))
+            if deleted < 10:
+                break
+        self.assertEqual(counts, [(10, 20, 5), (10, 10, 0), (5, 5, 0)])
+        # Oldest first, and nothing within retention
+        self.assertEqual(self.query('SELECT MIN(timestamp) > {} FROM sensor_data;'.format(now - 3600)), [(1,)])
+        self.assertEqual(data_logger.trim_chunk(now), 0)
+
+    def test_history_status_is_the_latest_of_each_bucket(self):
+        data_logger = DataLogger(self.path, 'device')
+        for i in range(120):
+            # Open circuit for 10 seconds, half of each of two buckets
+            status = 3 if 35 <= i < 45 else 0
+            data_logger.log_sensors(self.start + i, [('pit', {'temp': None if status else 100.0, 'status': status})])
+
+        resolution, step, pages = data_logger.history(['pit'], self.start, self.start + 120, 12, 100)
+        points = [point for _, page in pages for point in page]
+        self.assertEqual((resolution, step, len(points)), ('raw', 10, 12))
+        self.assertEqual([point[5] for point in points], [0, 0, 0, 3, 0, 0, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(points[3][1:5], [100.0, 100.0, 100.0, 5])
+
+        data_logger.stop()
+        resolution, step, pages = data_logger.history(['pit'], self.start, self.start + 120, 2, 100)
+        points = [point for _, page in pages for point in page]
+        self.assertEqual((resolution, step), ('1m', 60))
+        self.assertEqual([(point[4], point[5]) for point in points], [(50, 0), (60, 0)])
+
+    def test_write_behind_drops_samples_when_the_queue_is_full(self):
+        data_logger = DataLogger(self.path, 'device', {'write_behind': True, 'queue_size': 2, 'batch_size': 1})
+        data_logger.start()
+        # The writer takes the first sample, then waits on the connection while the queue fills up
+        with data_logger._conn_lock:
+            data_logger.log_sensors(self.start, [('pit', {'temp': 100.0, 'status': 0})])
+            deadline = time.time() + 5
+            while data_logger.queue_depth and time.time() < deadline:
+                time.sleep(0.001)
+            for i in range(1, 6):
+                data_logger.log_sensors(self.start + i, [('pit', {'temp': 100.0, 'status': 0}),
+                                                         ('probe1', {'temp': 50.0, 'status': 0})])
+            self.assertEqual(data_logger.queue_depth, 2)
+        data_logger.stop()
+
+        self.assertEqual(data_logger.dropped_samples, 6)
+        self.assertEqual(self.query('SELECT timestamp, sensor_name FROM sensor_data ORDER BY id;'),
+                         [(self.start, 'pit'), (self.start + 1, 'pit'), (self.start + 1, 'probe1'),
+                          (self.start + 2, 'pit'), (self.start + 2, 'probe1')])
+
+    def test_write_behind_stop_drains_and_flushes(self):
+        data_logger = DataLogger(self.path, 'device', {'write_behind': True, 'flush_interval_seconds': 60})
+        data_logger.start()
+        for i in range(50):
+            data_logger.log_sensors(self.start + i, [('pit', {'temp': 100.0 + i, 'status': 0})],
+                                    [('fan', {'dutyCycle': i, 'rpm': None, 'healthy': True})])
+        # Nothing is due before the flush interval
+        self.assertEqual(self.query('SELECT COUNT(*) FROM sensor_data;'), [(0,)])
+        data_logger.stop()
+
+        self.assertEqual(data_logger.dropped_samples, 0)
+        self.assertEqual(self.query('SELECT COUNT(*) FROM sensor_data;'), [(50,)])
+        self.assertEqual(self.query('SELECT COUNT(*) FROM fan_data;'), [(50,)])
+        self.assertEqual(self.query('SELECT count, temp_min, temp_max FROM sensor_rollup_1m;'), [(50, 100.0, 149.0)])
+
+    def test_fans_are_logged_apart_from_temperatures(self):
+        data_logger = DataLogger(self.path, 'device', {'write_behind': True, 'flush_interval_seconds': 0.01})
+        data_logger.start()
+        data_logger.log_sensors(self.start, [('pit', {'temp': 100.0, 'status': 0})],
+                                [('fan', {'dutyCycle': 35.5, 'rpm': 1800, 'healthy': True})])
+        data_logger.log_sensors(self.start + 1, [], [('fan2', {'dutyCycle': 20, 'rpm': 0, 'healthy': False})])
+        data_logger.stop()
+
+        self.assertEqual(self.query('SELECT DISTINCT sensor_name FROM sensor_data;'), [('pit',)])
+        self.assertEqual(self.query('SELECT DISTINCT sensor_name FROM sensor_rollup_1m;'), [('pit',)])
+        self.assertEqual(list(data_logger.fan_samples(['fan', 'fan2'])),
+                         [(self.start, 'fan', 35.5, 1800, 1), (self.start + 1, 'fan2', 20, 0, 0)])
+
+    def test_read_only_leaves_the_file_alone(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript('CREATE TABLE sensor_data (id INTEGER PRIMARY KEY, timestamp TIMESTAMP, device_id STRING, '
+                           'sensor_name STRING, temp REAL, status INTEGER);'
+                           'CREATE TABLE push_tokens (device_id STRING, token STRING);')
+        conn.execute("INSERT INTO sensor_data VALUES (1, ?, 'device', 'pit', 100.0, 0);", (self.start,))
+        conn.commit()
+        conn.close()
+        before = os.path.getmtime(self.path), os.path.getsize(self.path)
+
+        data_logger = DataLogger(self.path, None, read_only=True)
+        self.assertEqual(data_logger.devices(), [('device', 1)])
+        data_logger.device_id = 'device'
+        self.assertEqual(list(data_logger.samples(['pit'])), [(self.start, 'pit', 100.0, 0)])
+        data_logger.conn.close()
+
+        self.assertEqual((os.path.getmtime(self.path), os.path.getsize(self.path)), before)
+        self.assertEqual(self.query('PRAGMA journal_mode;'), [('delete',)])
+        self.assertEqual([row[1] for row in self.query('PRAGMA table_info(push_tokens);')], ['device_id', 'token'])
+        self.assertFalse(os.path.exists(self.path + '-wal'))
+
+
+if __name__ == '__main__':
+    unittest.main()
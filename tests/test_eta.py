@@ -0,0 +1,98 @@
+import math
+import unittest
+
+from eta import ProbeEta, CookEta, LEARNING, OK, PLATEAU, DONE, UNKNOWN
+
+CONFIG = {'interval_seconds': 60, 'min_updates': 5, 'plateau_rate': 0.05, 'plateau_seconds': 1200, 'reset_drop': 10}
+
+# Probe heating towards a pit at 110, less losses: dT/dt = K * (110 - T) + C per minute, so it tends to 100.
+K = 0.02
+C = -0.2
+TARGET = 110 + C / K
+
+
+def probe_temp(minutes, start=5.0):
+    return TARGET - (TARGET - start) * math.exp(-K * minutes)
+
+
+def minutes_to(temp, set_point):
+    return math.log((TARGET - temp) / (TARGET - set_point)) / K
+
+
+class ProbeEtaTest(unittest.TestCase):
+    def feed(self, eta, start_minute, end_minute, temp=probe_temp, step_seconds=5):
+        for second in range(int(start_minute * 60), int(end_minute * 60), step_seconds):
+            eta.feed(second, temp(second / 60), 110.0)
+
+    def test_unknown_without_samples(self):
+        eta = ProbeEta(CONFIG)
+        self.assertEqual(eta.estimate(90)['status'], UNKNOWN)
+        self.assertFalse(eta.feed(0, None, 110))
+
+    def test_learning_until_enough_updates(self):
+        eta = ProbeEta(CONFIG)
+        self.feed(eta, 0, 4)
+        self.assertEqual(eta.estimate(90), {'status': LEARNING, 'seconds': None, 'rate': eta.estimate(90)['rate']})
+
+    def test_learns_the_heating_model(self):
+        eta = ProbeEta(CONFIG)
+        # Past the first hour, the early estimates carry the initial guess still
+        self.feed(eta, 0, 90)
+        self.assertAlmostEqual(eta.k, K, delta=K * 0.1)
+        self.assertAlmostEqual(eta.pit + eta.c / eta.k, TARGET, delta=2)
+
+        estimate = eta.estimate(90)
+        self.assertEqual(estimate['status'], OK)
+        # Against the averaged temperature the model was last updated with
+        expected = minutes_to(eta.temp, 90) * 60
+        self.assertAlmostEqual(estimate['seconds'], expected, delta=expected * 0.05)
+        self.assertGreater(estimate['rate'], 0)
+
+    def test_done(self):
+        eta = ProbeEta(CONFIG)
+        self.feed(eta, 0, 10)
+        self.assertEqual(eta.estimate(20), {'status': DONE, 'seconds': 0, 'rate': eta.estimate(20)['rate']})
+
+    def test_plateau(self):
+        eta = ProbeEta(CONFIG)
+        self.feed(eta, 0, 60)
+        stalled_at = probe_temp(60)
+        self.feed(eta, 60, 100, temp=lambda minutes: stalled_at)
+        self.assertEqual(eta.estimate(90)['status'], PLATEAU)
+        self.assertIsNone(eta.estimate(90)['seconds'])
+
+    def test_set_point_out_of_reach(self):
+        eta = ProbeEta(CONFIG)
+        self.feed(eta, 0, 240)
+        # Creeping towards 100 this slowly, 105 is never reached
+        self.assertEqual(eta.estimate(105)['status'], PLATEAU)
+
+    def test_restarts_when_moved_to_another_piece(self):
+        eta = ProbeEta(CONFIG)
+        self.feed(eta, 0, 60)
+        self.assertGreater(eta.updates, 5)
+        self.feed(eta, 60, 62, temp=lambda minutes: 10.0)
+        self.assertEqual(eta.updates, 0)
+        self.assertEqual(eta.estimate(90)['status'], LEARNING)
+
+
+class CookEtaTest(unittest.TestCase):
+    def test_feeds_each_probe_with_its_chamber(self):
+        cook = CookEta(CONFIG, {'probe1': 'pit', 'probe3': 'smoker2'})
+        updated = []
+        for second in range(0, 3600, 5):
+            temps = {'pit': 110.0, 'probe1': probe_temp(second / 60), 'smoker2': None, 'probe3': 20.0}
+            updated += cook.feed(second, temps)
+        self.assertEqual(set(updated), {'probe1'})
+        state = {'probe1': {'setPoint': 90}, 'probe3': {'setPoint': 70}}
+        self.assertEqual(cook.estimate('probe1', state)['status'], OK)
+        self.assertEqual(cook.estimate('probe3', state)['status'], UNKNOWN)
+        self.assertEqual(cook.estimate('probe1', {})['status'], UNKNOWN)
+
+    def test_disabled(self):
+        cook = CookEta(dict(CONFIG, enabled=False), {'probe1': 'pit'})
+        self.assertEqual(cook.feed(0, {'pit': 110, 'probe1': 20}), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import json
+import threading
+import unittest
+
+from metrics import BUCKET_BOUNDS, Histogram, Metrics
+
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles_are_bucket_upper_bounds(self):
+        histogram = Histogram()
+        for _ in range(90):
+            histogram.record(1e-5)
+        for _ in range(9):
+            histogram.record(1e-3)
+        histogram.record(10.0)
+
+        self.assertEqual(histogram.percentile(0.5), BUCKET_BOUNDS[1])
+        self.assertEqual(histogram.percentile(0.9), BUCKET_BOUNDS[1])
+        self.assertEqual(histogram.percentile(0.99), BUCKET_BOUNDS[8])
+        # Past the last bucket, the largest sample
+        self.assertEqual(histogram.percentile(1.0), 10.0)
+        self.assertIsNone(Histogram().percentile(0.5))
+
+
+class MetricsTest(unittest.TestCase):
+    def test_snapshot(self):
+        metrics = Metrics({'enabled': True})
+        with metrics.stage('tick'):
+            pass
+        metrics.record('command.GetHistory', 0.002)
+        metrics.count('alerts.fired.pit_high')
+        metrics.count('alerts.fired.pit_high', 2)
+        metrics.gauge('queue', lambda: 3)
+        metrics.gauge('broken', lambda: 1 / 0)
+
+        snapshot = json.loads(json.dumps(metrics.snapshot()))
+        self.assertTrue(snapshot['enabled'])
+        self.assertEqual(sorted(snapshot['latency']), ['command.GetHistory', 'tick'])
+        self.assertEqual(snapshot['latency']['command.GetHistory']['count'], 1)
+        self.assertEqual(snapshot['latency']['command.GetHistory']['p50'], BUCKET_BOUNDS[9])
+        self.assertEqual(snapshot['counters'], {'alerts.fired.pit_high': 3})
+        self.assertEqual(snapshot['gauges'], {'queue': 3, 'broken': None})
+        self.assertIn(threading.current_thread().name, snapshot['threads'])
+
+    def test_disabled_records_nothing(self):
+        metrics = Metrics()
+        with metrics.stage('tick'):
+            pass
+        metrics.record('command.GetHistory', 0.002)
+        metrics.count('faults')
+        snapshot = metrics.snapshot()
+        self.assertEqual((snapshot['latency'], snapshot['counters']), ({}, {}))
+
+    def test_counts_from_many_threads(self):
+        metrics = Metrics({'enabled': True})
+        barrier = threading.Barrier(8)
+
+        def work():
+            barrier.wait()
+            for _ in range(10000):
+                metrics.count('samples')
+                metrics.record('command.GetHistory', 1e-4)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['samples'], 80000)
+        self.assertEqual(snapshot['latency']['command.GetHistory']['count'], 80000)
+
+
+if __name__ == '__main__':
+    unittest.main()
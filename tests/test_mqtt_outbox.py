@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import paho.mqtt.client as mqtt_client
+
+from mqtt_outbox import MqttOutbox
+
+
+class MessageInfo:
+    def __init__(self, rc):
+        self.rc = rc
+
+
+class FakeClient:
+    """ paho client which takes messages while up, and refuses them as not connected while down. """
+
+    def __init__(self):
+        self.up = True
+        self.sent = []
+        self.max_queued = None
+
+    def max_queued_messages_set(self, count):
+        self.max_queued = count
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self.up:
+            return MessageInfo(mqtt_client.MQTT_ERR_NO_CONN)
+        self.sent.append((topic, payload, qos, retain))
+        return MessageInfo(mqtt_client.MQTT_ERR_SUCCESS)
+
+    def subscribe(self, topic):
+        return 'subscribed ' + topic
+
+
+class MqttOutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'outbox.sqlite')
+        self.client = FakeClient()
+        self.outbox = self.create()
+
+    def tearDown(self):
+        self.outbox.stop()
+        shutil.rmtree(self.dir)
+
+    def create(self, **config):
+        config = dict({'path': self.path, 'memory_messages': 10, 'replay_rate': 10000, 'batch_size': 4,
+                       'retry_seconds': 0.05, 'max_queued_messages': 50}, **config)
+        return MqttOutbox(config, self.client)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'Timed out, outbox at {}'.format(self.outbox.stats))
+            time.sleep(0.01)
+
+    def publish(self, first, last):
+        for n in range(first, last):
+            self.outbox.publish('t/{}'.format(n), 'payload {}'.format(n), n % 2, n % 3 == 0)
+
+    def sent_numbers(self):
+        return [int(topic.split('/')[1]) for topic, _, _, _ in self.client.sent]
+
+    def test_delegates_to_the_client(self):
+        self.assertEqual(self.client.max_queued, 50)
+        self.assertEqual(self.outbox.subscribe('x'), 'subscribed x')
+
+    def test_publishes_directly_while_connected(self):
+        self.outbox.connected()
+        self.publish(0, 3)
+        self.assertEqual(self.sent_numbers(), [0, 1, 2])
+        self.assertEqual(self.outbox.stats['direct'], 3)
+
+    def test_holds_back_and_replays_in_order(self):
+        self.outbox.start()
+        self.publish(0, 5)
+        self.assertEqual(self.client.sent, [])
+        self.assertEqual(self.outbox.stats['memory'], 5)
+
+        self.outbox.connected()
+        self.wait_for(lambda: len(self.client.sent) == 5)
+        self.assertEqual(self.sent_numbers(), list(range(5)))
+        self.assertEqual(self.client.sent[3], ('t/3', 'payload 3', 1, True))
+
+    def test_spills_to_disk_and_replays_in_order(self):
+        self.outbox.start()
+        for n in range(0, 35, 5):
+            self.publish(n, n + 5)
+            # The thread spills, publishing never does
+            time.sleep(0.02)
+        self.wait_for(lambda: self.outbox.stats['disk'] >= 30)
+        self.assertGreaterEqual(self.outbox.stats['spilled'], 30)
+
+        self.outbox.connected()
+        self.wait_for(lambda: self.outbox.stats['memory'] == 0 and self.outbox.stats['disk'] == 0)
+        self.assertEqual(self.sent_numbers(), list(range(35)))
+        # Payloads come back from disk as bytes
+        self.assertEqual(self.client.sent[3], ('t/3', b'payload 3', 1, True))
+        # Caught up, publishes go straight through again
+        self.publish(35, 36)
+        self.assertEqual(self.outbox.stats['direct'], 1)
+
+    def test_evicts_oldest_over_disk_budget(self):
+        # Each message is 14 bytes, 10 of them fit
+        self.outbox = self.create(max_disk_bytes=140)
+        self.outbox.start()
+        for n in range(10, 40, 10):
+            self.publish(n, n + 10)
+            self.wait_for(lambda: self.outbox.stats['memory'] == 0)
+        self.assertLessEqual(self.outbox.stats['disk_bytes'], 140)
+        self.assertEqual(self.outbox.stats['evicted'], 20)
+
+        self.outbox.connected()
+        self.wait_for(lambda: self.outbox.stats['disk'] == 0)
+        self.assertEqual(self.sent_numbers(), list(range(30, 40)))
+
+    def test_retries_when_the_client_refuses(self):
+        self.client.up = False
+        self.outbox.start()
+        self.outbox.connected()
+        self.publish(0, 3)
+        self.wait_for(lambda: not self.outbox.stats['connected'])
+
+        self.client.up = True
+        self.outbox.connected()
+        self.wait_for(lambda: len(self.client.sent) == 3)
+        self.assertEqual(self.sent_numbers(), [0, 1, 2])
+
+    def test_memory_is_bounded_without_the_thread(self):
+        self.publish(0, 50)
+        self.assertEqual(self.outbox.stats['memory'], 20)
+        self.assertEqual(self.outbox.stats['evicted'], 30)
+
+    def test_keeps_held_messages_across_restarts(self):
+        self.outbox.start()
+        self.publish(0, 5)
+        self.outbox.stop()
+
+        self.outbox = self.create()
+        self.assertEqual(self.outbox.stats['disk'], 5)
+        self.outbox.start()
+        self.outbox.connected()
+        self.wait_for(lambda: len(self.client.sent) == 5)
+        self.assertEqual(self.sent_numbers(), list(range(5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
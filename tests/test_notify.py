@@ -0,0 +1,119 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from db.data_logger import DataLogger
+from notifications.notify import Notifier
+from notifications.stub_push_server import StubPushServer
+
+GONE = 'ExponentPushToken[gone]'
+TOKENS = ['ExponentPushToken[a]', 'ExponentPushToken[b]', GONE]
+
+
+class NotifierTest(unittest.TestCase):
+    """ Drives the notifier against the stub push service, one batch at a time. """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'agent.sqlite')
+        self.data_logger = DataLogger(self.path, 'device')
+        self.data_logger.save_push_tokens(TOKENS)
+
+        self.server = StubPushServer(('localhost', 0), unregistered=[GONE], out=None)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.notifier = Notifier({'push_host': self.server.url, 'backoff_seconds': 10, 'max_backoff_seconds': 60,
+                                  'max_attempts': 3}, self.path, self.data_logger)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        self.data_logger.conn.close()
+        shutil.rmtree(self.dir)
+
+    def outbox(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute('SELECT token, attempts, next_attempt_at, status FROM notification_outbox '
+                                'ORDER BY id;').fetchall()
+        finally:
+            conn.close()
+
+    def test_sends_to_every_active_token(self):
+        self.notifier.notify('Pit at 130', 'BBQ alert', {'rule': 'pit_high'})
+        self.assertEqual(self.notifier.send_due(), 0)
+        self.assertEqual(self.notifier.queue_pending(), 3)
+        self.assertEqual(self.notifier.send_due(), 3)
+
+        self.assertEqual(sorted(m['to'] for m in self.server.messages), sorted(TOKENS))
+        message = self.server.messages[0]
+        self.assertEqual(message['body'], 'Pit at 130')
+        self.assertEqual(message['title'], 'BBQ alert')
+        self.assertEqual(message['data'], {'rule': 'pit_high'})
+        self.assertEqual(self.notifier.sent, 2)
+        self.assertEqual(self.notifier.send_due(), 0)
+
+    def test_unregistered_device_is_deactivated(self):
+        self.notifier.notify('first')
+        self.notifier.queue_pending()
+        self.notifier.send_due()
+
+        self.assertEqual(self.notifier.deactivated_tokens, 1)
+        self.assertNotIn((GONE,), self.data_logger.push_tokens())
+        self.assertEqual([row[3] for row in self.outbox()], ['failed'])
+
+        # Nothing more is queued for it, until it registers again
+        self.notifier.notify('second')
+        self.assertEqual(self.notifier.queue_pending(), 2)
+        self.data_logger.save_push_tokens([GONE])
+        self.assertIn((GONE,), self.data_logger.push_tokens())
+
+    def test_server_errors_are_retried_with_backoff(self):
+        self.server.fail_rate = 1.0
+        self.notifier.notify('Fire out')
+        self.notifier.queue_pending()
+        now = time.time()
+        self.assertEqual(self.notifier.send_due(now), 3)
+
+        rows = self.outbox()
+        self.assertEqual([(attempts, status) for _, attempts, _, status in rows], [(1, 'pending')] * 3)
+        for _, _, next_attempt_at, _ in rows:
+            # Full backoff of the first attempt, less up to half of it as jitter
+            self.assertGreaterEqual(next_attempt_at, now + 5)
+            self.assertLessEqual(next_attempt_at, now + 10)
+        # Not due yet
+        self.assertEqual(self.notifier.send_due(now + 1), 0)
+
+        self.server.fail_rate = 0.0
+        self.assertEqual(self.notifier.send_due(now + 10), 3)
+        self.assertEqual(self.notifier.sent, 2)
+        self.assertEqual(self.notifier.retried, 3)
+
+    def test_gives_up_after_max_attempts(self):
+        self.server.fail_rate = 1.0
+        self.notifier.notify('Fire out')
+        self.notifier.queue_pending()
+        now = time.time()
+        for attempt in range(3):
+            self.assertEqual(self.notifier.send_due(now + attempt * 100), 3)
+
+        self.assertEqual({row[3] for row in self.outbox()}, {'failed'})
+        self.assertEqual(self.notifier.failed, 3)
+        self.assertEqual(self.notifier.send_due(now + 1000), 0)
+
+    def test_sender_thread_queues_and_sends(self):
+        self.notifier.start()
+        self.notifier.notify('Pit at 130')
+        deadline = time.time() + 5
+        while len(self.server.messages) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.notifier.stop()
+        self.assertEqual(sorted(m['to'] for m in self.server.messages), sorted(TOKENS))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from pacer import Pacer
+
+
+class FakeClock:
+    """ Monotonic clock which only moves when told to, or when slept on. """
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class PacerTest(unittest.TestCase):
+    def pacer(self, policy, max_catch_up=5):
+        self.clock = FakeClock()
+        pacer = Pacer(1.0, policy, max_catch_up, clock=self.clock, sleeper=self.clock.sleep)
+        pacer.start()
+        return pacer
+
+    def test_sleeps_until_next_slot(self):
+        pacer = self.pacer(Pacer.SKIP)
+        self.clock.now += 0.25
+        self.assertEqual(pacer.pace(), 0)
+        self.assertEqual(self.clock.sleeps, [0.75])
+        self.assertEqual(self.clock.now, 101.0)
+        self.assertEqual(pacer.overruns, 0)
+
+    def test_skip_drops_missed_slots(self):
+        pacer = self.pacer(Pacer.SKIP)
+        self.clock.now += 2.5
+        self.assertAlmostEqual(pacer.pace(), 1.5)
+        # Back on the time line, at the next slot still ahead
+        self.assertAlmostEqual(self.clock.now, 103.0)
+        self.assertEqual(pacer.missed_slots, 2)
+        self.assertEqual(pacer.overruns, 1)
+
+    def test_catch_up_runs_back_to_back(self):
+        pacer = self.pacer(Pacer.CATCH_UP)
+        self.clock.now += 2.5
+        pacer.pace()
+        self.assertEqual(self.clock.sleeps, [])
+        # The slot at 102 is due already, then the loop is on time again
+        pacer.pace()
+        self.assertEqual(self.clock.sleeps, [])
+        pacer.pace()
+        self.assertAlmostEqual(self.clock.sleeps[-1], 0.5)
+        self.assertAlmostEqual(self.clock.now, 103.0)
+        self.assertEqual(pacer.missed_slots, 0)
+
+    def test_catch_up_skips_beyond_max(self):
+        pacer = self.pacer(Pacer.CATCH_UP, max_catch_up=2)
+        self.clock.now += 5.5
+        pacer.pace()
+        self.assertAlmostEqual(self.clock.now, 106.0)
+        self.assertEqual(pacer.missed_slots, 5)
+
+    def test_shift_moves_time_line(self):
+        pacer = self.pacer(Pacer.SHIFT)
+        self.clock.now += 2.5
+        pacer.pace()
+        self.assertEqual(self.clock.sleeps, [])
+        self.clock.now += 0.5
+        pacer.pace()
+        self.assertAlmostEqual(self.clock.sleeps[-1], 0.5)
+        self.assertAlmostEqual(self.clock.now, 103.5)
+
+    def test_rejects_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Pacer(1.0, 'later')
+
+
+if __name__ == '__main__':
+    unittest.main()
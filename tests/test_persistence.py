@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from persistence import PersistenceService
+
+
+class PersistenceServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state.json')
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def read(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_saves_a_snapshot(self):
+        service = PersistenceService()
+        document = {'pit': {'setPoint': 110}}
+        service.save(self.path, document)
+        document['pit']['setPoint'] = 120
+        service.flush()
+        self.assertEqual(self.read(), {'pit': {'setPoint': 110}})
+        self.assertEqual(os.listdir(self.dir), ['state.json'])
+
+    def test_revisions_increase(self):
+        first = PersistenceService()
+        revision = first.save(self.path, {})
+        self.assertEqual(first.revision(self.path), revision)
+        self.assertEqual(first.save(self.path, {}), revision + 1)
+        self.assertEqual(first.revision('other.json'), revision + 1)
+        # Starting from the time the service started, so they keep increasing across restarts
+        self.assertGreaterEqual(revision, int(time.time() * 1000) - 1000)
+
+    def test_coalesces_within_debounce(self):
+        clock = mock.Mock(return_value=0.0)
+        with mock.patch('persistence.time.monotonic', clock):
+            service = PersistenceService({'debounce_seconds': 1, 'max_delay_seconds': 5})
+            service.save(self.path, {'n': 1})
+            clock.return_value = 0.5
+            service.save(self.path, {'n': 2})
+            due, wait = service._due(1.2)
+            self.assertEqual(due, [])
+            self.assertAlmostEqual(wait, 0.3)
+            due, wait = service._due(1.5)
+        self.assertEqual(due, [(self.path, service.revision(self.path), json.dumps({'n': 2}, indent=4))])
+        self.assertIsNone(wait)
+        self.assertEqual(service.coalesced, 1)
+
+    def test_written_at_max_delay_under_constant_updates(self):
+        clock = mock.Mock(return_value=0.0)
+        with mock.patch('persistence.time.monotonic', clock):
+            service = PersistenceService({'debounce_seconds': 1, 'max_delay_seconds': 2})
+            for step in range(5):
+                clock.return_value = step * 0.5
+                service.save(self.path, {'n': step})
+            due, _ = service._due(2.0)
+        self.assertEqual(len(due), 1)
+
+    def test_writer_thread(self):
+        service = PersistenceService({'debounce_seconds': 0.05, 'max_delay_seconds': 0.2})
+        service.start()
+        try:
+            for n in range(5):
+                service.save(self.path, {'n': n})
+            deadline = time.monotonic() + 5
+            while service.writes == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            service.stop()
+        self.assertEqual(self.read(), {'n': 4})
+        self.assertEqual(service.writes, 1)
+        self.assertEqual(service.stats['pending'], 0)
+
+    def test_stop_writes_pending(self):
+        service = PersistenceService({'debounce_seconds': 60, 'max_delay_seconds': 60})
+        service.start()
+        service.save(self.path, {'n': 1})
+        service.stop()
+        self.assertEqual(self.read(), {'n': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
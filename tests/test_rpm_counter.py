@@ -0,0 +1,79 @@
+import unittest
+from unittest import mock
+
+from peripherals.blower_fan import PeriodRpmCounter
+
+
+class FakeGpio:
+    IN = 1
+    FALLING = 2
+    PUD_UP = 3
+
+    def setup(self, pin, mode, pull_up_down=None):
+        pass
+
+    def add_event_detect(self, pin, edge, callback):
+        self.callback = callback
+
+
+class PeriodRpmCounterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch('peripherals.blower_fan.perf_counter', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.gpio = FakeGpio()
+        self.counter = PeriodRpmCounter(6, {'window': 8, 'glitch_tolerance': 0.5, 'timeout_seconds': 1.0}, self.gpio)
+        self.counter.initialise()
+        self.counter.start()
+
+    def pulses(self, periods):
+        for period in periods:
+            self.now += period
+            self.gpio.callback(6)
+
+    def assertRpm(self, expected):
+        # Periods are floats and RPM is truncated, within 1% is good enough for a fan
+        self.assertAlmostEqual(self.counter.rpm, expected, delta=expected / 100)
+
+    def test_rpm_from_periods(self):
+        # 2 pulses per rotation every 20ms is 1500 RPM
+        self.pulses([0.02] * 20)
+        self.assertRpm(1500)
+
+    def test_needs_two_edges(self):
+        self.assertEqual(self.counter.rpm, 0)
+        self.pulses([0.02])
+        self.assertEqual(self.counter.rpm, 0)
+
+    def test_follows_speed_changes_within_the_window(self):
+        self.pulses([0.02] * 20 + [0.01] * 8)
+        self.assertRpm(3000)
+
+    def test_rejects_missed_pulses(self):
+        # Averaging in the doubled period would read 1333 RPM
+        self.pulses([0.02] * 10 + [0.04] + [0.02] * 4)
+        self.assertRpm(1500)
+
+    def test_slowing_down_and_stopped(self):
+        self.pulses([0.02] * 20)
+        self.now += 0.06
+        # No pulse for 60ms, it turns at 500 RPM at most
+        self.assertRpm(500)
+        self.now += 1.0
+        self.assertEqual(self.counter.rpm, 0)
+
+    def test_ring_buffer_wraps(self):
+        self.pulses([0.02] * 1000 + [0.025] * 8)
+        self.assertRpm(1200)
+
+    def test_stopped_counter_reads_zero(self):
+        self.pulses([0.02] * 20)
+        self.counter.stop()
+        self.assertEqual(self.counter.rpm, 0)
+        self.counter.start()
+        self.assertEqual(self.counter.rpm, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import random
+import statistics
+import unittest
+
+from peripherals.sample_history import SampleHistory
+
+
+class SampleHistoryTest(unittest.TestCase):
+    def test_empty(self):
+        history = SampleHistory(5, 0.5)
+        self.assertEqual(len(history), 0)
+        self.assertIsNone(history.last)
+        self.assertIsNone(history.mean)
+        self.assertIsNone(history.ema)
+        self.assertIsNone(history.median)
+        self.assertIsNone(history.slope)
+
+    def test_ema(self):
+        history = SampleHistory(5, 0.5)
+        history.add(0, 10)
+        self.assertEqual(history.ema, 10)
+        history.add(1, 20)
+        self.assertEqual(history.ema, 15)
+
+    def test_slope_of_a_line(self):
+        history = SampleHistory(10, 0.3)
+        for i in range(25):
+            history.add(1.7e9 + i * 2, 100 + 0.5 * i)
+        # Units per second, from samples 2 seconds apart
+        self.assertAlmostEqual(history.slope, 0.25)
+
+    def test_matches_window_over_many_wraps(self):
+        rng = random.Random(42)
+        size = 7
+        history = SampleHistory(size, 0.3)
+        samples = []
+        for i in range(1000):
+            sample = (1.7e9 + i + rng.random() * 0.1, rng.uniform(50, 150))
+            samples.append(sample)
+            history.add(*sample)
+            window = samples[-size:]
+            values = [v for _, v in window]
+            self.assertEqual(len(history), len(window))
+            self.assertEqual(history.last, values[-1])
+            self.assertAlmostEqual(history.mean, statistics.mean(values))
+            self.assertAlmostEqual(history.median, statistics.median(values))
+            if len(window) > 1:
+                self.assertAlmostEqual(history.slope, self.least_squares(window), places=6)
+
+    @staticmethod
+    def least_squares(window):
+        n = len(window)
+        mean_t = sum(t for t, _ in window) / n
+        mean_v = sum(v for _, v in window) / n
+        return sum((t - mean_t) * (v - mean_v) for t, v in window) / sum((t - mean_t) ** 2 for t, _ in window)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import json
+import unittest
+
+from telemetry import encode_frame, decode_frame, Deadband, TelemetryPublisher, FRAME_CHANNELS, FRAME_VERSION
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+
+CHANNELS = {
+    'board': {'temp': 41.26},
+    'probe1': {'temp': 65.04, 'status': 0},
+    'probe2': {'temp': None, 'status': 3},
+    'pit': {'temp': 110.55, 'status': 'OK'},
+}
+FAN = {'dutyCycle': 37.25, 'rpm': 1830.4, 'healthy': True}
+
+
+class FrameTest(unittest.TestCase):
+    def test_round_trip(self):
+        frame = encode_frame(1.7e9, CHANNELS, FAN)
+        self.assertEqual(len(frame), 10 + 3 * len(FRAME_CHANNELS) + 5)
+        timestamp, channels, fan = decode_frame(frame)
+        self.assertEqual(timestamp, 1.7e9)
+        self.assertEqual(channels['board'], {'temp': 41.3, 'status': 0})
+        self.assertEqual(channels['probe1'], {'temp': 65.0, 'status': 0})
+        self.assertEqual(channels['probe2'], {'temp': None, 'status': 3})
+        self.assertEqual(channels['pit'], {'temp': 110.6, 'status': 0})
+        self.assertEqual(fan, {'dutyCycle': 37.2, 'rpm': 1830, 'healthy': True})
+
+    def test_clamps_out_of_range(self):
+        _, channels, fan = decode_frame(encode_frame(0, dict(CHANNELS, pit={'temp': 9999, 'status': 0}),
+                                                     dict(FAN, rpm=100000)))
+        self.assertEqual(channels['pit']['temp'], 3276.7)
+        self.assertEqual(fan['rpm'], 0xFFFF)
+
+    def test_unknown_board_temperature(self):
+        _, channels, _ = decode_frame(encode_frame(0, dict(CHANNELS, board={'temp': None}), FAN))
+        self.assertEqual(channels['board'], {'temp': None, 'status': -1})
+
+    def test_configured_channels(self):
+        names = ('board', 'pit', 'smoker2', 'probe3')
+        channels = dict(CHANNELS, smoker2={'temp': 90.0, 'status': 0}, probe3={'temp': 20.5, 'status': 0})
+        _, decoded, _ = decode_frame(encode_frame(0, channels, FAN, names), names)
+        self.assertEqual(list(decoded), list(names))
+        self.assertEqual(decoded['probe3']['temp'], 20.5)
+
+    def test_rejects_other_versions(self):
+        frame = bytearray(encode_frame(0, CHANNELS, FAN))
+        frame[0] = FRAME_VERSION + 1
+        with self.assertRaises(ValueError):
+            decode_frame(bytes(frame))
+
+
+class DeadbandTest(unittest.TestCase):
+    def setUp(self):
+        self.deadband = Deadband({'enabled': True, 'temp': 0.5, 'duty_cycle': 1, 'rpm': 100, 'heartbeat_seconds': 60})
+
+    def test_suppresses_small_moves(self):
+        self.assertTrue(self.deadband.changed('pit', {'temp': 100.0, 'status': 0}, 0))
+        self.assertFalse(self.deadband.changed('pit', {'temp': 100.4, 'status': 0}, 1))
+        self.assertFalse(self.deadband.changed('pit', {'temp': 99.6, 'status': 0}, 2))
+        self.assertTrue(self.deadband.changed('pit', {'temp': 100.5, 'status': 0}, 3))
+        # Compared against the last value sent, not the last one seen
+        self.assertFalse(self.deadband.changed('pit', {'temp': 100.9, 'status': 0}, 4))
+        self.assertEqual(self.deadband.suppressed, {'pit': 3})
+        self.assertEqual(self.deadband.suppressed_total, 3)
+
+    def test_sends_status_and_unknown_changes(self):
+        self.deadband.changed('probe1', {'temp': 60.0, 'status': 0}, 0)
+        self.assertTrue(self.deadband.changed('probe1', {'temp': 60.0, 'status': 3}, 1))
+        self.assertTrue(self.deadband.changed('probe1', {'temp': None, 'status': 3}, 2))
+        self.assertFalse(self.deadband.changed('probe1', {'temp': None, 'status': 3}, 3))
+
+    def test_per_key_deltas(self):
+        self.deadband.changed('fan', FAN, 0)
+        self.assertFalse(self.deadband.changed('fan', dict(FAN, dutyCycle=38, rpm=1900), 1))
+        self.assertTrue(self.deadband.changed('fan', dict(FAN, rpm=1950), 2))
+        self.assertTrue(self.deadband.changed('fan', dict(FAN, rpm=1950, healthy=False), 3))
+
+    def test_heartbeat(self):
+        self.deadband.changed('pit', {'temp': 100.0}, 0)
+        self.assertFalse(self.deadband.changed('pit', {'temp': 100.0}, 59))
+        self.assertTrue(self.deadband.changed('pit', {'temp': 100.0}, 60))
+
+    def test_disabled(self):
+        deadband = Deadband({})
+        self.assertTrue(deadband.changed('pit', {'temp': 100.0}, 0))
+        self.assertTrue(deadband.changed('pit', {'temp': 100.0}, 1))
+
+
+class TelemetryPublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.client = RecordingClient()
+        self.channels = [(name, CHANNELS[name]) for name in FRAME_CHANNELS]
+
+    def test_topics_mode_publishes_changed_channels(self):
+        publisher = TelemetryPublisher({}, self.client, 'bbq/device')
+        publisher.publish(1.0, self.channels, FAN, {'pit', 'fan'}, [('fan2', FAN)])
+        self.assertEqual([topic for topic, _ in self.client.published],
+                         ['bbq/device/temperature/pit', 'bbq/device/fan'])
+        self.assertEqual(json.loads(self.client.published[1][1]), FAN)
+
+    def test_binary_frame_mode(self):
+        publisher = TelemetryPublisher({'mode': 'frame'}, self.client, 'bbq/device')
+        publisher.publish(1.0, self.channels, FAN, {'pit'})
+        publisher.publish(2.0, self.channels, FAN, set())
+        self.assertEqual(len(self.client.published), 1)
+        topic, frame = self.client.published[0]
+        self.assertEqual(topic, 'bbq/device/telemetry')
+        self.assertEqual(decode_frame(frame)[0], 1.0)
+        self.assertEqual(publisher.suppressed_frames, 1)
+
+    def test_json_frame_mode(self):
+        publisher = TelemetryPublisher({'mode': 'frame', 'encoding': 'json'}, self.client, 'bbq/device')
+        publisher.publish(1.0, self.channels, FAN)
+        frame = json.loads(self.client.published[0][1])
+        self.assertEqual(frame['v'], FRAME_VERSION)
+        self.assertEqual(frame['pit'], CHANNELS['pit'])
+        self.assertEqual(frame['fan'], FAN)
+
+
+if __name__ == '__main__':
+    unittest.main()
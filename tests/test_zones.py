@@ -0,0 +1,98 @@
+import json
+import unittest
+
+from commands import Commands
+from controller import check_zones, fan_configs, zone_configs, LEGACY_ZONE
+
+SENSORS = ['pit', 'probe1', 'probe2', 'smoker2', 'probe3']
+STATE = {'pit': {'setPoint': 110}, 'smoker2': {'setPoint': 90}}
+FAN = {'monitor': {'enabled': True, 'profile_path': 'config/fan_profile.json'}, 'pwm_gpio': 18}
+CONFIG = {'fan': FAN, 'fans': {'fan2': {'monitor': {'enabled': True}, 'pwm_gpio': 13}}}
+
+
+class ZonesTest(unittest.TestCase):
+    def check(self, *zones, config=CONFIG, state=STATE):
+        check_zones(list(zones), SENSORS, fan_configs(config), state)
+
+    def assertRejected(self, message, *zones, **kwargs):
+        with self.assertRaises(ValueError) as context:
+            self.check(*zones, **kwargs)
+        self.assertIn(message, str(context.exception))
+
+    def test_legacy_zone(self):
+        self.assertEqual(zone_configs({}), [LEGACY_ZONE])
+        self.check(LEGACY_ZONE)
+
+    def test_two_zones(self):
+        self.check(LEGACY_ZONE, {'name': 'smoker2', 'fan': 'fan2', 'probes': ['probe3']})
+
+    def test_rejects_unknown_sensors(self):
+        self.assertRejected('sensor pitt', {'name': 'pit', 'sensor': 'pitt'})
+        self.assertRejected('sensor probe9', {'name': 'pit', 'probes': ['probe9']})
+        self.assertRejected('sensor smoker3', {'name': 'smoker3', 'fan': 'fan2'})
+
+    def test_rejects_unknown_fan(self):
+        self.assertRejected('fan fan3', {'name': 'pit', 'fan': 'fan3'})
+
+    def test_rejects_shared_fan(self):
+        self.assertRejected('both drive fan fan', LEGACY_ZONE, {'name': 'smoker2'})
+
+    def test_rejects_zone_without_set_point(self):
+        self.assertRejected('no setPoint', LEGACY_ZONE, {'name': 'smoker2', 'fan': 'fan2'}, state={'pit': {}})
+
+    def test_rejects_repeated_names(self):
+        self.assertRejected('name of its own', LEGACY_ZONE, dict(LEGACY_ZONE, fan='fan2'))
+
+    def test_fan_profiles_default_per_fan(self):
+        fans = fan_configs(CONFIG)
+        self.assertEqual(list(fans), ['fan', 'fan2'])
+        self.assertEqual(fans['fan']['monitor']['profile_path'], 'config/fan_profile.json')
+        self.assertEqual(fans['fan2']['monitor']['profile_path'], 'config/fan_profile_fan2.json')
+        self.assertNotIn('profile_path', CONFIG['fans']['fan2']['monitor'])
+
+    def test_rejects_shared_fan_profile(self):
+        config = dict(CONFIG, fans={'fan2': FAN})
+        self.assertRejected('both learn into config/fan_profile.json', LEGACY_ZONE, config=config)
+        # Unless the monitor is off, and so never saves
+        self.check(LEGACY_ZONE, config=dict(CONFIG, fans={'fan2': dict(FAN, monitor={'profile_path': 'x'}),
+                                                          'fan3': dict(FAN, monitor={'profile_path': 'x'})}))
+
+
+class RecordingDataLogger:
+    def __init__(self):
+        self.sensors = None
+
+    def history(self, sensors, start, end, max_points, page_size):
+        self.sensors = sensors
+        return 'raw', 1, iter([])
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload):
+        self.published.append((topic, json.loads(payload)))
+
+
+class HistoryDefaultsTest(unittest.TestCase):
+    def get_history(self, temperature, **cmd):
+        data_logger = RecordingDataLogger()
+        client = RecordingClient()
+        commands = Commands({'temperature': temperature}, client, data_logger)
+        self.addCleanup(commands.stop)
+        self.assertTrue(commands._handle_get_history(dict(cmd, id=1, reply_topic='reply')))
+        self.assertTrue(client.published[-1][1]['last'])
+        return data_logger.sensors
+
+    def test_defaults_to_configured_sensors(self):
+        temperature = {'pit': {'id': 'a', 'temperature_offset': 0}, 'board': {'temperature_offset': 0},
+                       'probe1': {'id': 'b', 'temperature_offset': 0}, 'probe2': {'id': 'c', 'temperature_offset': 0},
+                       'probe3': {'id': 'd', 'temperature_offset': 0}, 'gpio': 17}
+        self.assertEqual(self.get_history(temperature), ['pit', 'probe1', 'probe2', 'probe3'])
+        self.assertEqual(self.get_history({'pit': {'id': 'a', 'temperature_offset': 0}}), ['pit'])
+        self.assertEqual(self.get_history(temperature, sensors=['probe3']), ['probe3'])
+
+
+if __name__ == '__main__':
+    unittest.main()